@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+test_main启动时间检查
+Startup time check for test_main
+
+用 python -X importtime 导入test_main，确认没有在启动时加载各阶段的重量级依赖，并且总导入时间在预算之内。
+适合放在cron任务之前或CI中运行，不通过时返回非0。
+Imports test_main under python -X importtime, checks that no heavy stage dependency is loaded at
+startup and that the total import time stays within budget. Suitable before cron runs or in CI;
+exits non-zero on failure.
+"""
+
+import os
+import re
+import sys
+import subprocess
+
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", 150))  # 导入test_main的时间预算（毫秒）/ Import budget for test_main (ms)
+RUNS = 5  # 取多次运行的最小值，减少噪声 / Take the minimum of several runs to reduce noise
+
+# 启动时不应该被导入的模块 / Modules that must not be imported at startup
+HEAVY_MODULES = ("selenium", "instaloader", "tqdm", "test_download", "test_upload", "test_login", "test_merge", "requests")
+
+_LINE = re.compile(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)")
+
+
+def measure_import(module="test_main"):
+    """导入一次模块，返回(总耗时毫秒, 被导入的顶层模块集合, 最慢的模块列表)
+    Import the module once and return (cumulative ms, set of imported top-level modules, slowest modules)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr[-2000:]}")
+
+    total_us = 0
+    imported = set()
+    entries = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        cumulative_us, name = int(match.group(1)), match.group(2)
+        imported.add(name.split(".")[0])
+        entries.append((cumulative_us, name))
+        if name == module:
+            total_us = cumulative_us
+    entries.sort(reverse=True)
+    return total_us / 1000, imported, entries[:10]
+
+
+def main():
+    best_ms, imported, slowest = None, set(), []
+    for _ in range(RUNS):
+        total_ms, imported, slowest = measure_import()
+        best_ms = total_ms if best_ms is None else min(best_ms, total_ms)
+
+    print(f"导入test_main用时: {best_ms:.1f}ms（预算 {STARTUP_BUDGET_MS:.0f}ms，{RUNS} 次取最小值）")
+    print("最慢的导入 / Slowest imports:")
+    for cumulative_us, name in slowest:
+        print(f"  {cumulative_us / 1000:8.1f}ms  {name}")
+
+    failed = False
+    heavy = sorted(name for name in HEAVY_MODULES if name in imported)
+    if heavy:
+        print(f"❌ 启动时导入了重量级模块: {', '.join(heavy)}")
+        failed = True
+    if best_ms > STARTUP_BUDGET_MS:
+        print(f"❌ 启动时间超出预算: {best_ms:.1f}ms > {STARTUP_BUDGET_MS:.0f}ms")
+        failed = True
+    if not failed:
+        print("✅ 启动时间检查通过")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+片头/片尾/转场素材库
+Intro / outro / transition bumper library
+
+素材只按标准化规格编码一次，并记录编码指纹；合并时直接复制流拼接，不再重新编码。
+只有标准化参数变化、源素材变化或指纹校验失败时才会自动重新编码。
+Bumpers are encoded once to the standardization spec and their codec fingerprint is recorded;
+the merge stage splices them in by stream copy. A bumper is re-encoded automatically only when
+the standardization parameters change, the source changes, or the fingerprint check fails.
+
+目录结构 / Layout:
+    bumpers/source/intro.mp4      源素材 / source material
+    bumpers/encoded/intro.mp4     标准化后的素材 / standardized bumper
+    bumpers/bumpers.json          编码记录 / encode records
+"""
+
+import os
+import glob
+import json
+
+from test_merge import (
+    FFMPEG_PATH, standardize_video, probe_video, is_standard_spec, standard_params_hash,
+)
+from ffmpeg_supervisor import run_process
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
+BUMPER_DIR = "bumpers"  # 素材库目录 / Bumper library directory
+SOURCE_DIR = os.path.join(BUMPER_DIR, "source")  # 源素材目录 / Source material directory
+ENCODED_DIR = os.path.join(BUMPER_DIR, "encoded")  # 标准化素材目录 / Standardized bumper directory
+INDEX_FILE = os.path.join(BUMPER_DIR, "bumpers.json")  # 编码记录 / Encode records
+BUMPER_NAMES = ("intro", "outro", "transition")  # 支持的素材类型 / Supported bumper kinds
+
+# 参与指纹校验的流参数 / Stream parameters that make up the codec fingerprint
+FINGERPRINT_KEYS = (
+    "video_codec", "profile", "width", "height", "fps", "pix_fmt", "time_base",
+    "audio_codec", "sample_rate", "channels",
+)
+
+
+def load_index():
+    """读取编码记录
+    Load encode records"""
+    if not os.path.exists(INDEX_FILE):
+        return {}
+    try:
+        with open(INDEX_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(index):
+    """原子地写入编码记录
+    Atomically write encode records"""
+    os.makedirs(BUMPER_DIR, exist_ok=True)
+    tmp_file = INDEX_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, INDEX_FILE)
+
+
+def find_source(name):
+    """查找指定类型的源素材
+    Find the source material for a bumper kind"""
+    matches = sorted(glob.glob(os.path.join(SOURCE_DIR, f"{name}.*")))
+    return matches[0] if matches else None
+
+
+def get_fingerprint(info):
+    """从probe_video结果中提取编码指纹
+    Extract the codec fingerprint from a probe_video result"""
+    return {key: info.get(key) for key in FINGERPRINT_KEYS}
+
+
+def _source_stamp(source_path):
+    stat = os.stat(source_path)
+    return {"source": os.path.abspath(source_path), "source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+def _is_up_to_date(record, source_path, encoded_path):
+    """检查已编码的素材是否仍然可以直接使用
+    Check whether an encoded bumper can still be used as-is"""
+    if not record or not os.path.exists(encoded_path):
+        return False
+    if record.get("spec_hash") != standard_params_hash():
+        return False
+    stamp = _source_stamp(source_path)
+    if any(record.get(key) != value for key, value in stamp.items()):
+        return False
+    info = probe_video(encoded_path)
+    return is_standard_spec(info) and get_fingerprint(info) == record.get("fingerprint")
+
+
+def prepare_bumper(name, force=False):
+    """确保指定素材已按当前规格编码，返回标准化素材路径
+    Make sure a bumper is encoded to the current spec and return its path
+
+    Returns:
+        标准化素材路径，没有源素材或编码失败时返回None / Standardized bumper path, None if missing or encoding failed
+    """
+    source_path = find_source(name)
+    if not source_path:
+        return None
+
+    encoded_path = os.path.join(ENCODED_DIR, f"{name}.mp4")
+    index = load_index()
+    if not force and _is_up_to_date(index.get(name), source_path, encoded_path):
+        return encoded_path
+
+    logger.info(f"正在按当前标准化规格编码素材: {name}")
+    os.makedirs(ENCODED_DIR, exist_ok=True)
+    # 没有音轨的素材补一条静音音轨，否则拼接后音画会错位 / Silent sources get a silent track, otherwise audio drifts after the splice
+    source_info = probe_video(source_path)
+    add_silence = bool(source_info) and not source_info.get("has_audio")
+    if not standardize_video(source_path, encoded_path, add_silence=add_silence):
+        logger.error(f"❌ 素材编码失败: {source_path}")
+        return None
+
+    info = probe_video(encoded_path)
+    if not is_standard_spec(info):
+        logger.error(f"❌ 素材编码结果不符合标准规格: {encoded_path}")
+        return None
+
+    index[name] = {
+        **_source_stamp(source_path),
+        "spec_hash": standard_params_hash(),
+        "fingerprint": get_fingerprint(info),
+    }
+    save_index(index)
+    return encoded_path
+
+
+def prepare_bumper_ts(name):
+    """返回素材的MPEG-TS版本（复制流重新封装），供智能渲染拼接使用
+    Return an MPEG-TS copy of the bumper (remuxed by stream copy) for smart-render joins"""
+    encoded_path = prepare_bumper(name)
+    if not encoded_path:
+        return None
+
+    ts_path = os.path.join(ENCODED_DIR, f"{name}.ts")
+    if os.path.exists(ts_path) and os.path.getmtime(ts_path) >= os.path.getmtime(encoded_path):
+        return ts_path
+
+    command = [
+        FFMPEG_PATH, "-y",
+        "-i", encoded_path,
+        "-c", "copy",
+        "-bsf:v", "h264_mp4toannexb",
+        "-f", "mpegts",
+        ts_path
+    ]
+    result = run_process(command)
+    return ts_path if result.returncode == 0 else None
+
+
+def get_bumpers(container="mp4"):
+    """准备素材库中所有可用的素材
+    Prepare every available bumper in the library
+
+    Args:
+        container: "mp4"用于标准合并，"ts"用于智能渲染 / "mp4" for the standard merge, "ts" for smart render
+
+    Returns:
+        dict: 素材类型到路径的映射，只包含可用的素材 / Mapping of bumper kind to path, available bumpers only
+    """
+    prepare = prepare_bumper_ts if container == "ts" else prepare_bumper
+    bumpers = {}
+    for name in BUMPER_NAMES:
+        path = prepare(name)
+        if path:
+            bumpers[name] = path
+    return bumpers
+
+
+def splice_bumpers(clip_paths, bumpers):
+    """按顺序插入片头、转场和片尾
+    Insert intro, transitions and outro in order"""
+    spliced = []
+    if bumpers.get("intro"):
+        spliced.append(bumpers["intro"])
+    for idx, path in enumerate(clip_paths):
+        if idx > 0 and bumpers.get("transition"):
+            spliced.append(bumpers["transition"])
+        spliced.append(path)
+    if bumpers.get("outro"):
+        spliced.append(bumpers["outro"])
+    return spliced
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="片头片尾素材库 / Bumper library")
+    parser.add_argument("--force", "-f", action="store_true", help="强制重新编码所有素材 / Force re-encode all bumpers")
+    args = parser.parse_args()
+
+    for bumper_name in BUMPER_NAMES:
+        path = prepare_bumper(bumper_name, force=args.force)
+        if path:
+            logger.info(f"✅ {bumper_name}: {path}")
+        else:
+            logger.warning(f"⚠️ {bumper_name}: 未找到源素材或编码失败")
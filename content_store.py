@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+按内容哈希去重的文件存储层：快速哈希、reflink/硬链接代替复制、合并已有的重复文件
+Content-addressed storage helpers: fast hashing, reflinks/hard links instead of copies, and collapsing existing duplicates
+
+    - hash_file：用mmap读取文件计算SHA-256，不经过Python的读缓冲；hash_files在线程池里并行计算
+      （hashlib处理大块数据时会释放GIL）
+    - clone_file：按reflink（写时复制，btrfs/XFS/APFS等）-> 硬链接 -> 复制的顺序“复制”文件，
+      同一文件系统上几GB的复制变成元数据操作
+    - move_file：同一文件系统上直接重命名，跨设备时用clone_file后删除
+    - find_duplicates/dedupe：在test_downloads、temp和merged_videos中找出内容相同的文件，
+      先按大小分组，只对大小相同的文件计算哈希，然后把重复的文件换成指向同一份数据的reflink或硬链接
+    - hash_file: SHA-256 via an mmap of the file, bypassing Python's read buffers; hash_files hashes
+      in parallel on a thread pool (hashlib releases the GIL on large buffers)
+    - clone_file: "copies" a file as a reflink (copy-on-write: btrfs, XFS, APFS, ...), then a hard link,
+      then a byte copy, so multi-gigabyte copies on one filesystem become metadata operations
+    - move_file: a rename on the same filesystem, clone_file plus delete across devices
+    - find_duplicates/dedupe: finds identical files across test_downloads, temp and merged_videos,
+      grouping by size first and hashing only same-sized files, then replaces duplicates with
+      reflinks or hard links to a single copy of the data
+
+硬链接共享同一个inode，原地改写其中一个会同时改变另一个：FFmpeg写输出前要先调用merge_cache.prepare_output_path()，
+temp目录里的中间文件会被重新写入，所以只用reflink去重。硬链接的文件还共用修改时间，而合并按修改时间
+挑选和排序下载的片段（merge_specific_videos、--last N、merge_todays_videos），所以下载目录也只用reflink。
+Hard links share one inode, so rewriting one in place changes the other: call
+merge_cache.prepare_output_path() before FFmpeg writes an output; intermediates in temp get
+rewritten, so they are only deduplicated with reflinks. Hard-linked files also share one mtime, and
+merges select and order downloaded clips by mtime (merge_specific_videos, --last N,
+merge_todays_videos), so the download directory is reflink-only as well.
+"""
+
+import os
+import sys
+import mmap
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from test_merge import DOWNLOADS_DIR, MERGED_DIR, TEMP_DIR
+from log_setup import get_logger
+
+logger = get_logger("store")
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024  # 每次交给hashlib的字节数 / Bytes handed to hashlib per update
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", min(8, os.cpu_count() or 2)))  # 并行哈希线程数 / Parallel hashing threads
+DEDUPE_DIRS = (DOWNLOADS_DIR, TEMP_DIR, MERGED_DIR)  # 默认去重的目录 / Directories deduplicated by default
+# 只能用reflink的目录：temp的文件会被原地改写，下载目录的文件靠修改时间排序
+# Reflink-only directories: files in temp are rewritten in place, downloads are ordered by mtime
+REFLINK_ONLY_DIRS = (DOWNLOADS_DIR, TEMP_DIR)
+FICLONE = 0x40049409  # Linux的ioctl(FICLONE)，即cp --reflink / Linux ioctl(FICLONE), as used by cp --reflink
+
+
+def hash_file(path):
+    """用mmap读取文件计算SHA-256
+    SHA-256 of a file, read through an mmap"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # 某些文件系统不支持mmap时退回普通读取 / Fall back to plain reads where mmap is unsupported
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+            return digest.hexdigest()
+        with mapped:
+            if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, HASH_CHUNK_SIZE):
+                    digest.update(view[offset:offset + HASH_CHUNK_SIZE])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+def hash_files(paths, workers=HASH_WORKERS):
+    """并行计算多个文件的哈希
+    Hash several files in parallel
+
+    Returns:
+        dict: 路径 -> SHA-256 / Path -> SHA-256
+    """
+    paths = list(dict.fromkeys(paths))
+    if len(paths) <= 1 or workers <= 1:
+        return {path: hash_file(path) for path in paths}
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        return dict(zip(paths, pool.map(hash_file, paths)))
+
+
+def _reflink(source, target):
+    if sys.platform != "linux":
+        return False
+    import fcntl
+
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+        return False
+
+
+def clone_file(source, target, hardlink=True, copy=True):
+    """把source“复制”到target：优先reflink，其次硬链接，最后才真正复制字节
+    "Copy" source to target: a reflink if possible, then a hard link, and only then a byte copy
+
+    Args:
+        hardlink: 是否允许硬链接（target之后会被原地改写时传False）/ Allow a hard link (pass False if target is rewritten in place later)
+        copy: 是否允许退回字节复制 / Allow falling back to a byte copy
+
+    Returns:
+        使用的方式："reflink"、"hardlink"、"copy"，都不可用时为None
+        The method used: "reflink", "hardlink", "copy", or None if none was possible
+    """
+    if os.path.exists(target):
+        os.remove(target)
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    if _reflink(source, target):
+        shutil.copystat(source, target)
+        return "reflink"
+    if hardlink:
+        try:
+            os.link(source, target)
+            return "hardlink"
+        except OSError:
+            pass
+    if copy:
+        shutil.copy2(source, target)
+        return "copy"
+    return None
+
+
+def move_file(source, target):
+    """移动文件：同一文件系统上重命名，跨设备时clone_file后删除源文件
+    Move a file: a rename on the same filesystem, clone_file plus deleting the source across devices"""
+    try:
+        os.replace(source, target)
+    except OSError:
+        clone_file(source, target, hardlink=False)
+        os.remove(source)
+    return target
+
+
+def _list_files(folders):
+    paths = []
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for root, _, files in os.walk(folder):
+            paths += [os.path.join(root, name) for name in files if name.endswith(".mp4")]
+    return paths
+
+
+def find_duplicates(folders=DEDUPE_DIRS, workers=HASH_WORKERS):
+    """找出内容相同的文件；先按大小分组，已经是同一个inode的只算一次
+    Find files with identical content; grouped by size first, and paths sharing one inode count once
+
+    Returns:
+        list: 每组重复文件的路径列表（每组至少两个不同的inode）/ Path lists of duplicate groups (at least two distinct inodes each)
+    """
+    by_size, seen_inodes = {}, set()
+    for path in _list_files(folders):
+        stat = os.stat(path)
+        inode = (stat.st_dev, stat.st_ino)
+        if stat.st_size == 0 or inode in seen_inodes:
+            continue
+        seen_inodes.add(inode)
+        by_size.setdefault(stat.st_size, []).append(path)
+
+    candidates = [path for paths in by_size.values() if len(paths) > 1 for path in paths]
+    by_hash = {}
+    for path, value in hash_files(candidates, workers).items():
+        by_hash.setdefault(value, []).append(path)
+    return [paths for paths in by_hash.values() if len(paths) > 1]
+
+
+def _in_dirs(path, folders):
+    path = os.path.abspath(path)
+    return any(path.startswith(os.path.abspath(folder) + os.sep) for folder in folders)
+
+
+def dedupe(folders=DEDUPE_DIRS, dry_run=False, workers=HASH_WORKERS):
+    """把重复文件换成指向同一份数据的reflink或硬链接；保留最新的文件为原件。
+    reflink的副本保留自己的修改时间；硬链接的副本和原件共用一个inode和修改时间，
+    所以原件或副本在REFLINK_ONLY_DIRS里时不用硬链接，文件系统不支持reflink就保留原样
+    Replace duplicates with reflinks or hard links to one copy of the data; the newest file is kept as the
+    original. A reflinked copy keeps its own modification time; a hard-linked copy shares the original's
+    inode and mtime, so no hard link is made when either file is in REFLINK_ONLY_DIRS, and such
+    duplicates are left alone where the filesystem has no reflinks
+
+    Returns:
+        (files, saved_bytes): 合并的文件数和节省的字节数 / Files collapsed and bytes saved
+    """
+    collapsed, saved = 0, 0
+    for paths in find_duplicates(folders, workers):
+        # 以最新的文件为原件，硬链接后其他文件看起来不会比原来更旧（retention按修改时间判断）
+        # Keep the newest as the original so hard-linked copies never look older (retention goes by mtime)
+        paths.sort(key=os.path.getmtime, reverse=True)
+        original = paths[0]
+        for path in paths[1:]:
+            size = os.path.getsize(path)
+            if dry_run:
+                logger.info(f"[dry-run] {path} -> {original}  ({size / 1024 ** 2:.1f}MB)")
+                collapsed, saved = collapsed + 1, saved + size
+                continue
+            stat = os.stat(path)
+            tmp_path = path + ".dedupe.tmp"
+            hardlink = not (_in_dirs(path, REFLINK_ONLY_DIRS) or _in_dirs(original, REFLINK_ONLY_DIRS))
+            method = clone_file(original, tmp_path, hardlink=hardlink, copy=False)
+            if not method:
+                continue
+            if method == "reflink":
+                os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(tmp_path, path)
+            logger.info(f"{method}: {path} -> {original}  ({size / 1024 ** 2:.1f}MB)")
+            collapsed, saved = collapsed + 1, saved + size
+    return collapsed, saved
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="按内容去重 / Content-hash deduplication")
+    parser.add_argument("folders", nargs="*", default=list(DEDUPE_DIRS), help="要检查的目录 / Directories to check")
+    parser.add_argument("--dedupe", action="store_true", help="把重复文件换成reflink或硬链接 / Replace duplicates with reflinks or hard links")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="只显示会合并的文件 / Only show what would be collapsed")
+    args = parser.parse_args()
+
+    if args.dedupe or args.dry_run:
+        files, saved = dedupe(args.folders, dry_run=args.dry_run)
+        logger.info(f"{'可' if args.dry_run else '已'}合并 {files} 个重复文件，节省 {saved / 1024 ** 3:.2f}GB")
+    else:
+        groups = find_duplicates(args.folders)
+        for paths in groups:
+            logger.info(f"{os.path.getsize(paths[0]) / 1024 ** 2:.1f}MB x{len(paths)}: " + ", ".join(paths))
+        wasted = sum(os.path.getsize(paths[0]) * (len(paths) - 1) for paths in groups)
+        logger.info(f"{len(groups)} 组重复文件，浪费 {wasted / 1024 ** 3:.2f}GB（--dedupe合并）")
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+标准化任务的成本模型和调度（最长任务优先）
+Cost model and scheduling for standardization jobs (longest job first)
+
+根据探测到的时长、分辨率和帧率，加上本机历史运行测得的编码吞吐量，预测每个片段的编码用时。
+任务按预测用时从长到短派发，同一个模型也用来预先估计整个标准化阶段的总用时。
+Each clip's encode time is predicted from its probed duration, resolution and frame rate plus the
+encode throughput measured on this machine in past runs. Jobs are dispatched longest first, and the
+same model gives an up-front ETA for the whole standardization stage.
+
+多个流水线（租户）同时合并时，它们的任务提交到同一个FairShareExecutor：按权重公平分配工作线程，
+每个租户内部仍然保持最长任务优先的顺序。
+When several pipelines (tenants) merge at the same time, their jobs go to one shared FairShareExecutor:
+workers are shared fairly by weight, and each tenant still runs its own jobs longest first.
+"""
+
+import os
+import json
+import heapq
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from test_merge import LOG_DIR, probe_video
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
+STATS_FILE = os.path.join(LOG_DIR, "encode_stats.json")  # 历史吞吐量记录 / Historical throughput records
+
+# 标准化输出的像素速率（1080x1920@30fps）/ Pixel rate of the standardized output (1080x1920@30fps)
+OUTPUT_PIXEL_RATE = 1080 * 1920 * 30
+# 没有历史记录时假设的吞吐量（工作量单位/秒）/ Assumed throughput without history (work units per second)
+DEFAULT_THROUGHPUT = 2.0e8
+# 新测量值在滑动平均中的权重 / Weight of a new measurement in the moving average
+EWMA_ALPHA = 0.3
+
+_stats_lock = threading.Lock()
+
+
+def load_stats():
+    """读取历史吞吐量
+    Load historical throughput"""
+    if not os.path.exists(STATS_FILE):
+        return {"throughput": {}}
+    try:
+        with open(STATS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {"throughput": {}}
+    data.setdefault("throughput", {})
+    return data
+
+
+def save_stats(data):
+    """原子地写入历史吞吐量
+    Atomically write historical throughput"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    tmp_file = STATS_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_file, STATS_FILE)
+
+
+def get_throughput(workers, stats=None):
+    """获取指定并行数下单个任务的吞吐量，没有记录时使用最接近的并行数
+    Per-job throughput at a given parallelism, falling back to the nearest recorded parallelism"""
+    stats = stats or load_stats()
+    table = stats["throughput"]
+    if str(workers) in table:
+        return table[str(workers)]
+    if not table:
+        return DEFAULT_THROUGHPUT
+    nearest = min(table, key=lambda key: abs(int(key) - workers))
+    # 并行数越多，单个任务分到的CPU越少 / More parallel jobs means less CPU per job
+    return table[nearest] * int(nearest) / workers if int(nearest) < workers else table[nearest]
+
+
+def record_throughput(workers, work, elapsed):
+    """用一次实际运行更新吞吐量的滑动平均
+    Update the throughput moving average with one measured run"""
+    if elapsed <= 0 or work <= 0:
+        return
+    measured = work / elapsed
+    with _stats_lock:
+        stats = load_stats()
+        key = str(workers)
+        previous = stats["throughput"].get(key)
+        stats["throughput"][key] = measured if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * measured
+        save_stats(stats)
+
+
+def estimate_work(info):
+    """估算一个片段的工作量：解码输入像素加编码输出像素
+    Estimate the work of one clip: decoded input pixels plus encoded output pixels"""
+    duration = info.get("duration") or 0.0
+    input_rate = (info.get("width") or 1080) * (info.get("height") or 1920) * (info.get("fps") or 30.0)
+    return duration * (input_rate + OUTPUT_PIXEL_RATE)
+
+
+def plan_jobs(source_paths, workers):
+    """探测片段并按预测用时从长到短排序
+    Probe clips and sort them by predicted encode time, longest first
+
+    Returns:
+        任务列表，每项为 {"path", "work", "predicted"} / Job list of {"path", "work", "predicted"}
+    """
+    stats = load_stats()
+    throughput = get_throughput(workers, stats)
+    jobs = []
+    for path in source_paths:
+        info = probe_video(path) or {}
+        work = estimate_work(info)
+        jobs.append({"path": path, "work": work, "predicted": work / throughput})
+    jobs.sort(key=lambda job: job["predicted"], reverse=True)
+    return jobs
+
+
+def estimate_makespan(jobs, workers):
+    """模拟按顺序把任务派发给空闲的工作线程，返回预计总用时（秒）
+    Simulate dispatching jobs in order to free workers and return the predicted makespan (seconds)"""
+    finish_times = [0.0] * max(1, workers)
+    for job in jobs:
+        earliest = heapq.heappop(finish_times)
+        heapq.heappush(finish_times, earliest + job["predicted"])
+    return max(finish_times)
+
+
+def run_jobs(jobs, job_fn, workers, desc="正在标准化视频", executor=None, tenant=None):
+    """按给定顺序派发任务并行执行，并记录实测吞吐量
+    Dispatch jobs in the given order, run them in parallel and record measured throughput
+
+    Args:
+        jobs: plan_jobs返回的任务列表 / Job list from plan_jobs
+        job_fn: 执行单个任务的函数，参数为任务dict，返回是否成功 / Function running one job dict, returns success
+        workers: 并行任务数 / Number of parallel jobs
+        executor: 可选，共享的FairShareExecutor，此时workers取它的线程数 / Optional shared FairShareExecutor; workers is then its thread count
+        tenant: 使用共享executor时任务所属的租户名 / Tenant name of the jobs when using a shared executor
+
+    Returns:
+        dict: 源路径到job_fn返回值的映射 / Mapping of source path to job_fn result
+    """
+    if executor is not None:
+        workers = executor.workers
+
+    def timed(job):
+        started = time.time()
+        ok = job_fn(job)
+        if ok:
+            record_throughput(workers, job["work"], time.time() - started)
+        return ok
+
+    def collect(futures):
+        results = {}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                logger.error(f"❌ 任务出错: {futures[future]}: {e}")
+                results[futures[future]] = False
+        return results
+
+    if executor is not None:
+        # 共享线程池：租户内按提交顺序，租户之间按权重公平 / Shared pool: submission order within a tenant, fair by weight across tenants
+        return collect({executor.submit(tenant, timed, job, cost=job["predicted"]): job["path"] for job in jobs})
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # 线程池按提交顺序派发，所以提交顺序就是调度顺序 / The pool dispatches in submission order
+        return collect({pool.submit(timed, job): job["path"] for job in jobs})
+
+
+class FairShareExecutor:
+    """多个租户共享的编码线程池，按加权公平排队调度
+    Encode worker pool shared by several tenants, scheduled by weighted fair queueing
+
+    每个租户有自己的FIFO队列和一个虚拟时间：派发一个任务后虚拟时间增加 预测用时/权重，
+    空闲线程总是取虚拟时间最小的租户的下一个任务。这样机器一直是满载的，但权重相同的租户分到的
+    编码时间大致相同，任务多的租户不会把别人饿死；刚开始排队的租户不会因为之前空闲而攒下额度。
+    Each tenant has its own FIFO queue and a virtual time that grows by predicted cost / weight per
+    dispatched job; a free worker always takes the next job of the tenant with the smallest virtual
+    time. The machine stays busy, tenants with equal weights get roughly equal encode time, and a
+    tenant with a long backlog cannot starve the others. A tenant that was idle does not bank credit.
+    """
+
+    def __init__(self, workers, weights=None):
+        self.workers = max(1, workers)
+        self.weights = dict(weights or {})
+        self._queues = {}
+        self._vtime = {}
+        self._running = {}
+        self._shutdown = False
+        self._cond = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"fair-share-{i}", daemon=True) for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def set_weight(self, tenant, weight):
+        """设置租户的权重（默认1）/ Set a tenant's weight (default 1)"""
+        with self._cond:
+            self.weights[tenant] = max(float(weight), 0.01)
+
+    def submit(self, tenant, fn, *args, cost=1.0, **kwargs):
+        """提交一个任务，返回concurrent.futures.Future
+        Submit a job and return a concurrent.futures.Future
+
+        Args:
+            cost: 任务的预测用时，用于公平分配 / Predicted duration of the job, used for fair sharing
+        """
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("FairShareExecutor已关闭")
+            queue = self._queues.setdefault(tenant, deque())
+            if not queue and not self._running.get(tenant):
+                # 从空闲变为活跃：追上当前活跃租户的最小虚拟时间 / Idle -> active: catch up to the active tenants' minimum
+                active = [self._vtime[t] for t, q in self._queues.items() if t != tenant and (q or self._running.get(t))]
+                self._vtime[tenant] = max(self._vtime.get(tenant, 0.0), min(active, default=0.0))
+            queue.append((future, fn, args, kwargs, max(float(cost), 0.001)))
+            self._cond.notify()
+        return future
+
+    def _next(self):
+        """取虚拟时间最小的租户的下一个任务（调用时持有锁）
+        Take the next job of the tenant with the smallest virtual time (called with the lock held)"""
+        tenant = min((t for t, q in self._queues.items() if q), key=lambda t: self._vtime.get(t, 0.0))
+        item = self._queues[tenant].popleft()
+        self._vtime[tenant] = self._vtime.get(tenant, 0.0) + item[4] / self.weights.get(tenant, 1.0)
+        self._running[tenant] = self._running.get(tenant, 0) + 1
+        return tenant, item
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and not any(self._queues.values()):
+                    self._cond.wait()
+                if self._shutdown and not any(self._queues.values()):
+                    return
+                tenant, (future, fn, args, kwargs, _) = self._next()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running[tenant] -= 1
+
+    def stats(self):
+        """每个租户排队和正在运行的任务数 / Queued and running jobs per tenant"""
+        with self._cond:
+            return {
+                tenant: {"queued": len(queue), "running": self._running.get(tenant, 0)}
+                for tenant, queue in self._queues.items()
+            }
+
+    def shutdown(self, wait=True):
+        """不再接受新任务，已排队的任务执行完后线程退出
+        Stop accepting jobs; threads exit once the queued jobs are done"""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+FFmpeg/FFprobe进程监管
+Supervisor for FFmpeg / FFprobe processes
+
+所有ffmpeg和ffprobe子进程都通过run_process启动：支持墙钟超时和CPU时间超时、nice/ionice优先级、
+CPU绑定、可选的cgroup内存上限、遇到临时性错误时自动重试，并把每个任务的资源占用写入日志。
+Every ffmpeg and ffprobe child process is started through run_process: wall-clock and CPU-time
+timeouts, nice/ionice priorities, CPU pinning, an optional cgroup memory cap, automatic retry on
+transient failures, and a per-job resource usage record.
+
+环境变量 / Environment variables:
+    FFMPEG_TIMEOUT       单个任务墙钟超时（秒）/ Per-job wall-clock timeout (seconds)
+    FFMPEG_CPU_TIMEOUT   单个任务CPU时间上限（秒）/ Per-job CPU time limit (seconds)
+    FFMPEG_NICE          nice值 / nice level
+    FFMPEG_IONICE        ionice的"类别:级别"，如"2:7" / ionice "class:level", e.g. "2:7"
+    FFMPEG_CPUS          CPU绑定，如"0-3,6" / CPU pinning, e.g. "0-3,6"
+    FFMPEG_MEMORY_MAX    内存上限，如"4G" / Memory cap, e.g. "4G"
+    FFMPEG_RETRIES       临时性错误的重试次数 / Retries on transient failures
+"""
+
+import os
+import json
+import time
+import shutil
+import signal
+import threading
+import subprocess
+
+from log_setup import get_logger, LOG_DIR, LOG_MAX_BYTES, LOG_BACKUP_COUNT
+
+logger = get_logger("ffmpeg")
+
+JOB_LOG = os.path.join(LOG_DIR, "ffmpeg_jobs.jsonl")  # 任务资源占用记录，按大小轮转 / Per-job resource usage records, rotated by size
+
+
+def _parse_cpus(value):
+    """解析"0-3,6"格式的CPU列表
+    Parse a CPU list like "0-3,6\""""
+    cpus = set()
+    for part in (value or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus or None
+
+
+def _parse_size(value):
+    """解析"4G"、"512M"格式的字节数
+    Parse a byte size like "4G" or "512M\""""
+    if not value:
+        return None
+    value = str(value).strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+DEFAULT_TIMEOUT = float(os.environ.get("FFMPEG_TIMEOUT", 3 * 3600))
+DEFAULT_CPU_TIMEOUT = float(os.environ["FFMPEG_CPU_TIMEOUT"]) if os.environ.get("FFMPEG_CPU_TIMEOUT") else None
+DEFAULT_NICE = int(os.environ.get("FFMPEG_NICE", 10))
+DEFAULT_IONICE = os.environ.get("FFMPEG_IONICE", "2:7")
+DEFAULT_CPUS = _parse_cpus(os.environ.get("FFMPEG_CPUS"))
+DEFAULT_MEMORY_MAX = _parse_size(os.environ.get("FFMPEG_MEMORY_MAX"))
+DEFAULT_RETRIES = int(os.environ.get("FFMPEG_RETRIES", 1))
+PROBE_TIMEOUT = 120  # ffprobe只读取文件头，不应该很久 / ffprobe only reads headers and should be quick
+RETRY_DELAY = 2.0  # 第一次重试前的等待（秒），之后翻倍 / Delay before the first retry (seconds), doubled afterwards
+
+# 这些错误通常是暂时的，重试可能成功 / These errors are usually temporary and a retry may succeed
+TRANSIENT_ERRORS = (
+    "Resource temporarily unavailable",
+    "Cannot allocate memory",
+    "Device or resource busy",
+    "Input/output error",
+    "Connection reset",
+    "Connection timed out",
+)
+# 内存不足：设置了内存上限时是撞到上限，用同样的上限重试没有意义 / Out of memory: with a memory cap set it hit the cap, so retrying at the same cap is pointless
+MEMORY_ERRORS = ("Cannot allocate memory", "Out of memory")
+
+_log_lock = threading.Lock()
+_usage_listeners = []  # 每条资源记录都会传给这些函数（如profiling）/ Every usage record is passed to these (e.g. profiling)
+
+
+def _uses_cgroup(memory_max):
+    return bool(memory_max) and os.environ.get("FFMPEG_USE_CGROUP") == "1" and bool(shutil.which("systemd-run"))
+
+
+def _build_command(command, memory_max):
+    """需要cgroup内存上限时在命令前加上systemd-run；包装前先确认程序存在，缺少程序时和subprocess.run一样抛出异常
+    Prefix the command with systemd-run for a cgroup memory cap; the program is checked first so a missing
+    binary raises like subprocess.run instead of failing inside the wrapper"""
+    if not _uses_cgroup(memory_max):
+        return list(command)
+    program = str(command[0])
+    if not shutil.which(program) and not os.path.exists(program):
+        raise FileNotFoundError(2, "No such file or directory", program)
+    return ["systemd-run", "--user", "--scope", "--quiet", "-p", f"MemoryMax={memory_max}"] + list(command)
+
+
+def _apply_limits(pid, nice, ionice, cpus, cpu_timeout, memory_max):
+    """启动后在父进程里给子进程设置优先级、IO优先级、CPU绑定和资源上限（仅POSIX）
+    Apply priority, IO priority, CPU pinning and resource limits to the child from the parent after spawn (POSIX only)
+
+    不用preexec_fn：有线程时它可能让子进程在exec前死锁，而run_process经常在线程池里调用。
+    子进程在设置生效前会先运行几毫秒。
+    preexec_fn is not used: with threads around it can deadlock the child before exec, and run_process
+    is often called from thread pools. The child runs for a few milliseconds before the settings apply.
+    """
+    import resource
+
+    try:
+        if nice:
+            os.setpriority(os.PRIO_PROCESS, pid, min(19, os.getpriority(os.PRIO_PROCESS, 0) + nice))
+        if cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(pid, cpus)
+        if cpu_timeout:
+            limit = int(cpu_timeout) + 1
+            resource.prlimit(pid, resource.RLIMIT_CPU, (limit, limit + 5))
+        if memory_max and not _uses_cgroup(memory_max):
+            resource.prlimit(pid, resource.RLIMIT_AS, (memory_max, memory_max))
+    except (ProcessLookupError, PermissionError):
+        return  # 进程已经退出 / The process already exited
+    if ionice and shutil.which("ionice"):
+        io_class, _, io_level = ionice.partition(":")
+        subprocess.run(["ionice", "-c", io_class] + (["-n", io_level] if io_level else []) + ["-p", str(pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _read_stream(stream, chunks):
+    for chunk in iter(lambda: stream.read(65536), ""):
+        chunks.append(chunk)
+    stream.close()
+
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _run_once_posix(command, timeout, limits):
+    """在POSIX上运行一次，用wait4获取子进程的资源占用
+    Run once on POSIX, collecting the child's resource usage with wait4"""
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True, encoding="utf-8", errors="replace",
+        start_new_session=True,
+    )
+    started = time.time()
+    timed_out = False
+    pid = 0
+    try:
+        _apply_limits(process.pid, **limits)
+        stdout_chunks, stderr_chunks = [], []
+        readers = [
+            threading.Thread(target=_read_stream, args=(process.stdout, stdout_chunks), daemon=True),
+            threading.Thread(target=_read_stream, args=(process.stderr, stderr_chunks), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if timeout and time.time() - started > timeout and not timed_out:
+                # 杀掉整个进程组 / Kill the whole process group
+                timed_out = True
+                _kill_group(process.pid)
+            time.sleep(0.05)
+    finally:
+        if not pid:
+            # 子进程在自己的会话里，收不到终端的Ctrl+C：中断或异常时杀掉进程组并回收，不留下孤儿编码器
+            # The child has its own session and never sees the terminal's Ctrl+C: on an interrupt or error,
+            # kill its process group and reap it so no orphaned encoder keeps writing the output
+            _kill_group(process.pid)
+            try:
+                os.waitpid(process.pid, 0)
+            except ChildProcessError:
+                pass
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    for reader in readers:
+        reader.join()
+
+    usage = {
+        "wall": round(time.time() - started, 3),
+        "user_cpu": round(rusage.ru_utime, 3),
+        "sys_cpu": round(rusage.ru_stime, 3),
+        "max_rss_kb": rusage.ru_maxrss,
+    }
+    return process.returncode, "".join(stdout_chunks), "".join(stderr_chunks), timed_out, usage
+
+
+def _run_once_windows(command, timeout, nice):
+    """在Windows上运行一次，只能记录墙钟时间
+    Run once on Windows, only wall-clock time can be recorded"""
+    creationflags = 0
+    if nice and nice > 0:
+        creationflags = subprocess.BELOW_NORMAL_PRIORITY_CLASS if nice < 15 else subprocess.IDLE_PRIORITY_CLASS
+    started = time.time()
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True, encoding="utf-8", errors="replace", creationflags=creationflags,
+    )
+    timed_out = False
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        process.kill()
+        stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr, timed_out, {"wall": round(time.time() - started, 3)}
+
+
+def add_usage_listener(listener):
+    """注册一个函数，之后每条资源记录都会传给它
+    Register a function that receives every later usage record"""
+    with _log_lock:
+        _usage_listeners.append(listener)
+
+
+def remove_usage_listener(listener):
+    """取消注册 / Unregister a listener"""
+    with _log_lock:
+        if listener in _usage_listeners:
+            _usage_listeners.remove(listener)
+
+
+def _rotate_job_log():
+    """JOB_LOG超过LOG_MAX_BYTES时轮转成.1、.2……，和log_setup一样最多保留LOG_BACKUP_COUNT个
+    Rotate JOB_LOG to .1, .2, ... once it exceeds LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT files like log_setup"""
+    if not os.path.exists(JOB_LOG) or os.path.getsize(JOB_LOG) < LOG_MAX_BYTES:
+        return
+    for idx in range(LOG_BACKUP_COUNT - 1, 0, -1):
+        if os.path.exists(f"{JOB_LOG}.{idx}"):
+            os.replace(f"{JOB_LOG}.{idx}", f"{JOB_LOG}.{idx + 1}")
+    os.replace(JOB_LOG, f"{JOB_LOG}.1")
+
+
+def record_usage(record):
+    """追加一条任务资源占用记录
+    Append one job resource usage record"""
+    os.makedirs(os.path.dirname(JOB_LOG), exist_ok=True)
+    with _log_lock:
+        _rotate_job_log()
+        with open(JOB_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        listeners = list(_usage_listeners)
+    for listener in listeners:
+        listener(record)
+
+
+def is_transient_failure(returncode, stderr, memory_max=None):
+    """判断失败是否可能是暂时的；有内存上限时内存不足视为永久失败（rlimit或cgroup OOM）
+    Check whether a failure is likely to be temporary; with a memory cap, running out of memory is permanent (rlimit or cgroup OOM)"""
+    if returncode == 0:
+        return False
+    stderr = stderr or ""
+    if memory_max and (returncode == -signal.SIGKILL or any(pattern in stderr for pattern in MEMORY_ERRORS)):
+        return False
+    return any(pattern in stderr for pattern in TRANSIENT_ERRORS)
+
+
+def run_process(command, timeout=DEFAULT_TIMEOUT, cpu_timeout=DEFAULT_CPU_TIMEOUT, nice=DEFAULT_NICE,
+                ionice=DEFAULT_IONICE, cpus=DEFAULT_CPUS, memory_max=DEFAULT_MEMORY_MAX,
+                retries=DEFAULT_RETRIES, job_name=None):
+    """在监管下运行一个ffmpeg/ffprobe命令，返回值与subprocess.run(capture_output=True, text=True)相同
+    Run an ffmpeg/ffprobe command under supervision; returns the same as subprocess.run(capture_output=True, text=True)
+
+    Args:
+        command: 命令参数列表 / Command argument list
+        timeout: 墙钟超时（秒），None表示不限制 / Wall-clock timeout in seconds, None for unlimited
+        cpu_timeout: CPU时间上限（秒）/ CPU time limit in seconds
+        nice: nice值 / nice level
+        ionice: ionice的"类别:级别" / ionice "class:level"
+        cpus: 绑定的CPU编号集合 / Set of CPU ids to pin to
+        memory_max: 内存上限（字节）/ Memory cap in bytes
+        retries: 临时性错误的重试次数 / Retries on transient failures
+        job_name: 写入资源记录的任务名 / Job name for the usage record
+
+    Returns:
+        subprocess.CompletedProcess，超时时returncode为负数 / subprocess.CompletedProcess, negative returncode on timeout
+    """
+    full_command = list(command)
+    limits = {"nice": nice, "ionice": ionice, "cpus": cpus, "cpu_timeout": cpu_timeout, "memory_max": memory_max}
+
+    delay = RETRY_DELAY
+    for attempt in range(1, retries + 2):
+        try:
+            if os.name == "posix":
+                full_command = _build_command(command, memory_max)
+                returncode, stdout, stderr, timed_out, usage = _run_once_posix(full_command, timeout, limits)
+            else:
+                returncode, stdout, stderr, timed_out, usage = _run_once_windows(full_command, timeout, nice)
+        except OSError as e:
+            # 程序不存在等启动错误，与subprocess.run的行为保持一致 / Launch errors like a missing binary, same as subprocess.run
+            record_usage({"job": job_name, "program": os.path.basename(str(command[0])), "error": str(e), "attempt": attempt})
+            raise
+
+        if timed_out:
+            stderr += f"\n[supervisor] 超时 {timeout} 秒，进程已被终止 / timed out after {timeout}s, process killed"
+
+        record_usage({
+            "job": job_name,
+            "program": os.path.basename(str(command[0])),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "returncode": returncode,
+            "timed_out": timed_out,
+            "attempt": attempt,
+            **usage,
+        })
+
+        if attempt <= retries and not timed_out and is_transient_failure(returncode, stderr, memory_max):
+            logger.warning(f"⚠️ FFmpeg临时性错误，{delay:.0f} 秒后重试 ({attempt}/{retries})")
+            time.sleep(delay)
+            delay *= 2
+            continue
+        return subprocess.CompletedProcess(command, returncode, stdout, stderr)
@@ -5,11 +5,15 @@ Fix Stream specifier errors in video concatenation
 """
 
 import os
-import subprocess
 import glob
 import json
 from datetime import datetime
 
+from ffmpeg_supervisor import run_process, PROBE_TIMEOUT
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
 # 配置
 FFMPEG_PATH = os.environ.get("FFMPEG_PATH", os.path.join("tools", "ffmpeg", "bin", "ffmpeg.exe"))
 FFPROBE_PATH = os.environ.get("FFPROBE_PATH", os.path.join("tools", "ffmpeg", "bin", "ffprobe.exe"))
@@ -32,12 +36,12 @@ def get_stream_info(video_path):
     ]
     
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_process(cmd, timeout=PROBE_TIMEOUT)
         if result.returncode == 0 and result.stdout:
             info = json.loads(result.stdout)
             return info
     except Exception as e:
-        print(f"获取视频信息出错: {e}")
+        logger.error(f"获取视频信息出错: {e}")
     
     return None
 
@@ -61,51 +65,58 @@ def merge_with_concat_demuxer(videos, output_path):
         output_path
     ]
     
-    print(f"执行命令: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    logger.info(f"执行命令: {' '.join(cmd)}")
+    result = run_process(cmd)
     
     if result.returncode == 0:
-        print(f"合并成功: {output_path}")
+        logger.info(f"合并成功: {output_path}")
         return True
     else:
-        print(f"合并失败: {result.stderr}")
+        logger.error(f"合并失败: {result.stderr}")
         return False
 
 def fix_concat_error(last_n=None):
     """修复合并错误"""
-    print("=== 视频合并修复工具 ===")
+    logger.info("=== 视频合并修复工具 ===")
     
     # 确保目录存在
     ensure_dirs()
     
-    # 查找需要合并的视频
-    videos = glob.glob(os.path.join(TEMP_DIR, "temp_*.mp4"))
+    # 查找需要合并的视频：最新的未完成合并任务里的标准化片段，其次是旧版本的temp_*.mp4
+    # Clips to merge: the newest unfinished merge job's standardized clips, then older versions' temp_*.mp4
+    from merge_jobs import recovery_clips
+    job, videos = recovery_clips()
+    if job:
+        logger.info(f"使用合并任务 {job.id[:12]} 的标准化片段")
+    else:
+        videos = glob.glob(os.path.join(TEMP_DIR, "temp_*.mp4"))
     if not videos:
-        print("未找到临时视频文件，尝试查找下载目录")
+        logger.info("未找到临时视频文件，尝试查找下载目录")
         download_dir = "test_downloads"
         if os.path.exists(download_dir):
             videos = glob.glob(os.path.join(download_dir, "*.mp4"))
     
     if not videos:
-        print("未找到视频文件")
+        logger.info("未找到视频文件")
         return False
     
-    # 按修改时间排序
-    videos.sort(key=os.path.getmtime)
+    # 任务的片段已经按合并顺序排列，其他按修改时间排序 / Job clips are already in merge order; others go by mtime
+    if not job:
+        videos.sort(key=os.path.getmtime)
     
     # 处理last_n参数
     if last_n and isinstance(last_n, int) and last_n > 0:
         if last_n < len(videos):
             videos = videos[-last_n:]
-            print(f"只处理最新的{last_n}个视频")
+            logger.info(f"只处理最新的{last_n}个视频")
         else:
-            print(f"处理所有{len(videos)}个视频")
+            logger.info(f"处理所有{len(videos)}个视频")
     
     # 生成输出文件名
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     output_path = os.path.join(MERGED_DIR, f"{timestamp}.mp4")
     
-    print(f"开始合并{len(videos)}个视频")
+    logger.info(f"开始合并{len(videos)}个视频")
     
     # 使用concat demuxer合并
     return merge_with_concat_demuxer(videos, output_path)
@@ -114,9 +125,13 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="修复视频合并错误")
     parser.add_argument("--last", "-l", type=int, help="只处理最后N个视频")
+    import profiling
+    profiling.add_argument(parser)
     args = parser.parse_args()
     
-    if fix_concat_error(args.last):
-        print("视频合并修复成功！")
+    with profiling.stage("fix_concat", args.profile):
+        success = fix_concat_error(args.last)
+    if success:
+        logger.info("视频合并修复成功！")
     else:
-        print("视频合并失败，请手动检查文件。")
+        logger.error("视频合并失败，请手动检查文件。")
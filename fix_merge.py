@@ -9,9 +9,11 @@ When merging many videos, FFmpeg's filter_complex might fail, especially when pr
 
 import os
 import glob
-import subprocess
 import json
-from tqdm import tqdm
+from ffmpeg_supervisor import run_process, PROBE_TIMEOUT
+from log_setup import get_logger
+
+logger = get_logger("merge")
 
 # 配置 / Configuration
 FFMPEG_PATH = os.environ.get("FFMPEG_PATH", os.path.join("tools", "ffmpeg", "bin", "ffmpeg.exe"))
@@ -31,8 +33,8 @@ def get_stream_info(video_path):
     try:
         # 确保ffprobe路径存在
         if not os.path.exists(FFPROBE_PATH):
-            print(f"警告: FFprobe路径不存在: {FFPROBE_PATH}")
-            print("尝试使用系统路径...")
+            logger.warning(f"警告: FFprobe路径不存在: {FFPROBE_PATH}")
+            logger.info("尝试使用系统路径...")
             ffprobe_cmd = "ffprobe"  # 使用系统路径
         else:
             ffprobe_cmd = FFPROBE_PATH
@@ -46,23 +48,23 @@ def get_stream_info(video_path):
         ]
         
         if not os.path.exists(video_path):
-            print(f"错误: 视频文件不存在: {video_path}")
+            logger.error(f"错误: 视频文件不存在: {video_path}")
             return None
             
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_process(cmd, timeout=PROBE_TIMEOUT)
         if result.returncode != 0:
-            print(f"FFprobe命令失败 (代码 {result.returncode}): {result.stderr}")
+            logger.error(f"FFprobe命令失败 (代码 {result.returncode}): {result.stderr}")
             return None
             
         if not result.stdout:
-            print("FFprobe未返回任何输出")
+            logger.info("FFprobe未返回任何输出")
             return None
             
         try:
             info = json.loads(result.stdout)
         except json.JSONDecodeError as e:
-            print(f"JSON解析错误: {e}")
-            print(f"FFprobe输出: {result.stdout[:100]}...")  # 只显示前100个字符
+            logger.error(f"JSON解析错误: {e}")
+            logger.info(f"FFprobe输出: {result.stdout[:100]}...")  # 只显示前100个字符
             return None
         
         # 查找视频和音频流索引
@@ -71,7 +73,7 @@ def get_stream_info(video_path):
         
         streams = info.get("streams", [])
         if not streams:
-            print("警告: 未在视频中找到流")
+            logger.warning("警告: 未在视频中找到流")
         
         for stream in streams:
             if stream.get("codec_type") == "video" and video_index is None:
@@ -86,9 +88,9 @@ def get_stream_info(video_path):
             "has_audio": audio_index is not None
         }
     except Exception as e:
-        print(f"分析视频流时出错: {str(e)}")
+        logger.error(f"分析视频流时出错: {str(e)}")
         import traceback
-        traceback.print_exc()  # 打印详细错误堆栈
+        logger.error(traceback.format_exc())  # 打印详细错误堆栈
         
     # 如果无法获取信息，返回默认值
     return {
@@ -104,13 +106,13 @@ def merge_videos_with_concat_demuxer(video_paths, output_path):
     try:
         # 检查ffmpeg是否存在
         if not os.path.exists(FFMPEG_PATH):
-            print(f"错误: FFmpeg路径不存在: {FFMPEG_PATH}")
+            logger.error(f"错误: FFmpeg路径不存在: {FFMPEG_PATH}")
             return False
             
         # 检查所有视频文件是否存在
         for video in video_paths:
             if not os.path.exists(video):
-                print(f"错误: 视频文件不存在: {video}")
+                logger.error(f"错误: 视频文件不存在: {video}")
                 return False
                 
         # 创建一个临时的文件列表
@@ -131,24 +133,24 @@ def merge_videos_with_concat_demuxer(video_paths, output_path):
             output_path
         ]
         
-        print(f"执行FFmpeg命令: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        logger.info(f"执行FFmpeg命令: {' '.join(cmd)}")
+        result = run_process(cmd)
         
         if result.returncode != 0:
-            print(f"FFmpeg命令失败 (代码 {result.returncode}):")
-            print(f"错误输出: {result.stderr}")
+            logger.error(f"FFmpeg命令失败 (代码 {result.returncode}):")
+            logger.error(f"错误输出: {result.stderr}")
             return False
             
         # 验证输出文件是否创建成功
         if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-            print(f"错误: 输出文件未创建或为空: {output_path}")
+            logger.error(f"错误: 输出文件未创建或为空: {output_path}")
             return False
             
         return True
     except Exception as e:
-        print(f"合并视频时出错: {str(e)}")
+        logger.error(f"合并视频时出错: {str(e)}")
         import traceback
-        traceback.print_exc()
+        logger.error(traceback.format_exc())
         return False
 
 def merge_videos_in_batches(video_paths, output_path, batch_size=10):
@@ -164,28 +166,28 @@ def merge_videos_in_batches(video_paths, output_path, batch_size=10):
         batch = video_paths[i:i+batch_size]
         batch_output = os.path.join(TEMP_DIR, f"batch_{i//batch_size}.mp4")
         
-        print(f"处理批次 {i//batch_size + 1}/{(len(video_paths) + batch_size - 1)//batch_size}，包含 {len(batch)} 个视频")
+        logger.info(f"处理批次 {i//batch_size + 1}/{(len(video_paths) + batch_size - 1)//batch_size}，包含 {len(batch)} 个视频")
         # Processing batch X/Y, containing Z videos
         
         if merge_videos_with_concat_demuxer(batch, batch_output):
             batch_outputs.append(batch_output)
         else:
-            print(f"批次 {i//batch_size + 1} 处理失败")  # Batch X processing failed
+            logger.error(f"批次 {i//batch_size + 1} 处理失败")  # Batch X processing failed
             return False
     
     # 合并所有批次 / Merge all batches
     if len(batch_outputs) == 1:
         # 只有一个批次，直接重命名 / Only one batch, just rename
-        import shutil
-        shutil.move(batch_outputs[0], output_path)
+        from content_store import move_file
+        move_file(batch_outputs[0], output_path)
         return True
     else:
-        print(f"合并 {len(batch_outputs)} 个批次...")  # Merging X batches
+        logger.info(f"合并 {len(batch_outputs)} 个批次...")  # Merging X batches
         return merge_videos_with_concat_demuxer(batch_outputs, output_path)
 
 def fix_merge_problem(last_n=None, output_name=None):
-    """修复当前temp目录中的视频合并问题
-    Fix merge problem with videos in current temp directory
+    """用最新的未完成合并任务（或temp目录）中的标准化片段重新合并
+    Re-merge the standardized clips of the newest unfinished merge job (or the temp directory)
     
     Args:
         last_n: 只处理最后N个视频 / Only process last N videos
@@ -194,24 +196,28 @@ def fix_merge_problem(last_n=None, output_name=None):
     # 确保目录存在
     ensure_dirs()
     
-    # 查找所有临时视频文件
-    temp_videos = glob.glob(os.path.join(TEMP_DIR, "temp_*.mp4"))
+    # 优先使用最新的未完成合并任务（temp/job_<id>）里已经标准化的片段，按任务的合并顺序
+    # Prefer the standardized clips of the newest unfinished merge job (temp/job_<id>), in the job's merge order
+    from merge_jobs import recovery_clips
+    job, temp_videos = recovery_clips()
+    if job:
+        logger.info(f"使用合并任务 {job.id[:12]} 的标准化片段（{len(temp_videos)}/{len(job.data['clips'])} 个已完成）")
+    else:
+        # 旧版本留下的temp_*.mp4，按文件名排序 / temp_*.mp4 left by older versions, sorted by name
+        temp_videos = sorted(glob.glob(os.path.join(TEMP_DIR, "temp_*.mp4")))
     if not temp_videos:
-        print("没有找到临时视频文件")
+        logger.info("没有找到临时视频文件")
         return False
     
-    # 按文件名排序，确保顺序正确
-    temp_videos.sort()
-    
     # 处理last_n参数
     if last_n and isinstance(last_n, int) and last_n > 0:
         if last_n < len(temp_videos):
-            print(f"根据参数只处理最新的{last_n}个视频（共有{len(temp_videos)}个）")
+            logger.info(f"根据参数只处理最新的{last_n}个视频（共有{len(temp_videos)}个）")
             temp_videos = temp_videos[-last_n:]  # 取最后N个
         else:
-            print(f"要求处理最后{last_n}个视频，但只有{len(temp_videos)}个视频可用，将处理所有视频")
+            logger.info(f"要求处理最后{last_n}个视频，但只有{len(temp_videos)}个视频可用，将处理所有视频")
     
-    print(f"找到 {len(temp_videos)} 个视频文件")
+    logger.info(f"找到 {len(temp_videos)} 个视频文件")
     
     # 生成输出文件名
     import datetime
@@ -222,24 +228,38 @@ def fix_merge_problem(last_n=None, output_name=None):
         filename = f"{timestamp}.mp4"
     output_path = os.path.join(MERGED_DIR, filename)
     
+    # 相同的临时文件已经合并过时直接复用 / Reuse the output if the same temp files were merged before
+    from merge_cache import compute_manifest_hash, find_cached_output, record_output, reuse_output, prepare_output_path
+    manifest_hash = compute_manifest_hash(temp_videos, "fix_merge_batches")
+    cached_output = find_cached_output(manifest_hash)
+    if cached_output:
+        output_path = reuse_output(cached_output, output_path)
+        logger.info(f"相同的视频已经合并过，直接复用: {output_path}")
+        return True
+    prepare_output_path(output_path)
+    
     # 执行分批合并
     result = merge_videos_in_batches(temp_videos, output_path)
     
     if result:
-        print(f"合并成功！输出文件: {output_path}")
+        record_output(manifest_hash, output_path)
+        logger.info(f"合并成功！输出文件: {output_path}")
         return True
     else:
-        print("合并失败")
+        logger.error("合并失败")
         return False
 
 # 添加命令行支持
 if __name__ == "__main__":
-    print("=== 视频合并修复工具 ===")
+    logger.info("=== 视频合并修复工具 ===")
     
     import argparse
     parser = argparse.ArgumentParser(description="修复视频合并问题 / Fix video merging issues")
     parser.add_argument("--last", "-l", type=int, help="只合并最后N个视频 / Only merge last N videos")
     parser.add_argument("--output", "-o", help="指定输出文件名 / Specify output filename")
+    import profiling
+    profiling.add_argument(parser)
     args = parser.parse_args()
     
-    fix_merge_problem(args.last, args.output)
+    with profiling.stage("fix_merge", args.profile):
+        fix_merge_problem(args.last, args.output)
@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+"""
+不经过浏览器的B站分块上传（可断点续传）
+Browser-free chunked, resumable Bilibili uploader
+
+文件被切成固定大小的块并行上传，每块单独重试；已完成的块记录在续传日志里，中断后只上传剩余的块。
+登录状态来自PROFILE_PATH浏览器配置：第一次使用时用Selenium打开一次B站导出Cookie，之后直接复用。
+The file is split into fixed-size chunks uploaded in parallel, each retried on its own; finished chunks
+are recorded in a resume journal so an interrupted upload only sends the remaining chunks.
+The login comes from the PROFILE_PATH browser profile: on first use Selenium opens Bilibili once to
+export the cookies, which are reused afterwards.
+导出超过COOKIE_MAX_AGE_DAYS天的Cookie会重新导出。所有请求走同一个requests.Session，分块上传复用keep-alive连接。
+Cookies exported more than COOKIE_MAX_AGE_DAYS ago are exported again. Every request goes through one
+requests.Session, so chunk uploads reuse keep-alive connections.
+
+协议（与B站upos相同的流程）/ Protocol (same flow as Bilibili's upos):
+    GET  {preupload}?name=&size=&r=upos&profile=ugcupos/bup  -> endpoint, upos_uri, auth, biz_id, chunk_size
+    POST {endpoint}/{path}?uploads&output=json                 -> upload_id
+    PUT  {endpoint}/{path}?partNumber=&uploadId=&chunk=&chunks=&size=&start=&end=&total=
+    POST {endpoint}/{path}?output=json&name=&profile=&uploadId=&biz_id=   body: {"parts": [...]}
+    POST {submit}?csrf=                                        稿件信息 / video metadata
+
+本地测试：python http_upload.py --standin 启动实现同样协议的本地服务器，
+再用 BILI_PREUPLOAD_URL=http://127.0.0.1:8765/preupload 等环境变量指向它。
+Local testing: python http_upload.py --standin starts a local server implementing the same protocol;
+point BILI_PREUPLOAD_URL=http://127.0.0.1:8765/preupload (and the other URLs) at it.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from log_setup import get_logger
+
+logger = get_logger("upload")
+
+PREUPLOAD_URL = os.environ.get("BILI_PREUPLOAD_URL", "https://member.bilibili.com/preupload")
+SUBMIT_URL = os.environ.get("BILI_SUBMIT_URL", "https://member.bilibili.com/x/vu/web/add")
+COOKIE_FILE = "bilibili_cookies.json"  # 从浏览器导出的Cookie / Cookies exported from the browser
+COOKIE_MAX_AGE_DAYS = float(os.environ.get("BILI_COOKIE_MAX_AGE_DAYS", 7))  # Cookie导出后多少天重新导出 / Re-export cookies after this many days
+JOURNAL_DIR = "upload_journal"  # 续传日志目录 / Resume journal directory
+
+DEFAULT_CHUNK_SIZE = 10 * 1024 * 1024  # 服务器没有指定时的块大小 / Chunk size if the server does not specify one
+UPLOAD_THREADS = int(os.environ.get("BILI_UPLOAD_THREADS", 4))  # 并行上传的块数 / Chunks uploaded in parallel
+CHUNK_RETRIES = 5  # 每块最多重试次数 / Max retries per chunk
+RETRY_DELAY = 2.0  # 第一次重试前的等待（秒），之后翻倍 / Delay before the first retry (seconds), doubled afterwards
+REQUEST_TIMEOUT = 120  # 单个HTTP请求超时（秒）/ Timeout for one HTTP request (seconds)
+DEFAULT_TID = 21  # 投稿分区：日常 / Upload category: daily life
+RETRYABLE_STATUS = (408, 429)  # 可以重试的4xx状态码 / 4xx statuses worth retrying
+
+
+class UploadRejected(RuntimeError):
+    """服务器用4xx拒绝了请求（例如上传会话已过期），原样重试没有意义
+    The server rejected the request with a 4xx (e.g. an expired upload session); retrying it as-is is pointless"""
+
+
+# ==== Cookie ====
+
+def export_browser_cookies(profile_path=None, cookie_file=COOKIE_FILE):
+    """用PROFILE_PATH的浏览器配置打开B站，导出登录Cookie
+    Open Bilibili with the PROFILE_PATH browser profile and export the login cookies"""
+    from test_upload import init_browser
+
+    driver, _ = init_browser(profile_path)
+    try:
+        driver.get("https://member.bilibili.com/")
+        cookies = {cookie["name"]: cookie["value"] for cookie in driver.get_cookies()}
+    finally:
+        driver.quit()
+    if "SESSDATA" not in cookies:
+        raise RuntimeError("浏览器配置中没有B站登录状态，请先在浏览器中登录")
+    tmp_file = cookie_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(cookies, f)
+    os.replace(tmp_file, cookie_file)
+    return cookies
+
+
+def load_cookies(profile_path=None, cookie_file=COOKIE_FILE):
+    """读取已导出的Cookie；没有或超过COOKIE_MAX_AGE_DAYS天时从浏览器配置重新导出，导出失败时沿用旧的
+    Load exported cookies; export them from the browser profile if missing or older than
+    COOKIE_MAX_AGE_DAYS, keeping the old ones if the export fails"""
+    if not os.path.exists(cookie_file):
+        logger.info("正在从浏览器配置导出B站Cookie...")
+        return export_browser_cookies(profile_path, cookie_file)
+    age_days = (time.time() - os.path.getmtime(cookie_file)) / 86400
+    if age_days > COOKIE_MAX_AGE_DAYS:
+        logger.info(f"B站Cookie已导出 {age_days:.0f} 天，正在从浏览器配置重新导出...")
+        try:
+            return export_browser_cookies(profile_path, cookie_file)
+        except Exception as e:
+            logger.warning(f"⚠️ 重新导出Cookie失败，继续使用旧的Cookie: {e}")
+    with open(cookie_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ==== HTTP ====
+
+def make_session(cookies, threads=UPLOAD_THREADS):
+    """带登录Cookie的requests.Session，连接池足够让每个上传线程保持一个keep-alive连接
+    A requests.Session carrying the login cookies, with a pool large enough for one keep-alive
+    connection per upload thread"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.headers["User-Agent"] = "Mozilla/5.0"
+    session.cookies.update(cookies)
+    adapter = HTTPAdapter(pool_maxsize=max(1, threads))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _json_request(session, method, url, **kwargs):
+    response = session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+    if response.status_code >= 400:
+        error = UploadRejected if response.status_code < 500 and response.status_code not in RETRYABLE_STATUS else RuntimeError
+        raise error(f"HTTP {response.status_code}: {url}: {response.content[:200]!r}")
+    return response.json()
+
+
+def _absolute_endpoint(endpoint):
+    """服务器返回的endpoint形如//host，沿用preupload地址的协议
+    The server returns endpoints like //host; reuse the preupload URL's scheme"""
+    if endpoint.startswith("//"):
+        return urllib.parse.urlparse(PREUPLOAD_URL).scheme + ":" + endpoint
+    return endpoint
+
+
+# ==== 续传日志 / Resume journal ====
+
+def journal_path(video_path):
+    """文件对应的续传日志路径（文件内容变化后是新的日志）
+    Resume journal path for a file (a changed file gets a new journal)"""
+    stat = os.stat(video_path)
+    key = f"{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return os.path.join(JOURNAL_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def load_journal(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_journal(path, journal):
+    """原子地写入续传日志
+    Atomically write the resume journal"""
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(journal, f, ensure_ascii=False)
+    os.replace(tmp_file, path)
+
+
+def discard_journal(video_path):
+    """删除文件的续传日志 / Delete a file's resume journal"""
+    path = journal_path(video_path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# ==== 上传 / Upload ====
+
+def start_upload(video_path, session):
+    """preupload并创建分块上传任务
+    Call preupload and create the multipart upload"""
+    name = os.path.basename(video_path)
+    size = os.path.getsize(video_path)
+    params = {"name": name, "size": size, "r": "upos", "profile": "ugcupos/bup"}
+    info = _json_request(session, "GET", PREUPLOAD_URL, params=params)
+    if not info.get("OK"):
+        raise RuntimeError(f"preupload失败: {info}")
+
+    endpoint = _absolute_endpoint(info["endpoint"])
+    path = info["upos_uri"].replace("upos://", "")
+    upload_url = f"{endpoint}/{path}"
+    created = _json_request(session, "POST", f"{upload_url}?uploads&output=json",
+                            headers={"X-Upos-Auth": info["auth"]}, data=b"")
+    return {
+        "video": os.path.abspath(video_path),
+        "size": size,
+        "upload_url": upload_url,
+        "upos_uri": info["upos_uri"],
+        "auth": info["auth"],
+        "biz_id": info.get("biz_id"),
+        "chunk_size": int(info.get("chunk_size") or DEFAULT_CHUNK_SIZE),
+        "upload_id": created["upload_id"],
+        "parts": {},
+    }
+
+
+def upload_chunk(journal, index, chunks, session):
+    """上传一个块，失败时按指数退避重试
+    Upload one chunk, retrying with exponential backoff
+
+    Returns:
+        服务器返回的ETag / ETag returned by the server
+    """
+    import requests
+
+    start = index * journal["chunk_size"]
+    end = min(start + journal["chunk_size"], journal["size"])
+    with open(journal["video"], "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    params = {
+        "partNumber": index + 1, "uploadId": journal["upload_id"],
+        "chunk": index, "chunks": chunks, "size": len(data),
+        "start": start, "end": end, "total": journal["size"],
+    }
+    headers = {
+        "X-Upos-Auth": journal["auth"],
+        "Content-Type": "application/octet-stream",
+        "Content-MD5-Hex": hashlib.md5(data).hexdigest(),
+    }
+    delay = RETRY_DELAY
+    for attempt in range(1, CHUNK_RETRIES + 1):
+        try:
+            response = session.put(journal["upload_url"], params=params, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
+            if response.status_code < 400:
+                return hashlib.md5(data).hexdigest()
+            error = f"HTTP {response.status_code}: {response.content[:100]!r}"
+            if response.status_code < 500 and response.status_code not in RETRYABLE_STATUS:
+                raise UploadRejected(f"块 {index + 1}/{chunks} 被拒绝: {error}")
+        except requests.RequestException as e:
+            error = str(e)
+        if attempt < CHUNK_RETRIES:
+            logger.warning(f"⚠️ 块 {index + 1}/{chunks} 上传失败（{error}），{delay:.0f} 秒后重试")
+            time.sleep(delay)
+            delay *= 2
+    raise RuntimeError(f"块 {index + 1}/{chunks} 上传失败，已重试 {CHUNK_RETRIES} 次")
+
+
+def complete_upload(journal, session):
+    """通知服务器合并所有块
+    Ask the server to assemble all chunks"""
+    params = {
+        "output": "json", "name": os.path.basename(journal["video"]),
+        "profile": "ugcupos/bup", "uploadId": journal["upload_id"], "biz_id": journal["biz_id"] or "",
+    }
+    parts = [{"partNumber": int(number), "eTag": etag} for number, etag in sorted(journal["parts"].items(), key=lambda item: int(item[0]))]
+    result = _json_request(session, "POST", journal["upload_url"], params=params,
+                           headers={"X-Upos-Auth": journal["auth"]}, json={"parts": parts})
+    if not result.get("OK"):
+        raise RuntimeError(f"合并分块失败: {result}")
+
+
+def transfer_file(video_path, session, threads=UPLOAD_THREADS):
+    """并行分块上传一个文件，支持断点续传；续传的上传会话已过期（服务器返回4xx）时丢弃日志重新开始
+    Upload a file in parallel chunks, resuming from the journal; if the resumed upload session has expired
+    (the server answers 4xx) the journal is discarded and the upload starts over
+
+    Returns:
+        完成的续传日志（包含upos_uri）/ The completed journal (with upos_uri)
+    """
+    path = journal_path(video_path)
+    journal = load_journal(path)
+    if journal and journal.get("completed"):
+        return journal
+    if journal:
+        logger.info(f"从续传日志恢复，已完成 {len(journal['parts'])} 个块")
+        try:
+            return _send_chunks(journal, path, session, threads)
+        except UploadRejected as e:
+            logger.warning(f"⚠️ 续传的上传会话已失效（{e}），重新开始上传")
+            discard_journal(video_path)
+    journal = start_upload(video_path, session)
+    save_journal(path, journal)
+    return _send_chunks(journal, path, session, threads)
+
+
+def _send_chunks(journal, path, session, threads):
+    """上传日志中还没完成的块并通知服务器合并 / Upload the chunks the journal lacks and have the server assemble them"""
+    chunks = (journal["size"] + journal["chunk_size"] - 1) // journal["chunk_size"]
+    pending = [index for index in range(chunks) if str(index + 1) not in journal["parts"]]
+    lock = threading.Lock()
+    started = time.time()
+    sent = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        futures = {executor.submit(upload_chunk, journal, index, chunks, session): index for index in pending}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                etag = future.result()
+            except Exception:
+                # 已完成的块都在日志里，下次从这里继续 / Finished chunks are journaled; the next run resumes here
+                for other in futures:
+                    other.cancel()
+                raise
+            with lock:
+                journal["parts"][str(index + 1)] = etag
+                save_journal(path, journal)
+                sent += min(journal["chunk_size"], journal["size"] - index * journal["chunk_size"])
+            elapsed = time.time() - started
+            speed = sent / elapsed / (1024 * 1024) if elapsed > 0 else 0
+            logger.info(f"已上传 {len(journal['parts'])}/{chunks} 块 ({speed:.2f}MB/s)")
+
+    complete_upload(journal, session)
+    journal["completed"] = True
+    save_journal(path, journal)
+    return journal
+
+
+def submit_video(journal, title, session, tid=DEFAULT_TID, tag="海外,搞笑", desc=""):
+    """用上传好的文件提交稿件
+    Submit the uploaded file as a video post"""
+    filename = os.path.splitext(os.path.basename(journal["upos_uri"]))[0]
+    payload = {
+        "copyright": 1,
+        "source": "",
+        "tid": tid,
+        "tag": tag,
+        "title": title,
+        "desc": desc,
+        "videos": [{"filename": filename, "title": title, "desc": ""}],
+    }
+    result = _json_request(session, "POST", SUBMIT_URL, params={"csrf": session.cookies.get("bili_jct", "")},
+                           json=payload)
+    if result.get("code", 0) != 0:
+        raise RuntimeError(f"提交稿件失败: {result}")
+    return result
+
+
+def upload_video_http(video_path, threads=UPLOAD_THREADS, channel=None):
+    """不经过浏览器上传并投稿一个视频，返回值与test_upload.upload_latest_merged_video相同
+    Upload and publish a video without a browser; returns the same as test_upload.upload_latest_merged_video
+
+    Args:
+        channel: 可选，目标频道设置（见test_upload.get_channel），可以额外指定profile_path和cookie_file
+                 Optional target channel settings (see test_upload.get_channel); may also set profile_path and cookie_file
+
+    Returns:
+        (success, duration): 上传成功与否和用时
+    """
+    from test_upload import (
+        get_channel, reserve_serial_number, commit_serial_number, release_serial_number, record_uploaded,
+    )
+    channel = get_channel(channel)
+    serial_file = channel["serial_file"]
+
+    start = time.time()
+    video_path = os.path.abspath(video_path)
+    if not os.path.exists(video_path):
+        logger.error(f"文件错误: 指定的视频文件不存在: {video_path}")
+        return False, 0.0
+
+    logger.info(f"正在上传视频到哔哩哔哩（HTTP分块）: {os.path.basename(video_path)}")
+    serial = None
+    submitted = False
+    try:
+        cookies = load_cookies(channel.get("profile_path"), channel.get("cookie_file", COOKIE_FILE))
+        session = make_session(cookies, threads)
+        serial = reserve_serial_number(os.path.basename(video_path), serial_file)
+        journal = transfer_file(video_path, session, threads)
+        submitted = True  # 提交请求发出后序列号可能已经被使用 / After the submit request the serial may be used
+        submit_video(journal, f"{channel['title_prefix']}{serial}", session)
+        discard_journal(video_path)  # 投稿成功后日志没有用了 / The journal is useless once the post is submitted
+    except Exception as e:
+        logger.error(f"上传失败: {str(e)}")
+        return False, time.time() - start
+    finally:
+        # finally而不是except Exception：Ctrl+C中断时序列号也要释放 / finally, not except Exception, so Ctrl+C releases the serial too
+        if serial is not None:
+            if submitted:
+                commit_serial_number(serial, serial_file)
+            else:
+                release_serial_number(serial, serial_file)
+    record_uploaded(video_path, channel["uploaded_log"])
+    duration = time.time() - start
+    logger.info(f"上传成功！用时{int(duration)}秒")
+    return True, duration
+
+
+# ==== 本地测试服务器 / Local stand-in server ====
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """实现同样分块协议的本地服务器，分块保存在storage_dir中
+    Local server implementing the same chunk protocol, parts are stored in storage_dir"""
+
+    storage_dir = "upload_standin"
+    counter = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _parts_dir(self, upload_id):
+        return os.path.join(self.storage_dir, "parts", upload_id)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/preupload":
+            return self._send_json({"OK": 0}, 404)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        with self.lock:
+            StandinHandler.counter += 1
+            number = StandinHandler.counter
+        host = self.headers.get("Host")
+        self._send_json({
+            "OK": 1,
+            "endpoint": f"//{host}",
+            "upos_uri": f"upos://ugcboss/n{int(time.time())}{number}.mp4",
+            "auth": "standin-auth",
+            "biz_id": number,
+            "chunk_size": int(os.environ.get("STANDIN_CHUNK_SIZE", 4 * 1024 * 1024)),
+            "name": params.get("name"),
+        })
+
+    def do_PUT(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        data = self._read_body()
+        if self.headers.get("X-Upos-Auth") != "standin-auth":
+            return self._send_json({"OK": 0}, 403)
+        if int(params["size"]) != len(data):
+            return self._send_json({"OK": 0, "message": "size mismatch"}, 400)
+        if self.headers.get("Content-MD5-Hex") and self.headers["Content-MD5-Hex"] != hashlib.md5(data).hexdigest():
+            return self._send_json({"OK": 0, "message": "checksum mismatch"}, 400)
+        parts_dir = self._parts_dir(params["uploadId"])
+        os.makedirs(parts_dir, exist_ok=True)
+        with open(os.path.join(parts_dir, f"{int(params['partNumber']):06d}"), "wb") as f:
+            f.write(data)
+        self._send_json({"OK": 1})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        body = self._read_body()
+        if url.path.endswith("/x/vu/web/add"):
+            return self._send_json({"code": 0, "data": {"aid": 1, "bvid": "BVstandin"}, "submitted": json.loads(body or b"{}")})
+        if "uploads" in params:
+            upload_id = hashlib.sha1(f"{url.path}{time.time()}".encode()).hexdigest()[:16]
+            return self._send_json({"OK": 1, "upload_id": upload_id})
+        # 合并分块 / Assemble parts
+        parts = json.loads(body or b"{}").get("parts", [])
+        parts_dir = self._parts_dir(params.get("uploadId", ""))
+        output = os.path.join(self.storage_dir, os.path.basename(url.path))
+        with open(output, "wb") as out:
+            for part in sorted(parts, key=lambda item: item["partNumber"]):
+                part_file = os.path.join(parts_dir, f"{part['partNumber']:06d}")
+                if not os.path.exists(part_file):
+                    return self._send_json({"OK": 0, "message": f"missing part {part['partNumber']}"}, 400)
+                with open(part_file, "rb") as f:
+                    out.write(f.read())
+        self._send_json({"OK": 1, "location": output})
+
+
+def serve_standin(port=8765, storage_dir="upload_standin"):
+    """启动本地测试服务器
+    Start the local stand-in server"""
+    StandinHandler.storage_dir = storage_dir
+    os.makedirs(storage_dir, exist_ok=True)
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandinHandler)
+    logger.info(f"本地测试服务器已启动: http://127.0.0.1:{port}/preupload （文件保存在 {storage_dir}）")
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="B站分块上传 / Bilibili chunked uploader")
+    parser.add_argument("video", nargs="?", help="要上传的视频 / Video to upload")
+    parser.add_argument("--threads", "-t", type=int, default=UPLOAD_THREADS, help="并行上传的块数 / Parallel chunks")
+    parser.add_argument("--standin", action="store_true", help="启动本地测试服务器 / Start the local stand-in server")
+    parser.add_argument("--port", type=int, default=8765, help="本地测试服务器端口 / Stand-in server port")
+    parser.add_argument("--export-cookies", action="store_true", help="从浏览器配置重新导出Cookie / Re-export cookies from the browser profile")
+    args = parser.parse_args()
+
+    if args.standin:
+        try:
+            serve_standin(args.port).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if args.export_cookies:
+        export_browser_cookies()
+        logger.info(f"Cookie已保存到: {COOKIE_FILE}")
+    if args.video:
+        ok, _ = upload_video_http(args.video, args.threads)
+        sys.exit(0 if ok else 1)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+共享的异步日志
+Shared asynchronous logging
+
+所有模块通过get_logger(阶段名)记录日志，不再直接print：
+    - 记录先放进队列（QueueHandler），由后台线程写出，调用方不会被磁盘IO阻塞
+    - 文件写入经过MemoryHandler批量缓冲，每LOG_FLUSH_INTERVAL秒或遇到错误时落盘
+    - logs/pipeline.log按大小和天数轮转
+    - 控制台输出只有消息本身，有tqdm进度条时通过tqdm.write输出，不会打乱进度条
+    - 每个阶段可以单独设置级别，例如 LOG_LEVELS="download=DEBUG,upload=WARNING"
+Every module logs through get_logger(stage) instead of print:
+    - records go into a queue (QueueHandler) and a background thread writes them, so callers never block on disk IO
+    - file writes are batched by a MemoryHandler and flushed every LOG_FLUSH_INTERVAL seconds or on errors
+    - logs/pipeline.log rotates by size and by day
+    - the console shows just the message, through tqdm.write while a tqdm bar is active so bars stay intact
+    - levels can be set per stage, e.g. LOG_LEVELS="download=DEBUG,upload=WARNING"
+"""
+
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+LOG_DIR = "logs"  # 日志目录 / Log directory
+LOG_FILE = os.path.join(LOG_DIR, "pipeline.log")  # 主日志文件 / Main log file
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 20 * 1024 * 1024))  # 单个日志文件大小上限 / Size limit per log file
+LOG_ROTATE_SECONDS = int(os.environ.get("LOG_ROTATE_SECONDS", 24 * 3600))  # 按时间轮转的间隔 / Time-based rotation interval
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 14))  # 保留的旧日志数量 / Rotated files to keep
+LOG_BATCH_SIZE = 200  # 缓冲多少条后写盘 / Records buffered before a write
+LOG_FLUSH_INTERVAL = 2.0  # 缓冲最长保留时间（秒）/ Max time records stay buffered (seconds)
+ROOT_NAME = "pipeline"  # 所有阶段日志器的父日志器 / Parent of every stage logger
+
+_lock = threading.Lock()
+_state = {"listener": None, "buffer": None, "stop": None}
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """文件超过大小上限或进入新的时间段（默认按天）时轮转，多次短时间运行之间也有效
+    Rotate when the file exceeds the size limit or a new period (daily by default) starts, also across short runs"""
+
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.interval = interval
+        # 已有文件按最后写入时间归属时间段 / An existing file belongs to the period of its last write
+        written = os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        self.period = int(written // interval) if interval else 0
+
+    def shouldRollover(self, record):
+        if self.interval and int(record.created // self.interval) != self.period:
+            return os.path.exists(self.baseFilename)
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.period = int(time.time() // self.interval)
+
+
+class ConsoleHandler(logging.StreamHandler):
+    """控制台输出；tqdm已加载时用tqdm.write，避免打乱进度条
+    Console output; uses tqdm.write when tqdm is loaded so progress bars are not broken"""
+
+    def emit(self, record):
+        try:
+            message = self.format(record)
+            tqdm_module = sys.modules.get("tqdm")
+            if tqdm_module is not None:
+                tqdm_module.tqdm.write(message, file=sys.stdout)
+            else:
+                sys.stdout.write(message + "\n")
+                sys.stdout.flush()
+        except Exception:
+            self.handleError(record)
+
+
+def _stage_levels():
+    """解析LOG_LEVELS="download=DEBUG,merge=INFO"
+    Parse LOG_LEVELS="download=DEBUG,merge=INFO\""""
+    levels = {}
+    for part in os.environ.get("LOG_LEVELS", "").split(","):
+        stage, _, level = part.strip().partition("=")
+        if stage and level:
+            levels[stage.strip()] = level.strip().upper()
+    return levels
+
+
+def _flush_periodically(buffer, stop):
+    while not stop.wait(LOG_FLUSH_INTERVAL):
+        buffer.flush()
+
+
+def setup_logging():
+    """初始化日志（只执行一次）
+    Initialize logging (runs once)"""
+    with _lock:
+        if _state["listener"] is not None:
+            return
+        os.makedirs(LOG_DIR, exist_ok=True)
+
+        file_handler = SizeAndTimeRotatingFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUP_COUNT)
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s [%(name)s] %(message)s"))
+        buffer = logging.handlers.MemoryHandler(LOG_BATCH_SIZE, flushLevel=logging.ERROR, target=file_handler)
+        console = ConsoleHandler()
+        console.setFormatter(logging.Formatter("%(message)s"))
+
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, console, buffer, respect_handler_level=True)
+        listener.start()
+
+        root = logging.getLogger(ROOT_NAME)
+        root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.propagate = False
+        for stage, level in _stage_levels().items():
+            logging.getLogger(f"{ROOT_NAME}.{stage}").setLevel(level)
+
+        stop = threading.Event()
+        threading.Thread(target=_flush_periodically, args=(buffer, stop), name="log-flush", daemon=True).start()
+        _state.update(listener=listener, buffer=buffer, stop=stop)
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """写出队列和缓冲中剩余的日志
+    Drain the queue and flush buffered records"""
+    with _lock:
+        listener, buffer, stop = _state["listener"], _state["buffer"], _state["stop"]
+        if listener is None:
+            return
+        _state.update(listener=None, buffer=None, stop=None)
+    stop.set()
+    listener.stop()
+    buffer.flush()
+    buffer.target.close()
+
+
+def get_logger(stage):
+    """返回某个阶段的日志器，如get_logger("merge")
+    Return the logger for a stage, e.g. get_logger("merge")"""
+    setup_logging()
+    return logging.getLogger(f"{ROOT_NAME}.{stage}")
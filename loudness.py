@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+按片段缓存的响度分析（EBU R128）
+Cached per-clip loudness analysis (EBU R128)
+
+每个源片段只分析一次（并行），测量结果持久化保存；标准化时用测量值在同一次编码中做线性响度归一化。
+Each source clip is analyzed once (in parallel) and the measurements are persisted; standardization
+then applies linear loudness normalization within its single encode pass.
+"""
+
+import os
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from test_merge import FFMPEG_PATH, LOG_DIR
+from ffmpeg_supervisor import run_process
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
+LOUDNESS_CACHE = os.path.join(LOG_DIR, "loudness_cache.json")  # 测量结果缓存 / Measurement cache
+
+# 归一化目标 / Normalization targets
+TARGET_I = -16.0  # 综合响度 LUFS / Integrated loudness
+TARGET_TP = -1.5  # 真峰值 dBTP / True peak
+TARGET_LRA = 11.0  # 响度范围 LU / Loudness range
+
+ANALYSIS_WORKERS = int(os.environ.get("LOUDNESS_WORKERS", os.cpu_count() or 2))  # 并行分析数 / Parallel analyses
+
+NO_AUDIO_ERRORS = ("does not contain any stream", "matches no streams")  # 没有音轨时FFmpeg的报错 / FFmpeg errors for inputs without audio
+
+_cache_lock = threading.Lock()
+
+
+def _targets():
+    return f"I={TARGET_I}:TP={TARGET_TP}:LRA={TARGET_LRA}"
+
+
+def _cache_key(video_path):
+    """缓存键：路径、大小和修改时间，文件被替换后会重新分析
+    Cache key: path, size and mtime, so a replaced file is analyzed again"""
+    stat = os.stat(video_path)
+    return f"{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}|{_targets()}"
+
+
+def load_cache():
+    """读取响度缓存
+    Load the loudness cache"""
+    if not os.path.exists(LOUDNESS_CACHE):
+        return {}
+    try:
+        with open(LOUDNESS_CACHE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    """原子地写入响度缓存
+    Atomically write the loudness cache"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    tmp_file = LOUDNESS_CACHE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp_file, LOUDNESS_CACHE)
+
+
+def analyze_loudness(video_path):
+    """用loudnorm滤镜测量一个文件的响度，没有音频或失败时返回None
+    Measure the loudness of one file with the loudnorm filter, None if it has no audio or fails"""
+    return _measure(video_path)[0]
+
+
+def _measure(video_path):
+    """测量响度，同时说明结果是否确定：没有音轨或静音是确定的，FFmpeg失败或输出无法解析可能只是暂时的
+    Measure loudness and say whether the result is definitive: no audio or silence is, while an FFmpeg
+    failure or unparsable output may be transient
+
+    Returns:
+        (measurement, definitive): 测量值或None，以及是否可以缓存 / The measurement or None, and whether it may be cached
+    """
+    command = [
+        FFMPEG_PATH, "-hide_banner", "-nostats",
+        "-i", video_path,
+        "-vn",
+        "-af", f"loudnorm={_targets()}:print_format=json",
+        "-f", "null", "-"
+    ]
+    result = run_process(command)
+    if result.returncode != 0:
+        return None, any(error in (result.stderr or "") for error in NO_AUDIO_ERRORS)
+
+    # loudnorm把JSON打印在stderr末尾 / loudnorm prints its JSON at the end of stderr
+    match = re.search(r"\{[^{}]*\"input_i\"[^{}]*\}", result.stderr or "")
+    if not match:
+        return None, False
+    try:
+        data = json.loads(match.group(0))
+        measurement = {
+            "input_i": float(data["input_i"]),
+            "input_tp": float(data["input_tp"]),
+            "input_lra": float(data["input_lra"]),
+            "input_thresh": float(data["input_thresh"]),
+            "target_offset": float(data["target_offset"]),
+        }
+    except (KeyError, ValueError):
+        return None, False
+
+    # 静音片段测量值为-inf，无法归一化 / Silent clips measure -inf and cannot be normalized
+    if any(value != value or value in (float("inf"), float("-inf")) for value in measurement.values()):
+        return None, True
+    return measurement, True
+
+
+def analyze_clips(video_paths, workers=ANALYSIS_WORKERS):
+    """并行分析多个片段，已缓存的片段不再分析；FFmpeg暂时失败的结果不缓存，下次重新分析
+    Analyze several clips in parallel, skipping clips that are already cached; results of transient
+    FFmpeg failures are not cached, so they are analyzed again next time
+
+    Returns:
+        dict: 路径到测量值的映射，无法测量的片段值为None / Mapping of path to measurement, None if unmeasurable
+    """
+    with _cache_lock:
+        cache = load_cache()
+
+    results = {}
+    pending = []
+    for path in video_paths:
+        key = _cache_key(path)
+        if key in cache:
+            results[path] = cache[key]
+        else:
+            pending.append((path, key))
+
+    if pending:
+        logger.info(f"正在分析 {len(pending)} 个片段的响度（已缓存 {len(results)} 个）")
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            measured = list(executor.map(lambda item: _measure(item[0]), pending))
+        with _cache_lock:
+            cache = load_cache()
+            for (path, key), (measurement, definitive) in zip(pending, measured):
+                results[path] = measurement
+                if definitive:
+                    cache[key] = measurement
+            save_cache(cache)
+
+    return results
+
+
+def loudnorm_filter(measurement):
+    """根据测量值生成线性归一化的loudnorm滤镜
+    Build a linear-mode loudnorm filter from a measurement"""
+    return (
+        f"loudnorm={_targets()}"
+        f":measured_I={measurement['input_i']}"
+        f":measured_TP={measurement['input_tp']}"
+        f":measured_LRA={measurement['input_lra']}"
+        f":measured_thresh={measurement['input_thresh']}"
+        f":offset={measurement['target_offset']}"
+        f":linear=true:print_format=none"
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+
+    parser = argparse.ArgumentParser(description="预先分析片段响度 / Pre-analyze clip loudness")
+    parser.add_argument("--dir", "-d", default="test_downloads", help="视频目录 / Video directory")
+    args = parser.parse_args()
+
+    clip_paths = sorted(glob.glob(os.path.join(args.dir, "*.mp4")))
+    for clip_path, value in analyze_clips(clip_paths).items():
+        if value:
+            logger.info(f"{os.path.basename(clip_path)}: {value['input_i']:.1f} LUFS")
+        else:
+            logger.info(f"{os.path.basename(clip_path)}: 无法测量")
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+合并结果按清单哈希缓存
+Manifest-hash memoization of merge outputs
+
+清单哈希覆盖：按顺序排列的源文件内容哈希、标准化参数和合并方式。
+同样的请求再次出现时，直接返回已有文件，或用reflink/硬链接挂到新的输出文件名下。
+The manifest hash covers the ordered source content hashes, the standardization parameters and
+the merge strategy. A matching request returns the existing file, or reflinks/hard-links it under the new name.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+from test_merge import LOG_DIR, standard_params_hash
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
+MANIFEST_FILE = os.path.join(LOG_DIR, "merge_manifest.json")  # 清单记录 / Manifest records
+
+_manifest_lock = threading.Lock()
+
+
+def load_manifest():
+    """读取清单记录
+    Load manifest records"""
+    if not os.path.exists(MANIFEST_FILE):
+        return {"hashes": {}, "outputs": {}}
+    try:
+        with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {"hashes": {}, "outputs": {}}
+    data.setdefault("hashes", {})
+    data.setdefault("outputs", {})
+    return data
+
+
+def save_manifest(data):
+    """原子地写入清单记录
+    Atomically write manifest records"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    tmp_file = MANIFEST_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, MANIFEST_FILE)
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def file_content_hash(path, known_hashes=None):
+    """计算文件内容的SHA-256（content_store.hash_file），按路径、大小和修改时间缓存
+    SHA-256 of a file's content (content_store.hash_file), cached by path, size and mtime"""
+    from content_store import hash_file
+
+    key = _stat_key(path)
+    if known_hashes is not None and key in known_hashes:
+        return known_hashes[key]
+
+    value = hash_file(path)
+    if known_hashes is not None:
+        known_hashes[key] = value
+    return value
+
+
+def compute_manifest_hash(source_paths, strategy, options=None):
+    """计算一次合并请求的清单哈希
+    Compute the manifest hash of a merge request
+
+    Args:
+        source_paths: 按合并顺序排列的源文件 / Source files in merge order
+        strategy: 合并方式名称 / Merge strategy name
+        options: 影响输出的其他参数（如交叉淡化时长）/ Other parameters that affect the output (e.g. crossfade)
+    """
+    from content_store import hash_files
+
+    with _manifest_lock:
+        data = load_manifest()
+        known_hashes = data["hashes"]
+        # 没有缓存的文件并行计算 / Hash the uncached files in parallel
+        missing = [path for path in source_paths if _stat_key(path) not in known_hashes]
+        for path, value in hash_files(missing).items():
+            known_hashes[_stat_key(path)] = value
+        content_hashes = [file_content_hash(path, known_hashes) for path in source_paths]
+        save_manifest(data)
+
+    manifest = {
+        "sources": content_hashes,
+        "standard_params": standard_params_hash(),
+        "strategy": strategy,
+        "options": options or {},
+    }
+    payload = json.dumps(manifest, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def find_cached_output(manifest_hash):
+    """查找清单哈希对应的已有输出，文件丢失或大小变化时返回None
+    Find an existing output for a manifest hash, None if the file is gone or its size changed"""
+    with _manifest_lock:
+        record = load_manifest()["outputs"].get(manifest_hash)
+    if not record:
+        return None
+    path = record.get("output")
+    if not path or not os.path.exists(path) or os.path.getsize(path) != record.get("size"):
+        return None
+    return path
+
+
+def record_output(manifest_hash, output_path):
+    """记录一次合并的输出
+    Record the output of a merge"""
+    output_path = os.path.abspath(output_path)
+    with _manifest_lock:
+        data = load_manifest()
+        data["outputs"][manifest_hash] = {
+            "output": output_path,
+            "size": os.path.getsize(output_path),
+            "created": datetime.now().isoformat(timespec="seconds"),
+        }
+        save_manifest(data)
+
+
+def prepare_output_path(output_path):
+    """写入输出前断开已有的硬链接，避免FFmpeg覆盖共享的文件内容
+    Break an existing hard link before writing an output, so FFmpeg doesn't overwrite shared content"""
+    if os.path.exists(output_path) and os.stat(output_path).st_nlink > 1:
+        os.remove(output_path)
+
+
+def reuse_output(existing_path, output_path):
+    """把已有输出挂到新的文件名下：优先reflink，其次硬链接，都不支持时直接返回已有文件
+    Expose an existing output under a new name: a reflink, then a hard link, otherwise return the existing file
+
+    Returns:
+        可用的输出文件绝对路径 / Absolute path of the usable output
+    """
+    existing_path = os.path.abspath(existing_path)
+    output_path = os.path.abspath(output_path)
+    if existing_path == output_path:
+        return existing_path
+    from content_store import clone_file
+
+    try:
+        return output_path if clone_file(existing_path, output_path, copy=False) else existing_path
+    except OSError:
+        return existing_path
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+合并任务的断点记录，中断的合并可以从上次完成的步骤继续
+Crash-safe checkpoints for merge jobs, so an interrupted merge resumes from its last completed step
+
+每次合并都有一个任务记录（test_logs/merge_jobs/<清单哈希>.json），每个状态变化后都原子地写入：
+    - 计划合并的片段列表，以及每个片段的状态：pending、standardized（附带输出文件的哈希）、failed
+    - 分批合并时已经完成的批次中间文件
+    - 当前步骤：standardize -> concat -> finalize -> done
+中间文件放在任务自己的临时目录（temp/job_<id>）里，不会被prepare_temp_directory()清空。
+重启、OOM或Ctrl+C之后再次运行test_main -m时，找到同一目录下未完成的任务，跳过哈希仍然一致的标准化片段和批次，
+从上次完成的步骤继续。
+Each merge has a job record (test_logs/merge_jobs/<manifest hash>.json), written atomically after every
+state change:
+    - the planned clip list and each clip's state: pending, standardized (with the output's hash), failed
+    - finished batch intermediates when merging in batches
+    - the current step: standardize -> concat -> finalize -> done
+Intermediates live in the job's own temp directory (temp/job_<id>), which prepare_temp_directory()
+does not wipe. After a reboot, OOM kill or Ctrl+C, the next test_main -m finds the unfinished job for
+the same directory, skips clips and batches whose hashes still match, and continues from the last
+completed step.
+
+同一个任务失败MAX_FAILURES次（例如某个片段每次都标准化失败）后放弃，否则它会被无限次继续，
+retention也会一直保护它的源片段。
+A job that fails MAX_FAILURES times (say a clip that fails to standardize on every run) is dropped;
+otherwise it would be resumed forever and retention would keep protecting its sources.
+"""
+
+import os
+import json
+import glob
+import shutil
+import threading
+from datetime import datetime
+
+from test_merge import LOG_DIR, TEMP_DIR
+from merge_cache import file_content_hash
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
+JOBS_DIR = os.path.join(LOG_DIR, "merge_jobs")  # 任务记录目录 / Job record directory
+STEPS = ("standardize", "concat", "finalize", "done")  # 任务步骤，按顺序执行 / Job steps, in order
+MAX_FAILURES = int(os.environ.get("MERGE_JOB_MAX_FAILURES", 3))  # 任务失败这么多次后放弃 / Drop a job after this many failures
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class MergeJob:
+    """一次合并的断点记录，所有修改都立即原子地落盘
+    Checkpoint record of one merge; every change is written to disk atomically right away"""
+
+    def __init__(self, data):
+        self.data = data
+        self._lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.data["id"]
+
+    @property
+    def path(self):
+        return os.path.join(JOBS_DIR, f"{self.id}.json")
+
+    @property
+    def work_dir(self):
+        """任务自己的临时目录 / The job's own temp directory"""
+        return self.data.get("work_dir") or os.path.join(TEMP_DIR, f"job_{self.id[:12]}")
+
+    @property
+    def step(self):
+        return self.data["step"]
+
+    @property
+    def output(self):
+        return self.data["output"]
+
+    @property
+    def clip_names(self):
+        return [clip["name"] for clip in self.data["clips"]]
+
+    def save(self):
+        """原子地写入任务记录
+        Atomically write the job record"""
+        self.data["updated"] = datetime.now().isoformat(timespec="seconds")
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.path)
+
+    def set_step(self, step):
+        with self._lock:
+            self.data["step"] = step
+            self.save()
+
+    def _clip(self, source):
+        for clip in self.data["clips"]:
+            if clip["source"] == source:
+                return clip
+        raise KeyError(source)
+
+    def clip_output(self, source):
+        """片段标准化后的输出路径 / Standardized output path of a clip"""
+        return self._clip(source)["output"]
+
+    def mark_clip(self, source, ok, error=None):
+        """记录一个片段的标准化结果，成功时保存输出文件的哈希
+        Record a clip's standardization result, storing the output's hash on success"""
+        clip = self._clip(source)
+        output_hash = file_content_hash(clip["output"]) if ok and os.path.exists(clip["output"]) else None
+        with self._lock:
+            clip["state"] = "standardized" if output_hash else "failed"
+            clip["output_hash"] = output_hash
+            clip["error"] = None if output_hash else (error or "standardize failed")
+            self.save()
+
+    def is_standardized(self, source):
+        """片段已经标准化，且输出文件仍然和记录的哈希一致
+        The clip is standardized and its output still matches the recorded hash"""
+        clip = self._clip(source)
+        if clip["state"] != "standardized" or not os.path.exists(clip["output"]):
+            return False
+        return file_content_hash(clip["output"]) == clip["output_hash"]
+
+    def pending_clips(self):
+        """还需要标准化的片段，记录已失效的片段重新置为pending
+        Clips that still need standardizing; clips whose record is stale are reset to pending"""
+        pending = []
+        for clip in self.data["clips"]:
+            if not self.is_standardized(clip["source"]):
+                clip["state"], clip["output_hash"] = "pending", None
+                pending.append((clip["source"], clip["output"]))
+        with self._lock:
+            self.save()
+        return pending
+
+    def batch_done(self, batch_output, batch_inputs):
+        """批次中间文件已经生成，且输入和记录一致、文件哈希未变
+        A batch intermediate was produced from the same inputs and its hash is unchanged"""
+        record = self.data["batches"].get(batch_output)
+        if not record or record["inputs"] != list(batch_inputs) or not os.path.exists(batch_output):
+            return False
+        return file_content_hash(batch_output) == record["hash"]
+
+    def record_batch(self, batch_output, batch_inputs):
+        """记录一个完成的批次 / Record a finished batch"""
+        with self._lock:
+            self.data["batches"][batch_output] = {"inputs": list(batch_inputs), "hash": file_content_hash(batch_output)}
+            self.save()
+
+    def output_done(self):
+        """最终输出已经生成且大小和记录一致 / The final output exists with the recorded size"""
+        output = self.data["output"]
+        return os.path.exists(output) and os.path.getsize(output) == self.data.get("output_size")
+
+    def record_output(self):
+        """记录最终输出并进入finalize步骤 / Record the final output and move to the finalize step"""
+        with self._lock:
+            self.data["output_size"] = os.path.getsize(self.data["output"])
+            self.data["step"] = "finalize"
+            self.save()
+
+    def finish(self):
+        """标记完成并删除任务的临时目录
+        Mark the job done and remove its temp directory"""
+        self.set_step("done")
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def record_failure(self, reason):
+        """记录一次失败；达到MAX_FAILURES次时放弃任务
+        Record a failure; the job is dropped once it reaches MAX_FAILURES
+
+        Returns:
+            bool: 任务是否已被放弃 / Whether the job was dropped
+        """
+        with self._lock:
+            self.data["failures"] = self.data.get("failures", 0) + 1
+            self.data["last_error"] = reason
+            self.save()
+        if self.data["failures"] < MAX_FAILURES:
+            return False
+        logger.warning(f"⚠️ 合并任务 {self.id[:12]} 已失败 {self.data['failures']} 次（{reason}），放弃该任务")
+        self.discard()
+        return True
+
+    def discard(self):
+        """删除任务记录和临时目录 / Delete the job record and its temp directory"""
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_job(path):
+    """读取一个任务记录，损坏时返回None
+    Load a job record, None if it is corrupt"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return MergeJob(json.load(f))
+    except (OSError, ValueError):
+        return None
+
+
+def list_jobs():
+    """所有任务记录，按创建时间排序
+    Every job record, sorted by creation time"""
+    jobs = [load_job(path) for path in glob.glob(os.path.join(JOBS_DIR, "*.json"))]
+    return sorted((job for job in jobs if job), key=lambda job: job.data.get("created", ""))
+
+
+def recovery_clips():
+    """最新的未完成任务里已经标准化的片段，按合并顺序排列，供fix_merge/fix_concat手动补救使用
+    Standardized clips of the newest unfinished job, in merge order, for manual recovery with fix_merge/fix_concat
+
+    Returns:
+        (job, paths): 任务和片段路径；没有可用的任务时为(None, []) / The job and clip paths; (None, []) if there is none
+    """
+    for job in reversed(list_jobs()):
+        if job.step == "done":
+            continue
+        paths = [clip["output"] for clip in job.data["clips"]
+                 if clip["state"] == "standardized" and os.path.exists(clip["output"])]
+        if paths:
+            return job, paths
+    return None, []
+
+
+def create_job(manifest_hash, source_dir, source_paths, output_path, options, temp_dir=TEMP_DIR):
+    """为一次合并创建任务记录，已有同一清单的未完成任务时直接返回它
+    Create the job record for a merge; an unfinished job for the same manifest is returned instead
+
+    Args:
+        manifest_hash: merge_cache计算的清单哈希，作为任务ID / Manifest hash from merge_cache, used as the job ID
+        source_dir: 源目录 / Source directory
+        source_paths: 按合并顺序排列的源片段 / Source clips in merge order
+        output_path: 最终输出路径 / Final output path
+        options: 合并参数（strategy等），恢复时必须一致 / Merge options (strategy etc.), must match to resume
+        temp_dir: 任务临时目录的父目录（每个流水线一个）/ Parent of the job's temp directory (one per pipeline)
+    """
+    existing = load_job(os.path.join(JOBS_DIR, f"{manifest_hash}.json"))
+    if existing and existing.step != "done":
+        return existing
+
+    job = MergeJob({
+        "id": manifest_hash,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "source_dir": os.path.abspath(source_dir),
+        "options": options,
+        "output": os.path.abspath(output_path),
+        "work_dir": os.path.abspath(os.path.join(temp_dir, f"job_{manifest_hash[:12]}")),
+        "step": "standardize",
+        "clips": [],
+        "batches": {},
+    })
+    for idx, source in enumerate(source_paths):
+        name = os.path.relpath(source, source_dir)
+        job.data["clips"].append({
+            "name": name,
+            "source": os.path.abspath(source),
+            **_source_stamp(source),
+            # 加序号避免不同子目录里的同名片段冲突 / Prefix the index so same-named clips in subdirectories don't collide
+            "output": os.path.abspath(os.path.join(job.work_dir, f"{idx:04d}_{os.path.basename(source)}")),
+            "state": "pending",
+            "output_hash": None,
+            "error": None,
+        })
+    os.makedirs(job.work_dir, exist_ok=True)
+    job.save()
+    return job
+
+
+def find_resumable(source_dir, candidates, options, merged=()):
+    """查找可以继续的未完成任务：同一源目录、同样的合并参数，计划中的片段都还在且没有变化
+    Find an unfinished job to resume: same source directory and options, every planned clip still present and unchanged
+
+    有片段已经被别的合并用掉（记录在merged.log中）的任务不可能再继续，直接删除，不再让retention保护它的源片段
+    A job with a clip that another run already merged (recorded in merged.log) can never resume, so it
+    is deleted and retention stops protecting its sources
+
+    Args:
+        candidates: 当前尚未合并的片段名（相对source_dir）/ Clip names (relative to source_dir) not merged yet
+        merged: merged.log中记录的片段名 / Clip names recorded in merged.log
+    """
+    source_dir = os.path.abspath(source_dir)
+    candidates, merged = set(candidates), set(merged)
+    for job in reversed(list_jobs()):
+        if job.step == "done" or job.data["source_dir"] != source_dir:
+            continue
+        clips = job.data["clips"]
+        if any(clip["name"] in merged for clip in clips):
+            logger.info(f"合并任务 {job.id[:12]} 的片段已被其他合并使用，删除该任务")
+            job.discard()
+            continue
+        if job.data["options"] != options:
+            continue
+        if not all(clip["name"] in candidates and os.path.exists(clip["source"]) for clip in clips):
+            continue
+        if all(_source_stamp(clip["source"]) == {"size": clip["size"], "mtime_ns": clip["mtime_ns"]} for clip in clips):
+            return job
+    return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="合并任务断点记录 / Merge job checkpoints")
+    parser.add_argument("--discard", metavar="ID", help="删除指定任务（ID前缀即可）/ Delete a job (an ID prefix is enough)")
+    parser.add_argument("--prune", action="store_true", help="删除已完成的任务记录 / Delete records of finished jobs")
+    args = parser.parse_args()
+
+    for job in list_jobs():
+        if args.discard and job.id.startswith(args.discard) or args.prune and job.step == "done":
+            job.discard()
+            logger.info(f"已删除任务: {job.id[:12]}")
+        elif not args.discard and not args.prune:
+            states = [clip["state"] for clip in job.data["clips"]]
+            logger.info(f"{job.id[:12]}  {job.step:<11}  {states.count('standardized')}/{len(states)} 已标准化  "
+                        f"{job.data['created']}  {os.path.basename(job.output)}")
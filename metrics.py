@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+流水线运行指标与追踪
+Pipeline run metrics and tracing
+
+每个阶段和每个条目（列表页、帖子下载、片段标准化、拼接、上传步骤）都记录为一个span，包括耗时、字节数、
+重试次数等属性；计数器记录重试和限流等待。每次运行写一个JSON行文件，结束时再写一个Prometheus textfile快照
+（可以交给node_exporter的textfile collector），方便比较不同运行的吞吐量。
+Every stage and every item (listing page, post download, clip standardize, concat, upload step) is
+recorded as a span with duration, bytes, retries and other attributes; counters track retries and
+rate-limit waits. Each run writes one JSON-lines file and, when it ends, a Prometheus textfile snapshot
+(for node_exporter's textfile collector) so throughput can be compared across runs.
+
+用法 / Usage:
+    metrics.start_run("pipeline")
+    with metrics.span("merge.concat", clips=12) as s:
+        ...
+        s.set(bytes=os.path.getsize(output))
+    metrics.incr("retries", stage="download")
+    metrics.end_run()
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+import itertools
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_DIR = os.path.join("logs", "metrics")  # 每次运行的JSON行文件 / Per-run JSON-lines files
+PROM_FILE = os.path.join(METRICS_DIR, "pipeline.prom")  # Prometheus textfile快照 / Prometheus textfile snapshot
+PROM_PREFIX = "pipeline"  # 指标名前缀 / Metric name prefix
+
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+_run = {"id": None, "name": None, "file": None, "start": None}
+_span_totals = {}  # span名 -> 汇总 / span name -> totals
+_counters = {}  # (计数器名, 标签) -> 值 / (counter name, labels) -> value
+
+
+class Span:
+    """一个正在进行的span，可以在with块中补充属性或把status改为"error"
+    A span in progress; attributes can be added, or status set to "error", inside the with block"""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.id = next(_ids)
+        self.attrs = dict(attrs)
+        self.status = "ok"
+
+    def set(self, **attrs):
+        """设置属性 / Set attributes"""
+        self.attrs.update(attrs)
+
+    def add(self, key, value=1):
+        """累加一个数值属性，如retries / Accumulate a numeric attribute such as retries"""
+        self.attrs[key] = self.attrs.get(key, 0) + value
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _ensure_run():
+    """没有调用start_run时自动开始一次运行 / Start a run automatically if start_run was not called"""
+    if _run["id"] is None:
+        start_run()
+    return _run["id"]
+
+
+def _emit(record):
+    """追加一条记录到本次运行的JSON行文件
+    Append one record to this run's JSON-lines file"""
+    with _lock:
+        with open(_run["file"], "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+
+def start_run(name="pipeline"):
+    """开始一次运行，之后的span和计数器都写入这次运行的文件
+    Start a run; later spans and counters go to this run's file"""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    run_id = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+    with _lock:
+        _run.update(id=run_id, name=name, file=os.path.join(METRICS_DIR, f"{run_id}.jsonl"), start=time.time())
+        _span_totals.clear()
+        _counters.clear()
+    _emit({"type": "run_start", "run": run_id, "time": _run["start"]})
+    return run_id
+
+
+def end_run(status="ok"):
+    """结束本次运行并写Prometheus快照
+    End the run and write the Prometheus snapshot"""
+    if _run["id"] is None:
+        return
+    _emit({"type": "run_end", "run": _run["id"], "status": status, "duration": round(time.time() - _run["start"], 3)})
+    write_prometheus()
+    _run["id"] = None
+
+
+def record_span(name, duration, status="ok", parent=None, **attrs):
+    """记录一个已经计时完成的span
+    Record a span whose duration was already measured"""
+    if parent is None and _stack():
+        parent = _stack()[-1].id
+    span_id = next(_ids)
+    _emit({
+        "type": "span", "run": _ensure_run(), "name": name, "id": span_id, "parent": parent,
+        "thread": threading.current_thread().name, "end": time.time(),
+        "duration": round(duration, 4), "status": status, "attrs": attrs,
+    })
+    with _lock:
+        totals = _span_totals.setdefault(name, {"count": 0, "seconds": 0.0, "errors": 0, "bytes": 0})
+        totals["count"] += 1
+        totals["seconds"] += duration
+        totals["errors"] += status != "ok"
+        if isinstance(attrs.get("bytes"), (int, float)):
+            totals["bytes"] += attrs["bytes"]
+    return span_id
+
+
+@contextmanager
+def span(name, **attrs):
+    """计时一个阶段或条目，嵌套的span会记录父span
+    Time a stage or item; nested spans record their parent
+
+    with块中抛出异常时状态为error，异常继续向外抛出 / If the block raises, the status is error and the exception propagates
+    """
+    stack = _stack()
+    current = Span(name, attrs)
+    parent = stack[-1].id if stack else None
+    stack.append(current)
+    start = time.time()
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attrs.setdefault("error", str(e)[:200])
+        raise
+    finally:
+        stack.pop()
+        record_span(name, time.time() - start, current.status, parent=parent, **current.attrs)
+
+
+def incr(name, value=1, **labels):
+    """累加一个计数器，如retries、rate_limit_wait_seconds
+    Increment a counter such as retries or rate_limit_wait_seconds"""
+    run_id = _ensure_run()
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _emit({"type": "counter", "run": run_id, "name": name, "value": value, "labels": labels, "time": time.time()})
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in pairs
+    ) + "}"
+
+
+def write_prometheus():
+    """把本次运行的汇总写成Prometheus textfile格式（原子替换）
+    Write this run's totals in Prometheus textfile format (atomic replace)"""
+    with _lock:
+        totals = {name: dict(values) for name, values in _span_totals.items()}
+        counters = dict(_counters)
+    run_labels = _labels([("run", _run["name"])])
+    lines = [
+        f"# HELP {PROM_PREFIX}_run_timestamp_seconds 最近一次运行的开始时间 / Start time of the latest run",
+        f"# TYPE {PROM_PREFIX}_run_timestamp_seconds gauge",
+        f"{PROM_PREFIX}_run_timestamp_seconds{run_labels} {_run['start']:.3f}",
+        f"# TYPE {PROM_PREFIX}_run_duration_seconds gauge",
+        f"{PROM_PREFIX}_run_duration_seconds{run_labels} {time.time() - _run['start']:.3f}",
+    ]
+    for metric, key in (("span_seconds", "seconds"), ("span_count", "count"), ("span_errors", "errors"), ("span_bytes", "bytes")):
+        lines.append(f"# TYPE {PROM_PREFIX}_{metric} gauge")
+        for name in sorted(totals):
+            lines.append(f"{PROM_PREFIX}_{metric}{_labels([('span', name)])} {totals[name][key]}")
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {PROM_PREFIX}_{name} gauge")
+        for (counter, labels), value in sorted(counters.items()):
+            if counter == name:
+                lines.append(f"{PROM_PREFIX}_{name}{_labels(list(labels))} {value}")
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    tmp_file = PROM_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, PROM_FILE)
+
+
+# 进程意外退出时也写出快照 / Write the snapshot even if the process exits unexpectedly
+atexit.register(lambda: end_run("exit") if _run["id"] else None)
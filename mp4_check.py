@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+MP4结构快速检查
+Fast structural MP4 check
+
+只读取ISO-BMFF的盒子头（ftyp、moov、mdat大小、轨道数、mvhd时长、faststart顺序），不解码，
+每个文件只需几次小的读取。上传前和合并前用它拦截损坏或截断的文件，并移到隔离目录。
+Reads only ISO-BMFF box headers (ftyp, moov and mdat sizes, track count, mvhd duration,
+faststart ordering) without decoding, a few small reads per file. It gates uploads and merges
+so broken or truncated files are moved to quarantine immediately.
+
+分片MP4（moov里有mvex）的mvhd时长通常为0，时长取mvex/mehd，没有mehd时只要求至少有一个moof分片。
+Fragmented MP4 (mvex inside moov) usually has a zero mvhd duration, so the duration comes from
+mvex/mehd, and without mehd at least one moof fragment is required instead.
+"""
+
+import os
+import shutil
+import struct
+from datetime import datetime
+
+from log_setup import get_logger
+
+logger = get_logger("check")
+
+QUARANTINE_DIR = "quarantine"  # 隔离目录 / Quarantine directory
+QUARANTINE_LOG = os.path.join(QUARANTINE_DIR, "quarantine.log")  # 隔离记录 / Quarantine records
+
+
+def iter_boxes(f, start, end):
+    """遍历[start, end)范围内的盒子，返回(类型, 盒子起点, 内容起点, 盒子终点)
+    Iterate boxes in [start, end), yielding (type, box start, payload start, box end)
+
+    盒子超出范围时抛出ValueError（文件被截断）/ Raises ValueError when a box runs past the range (truncated file)
+    """
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError(f"盒子头不完整 @ {offset} / incomplete box header")
+        size, box_type = struct.unpack(">I4s", header)
+        payload = offset + 8
+        if size == 1:
+            large = f.read(8)
+            if len(large) < 8:
+                raise ValueError(f"盒子头不完整 @ {offset} / incomplete box header")
+            size = struct.unpack(">Q", large)[0]
+            payload += 8
+        elif size == 0:
+            size = end - offset  # 延伸到文件末尾 / Extends to the end of the file
+        if size < payload - offset:
+            raise ValueError(f"盒子大小无效: {box_type!r} @ {offset} / invalid box size")
+        if offset + size > end:
+            raise ValueError(
+                f"{box_type.decode('latin-1')} 盒子被截断，需要 {offset + size} 字节，只有 {end} 字节 / box truncated")
+        yield box_type, offset, payload, offset + size
+        offset += size
+
+
+def read_mvhd(f, payload):
+    """读取mvhd中的时间刻度和时长
+    Read timescale and duration from mvhd
+
+    Returns:
+        (timescale, duration) 原始单位 / in raw units
+    """
+    f.seek(payload)
+    version = f.read(4)[0]
+    if version == 1:
+        _, _, timescale, duration = struct.unpack(">QQIQ", f.read(28))
+    else:
+        _, _, timescale, duration = struct.unpack(">IIII", f.read(16))
+    return timescale, duration
+
+
+def read_mehd(f, payload):
+    """读取mehd中的分片总时长（mvhd的时间刻度）
+    Read the overall fragment duration from mehd (in the mvhd timescale)"""
+    f.seek(payload)
+    version = f.read(4)[0]
+    return struct.unpack(">Q", f.read(8))[0] if version == 1 else struct.unpack(">I", f.read(4))[0]
+
+
+def inspect_mp4(path):
+    """读取MP4的结构信息
+    Read the structural summary of an MP4
+
+    Returns:
+        dict: brand、各顶层盒子位置、轨道数、时长、是否faststart、是否分片及moof数
+              brand, top-level box offsets, track count, duration, faststart flag, fragmented flag and moof count
+
+    Raises:
+        ValueError: 结构损坏 / The structure is broken
+    """
+    file_size = os.path.getsize(path)
+    info = {
+        "size": file_size, "brand": None, "moov_offset": None, "moov_size": 0,
+        "mdat_offset": None, "mdat_size": 0, "tracks": 0, "duration": None, "faststart": False,
+        "fragmented": False, "fragments": 0,
+    }
+    with open(path, "rb") as f:
+        for box_type, start, payload, end in iter_boxes(f, 0, file_size):
+            if box_type == b"ftyp":
+                f.seek(payload)
+                info["brand"] = f.read(4).decode("latin-1")
+            elif box_type == b"moov":
+                info["moov_offset"], info["moov_size"] = start, end - start
+                timescale, fragment_duration = 0, 0
+                for child, _, child_payload, child_end in iter_boxes(f, payload, end):
+                    if child == b"mvhd":
+                        timescale, duration = read_mvhd(f, child_payload)
+                        if timescale:
+                            info["duration"] = duration / timescale
+                    elif child == b"trak":
+                        info["tracks"] += 1
+                    elif child == b"mvex":
+                        info["fragmented"] = True
+                        for grandchild, _, grandchild_payload, _ in iter_boxes(f, child_payload, child_end):
+                            if grandchild == b"mehd":
+                                fragment_duration = read_mehd(f, grandchild_payload)
+                if not info["duration"] and fragment_duration and timescale:
+                    info["duration"] = fragment_duration / timescale
+            elif box_type == b"moof":
+                info["fragments"] += 1
+            elif box_type == b"mdat":
+                # 只记录第一个mdat / Only the first mdat is recorded
+                if info["mdat_offset"] is None:
+                    info["mdat_offset"], info["mdat_size"] = start, end - start
+
+    if info["moov_offset"] is not None and info["mdat_offset"] is not None:
+        info["faststart"] = info["moov_offset"] < info["mdat_offset"]
+    return info
+
+
+def check_mp4(path, require_faststart=False):
+    """检查MP4结构是否完整
+    Check that an MP4 is structurally complete
+
+    Returns:
+        (ok, reason, info): 是否通过、失败原因、结构信息 / Whether it passed, why not, and the structure summary
+    """
+    try:
+        info = inspect_mp4(path)
+    except (OSError, ValueError, struct.error, IndexError) as e:
+        return False, str(e), None
+
+    if info["brand"] is None:
+        return False, "缺少ftyp盒子 / missing ftyp box", info
+    if info["moov_offset"] is None:
+        return False, "缺少moov盒子（文件可能未写完）/ missing moov box", info
+    if info["mdat_offset"] is None or info["mdat_size"] <= 8:
+        return False, "缺少媒体数据 / missing or empty mdat box", info
+    if info["tracks"] == 0:
+        return False, "没有轨道 / no tracks", info
+    if info["fragmented"] and not info["duration"]:
+        # 没有mehd的分片文件只能靠moof判断是否有媒体 / Without mehd a fragmented file only has its moofs to go by
+        if not info["fragments"]:
+            return False, "分片MP4没有moof分片 / fragmented MP4 without moof fragments", info
+    elif not info["duration"]:
+        return False, "时长为0 / zero duration", info
+    if require_faststart and not info["faststart"]:
+        return False, "moov位于mdat之后（不是faststart）/ moov after mdat (not faststart)", info
+    return True, "", info
+
+
+def quarantine(path, reason):
+    """把损坏的文件移到隔离目录并记录原因
+    Move a broken file to the quarantine directory and record why
+
+    Returns:
+        隔离后的路径 / The quarantined path
+    """
+    os.makedirs(QUARANTINE_DIR, exist_ok=True)
+    target = os.path.join(QUARANTINE_DIR, os.path.basename(path))
+    if os.path.exists(target):
+        name, ext = os.path.splitext(os.path.basename(path))
+        target = os.path.join(QUARANTINE_DIR, f"{name}_{datetime.now().strftime('%Y%m%d%H%M%S')}{ext}")
+    shutil.move(path, target)
+    with open(QUARANTINE_LOG, "a", encoding="utf-8") as f:
+        f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\t{path}\t{reason}\n")
+    logger.warning(f"⚠️ 文件结构损坏，已隔离: {os.path.basename(path)} ({reason})")
+    return target
+
+
+def gate_files(paths, require_faststart=False):
+    """检查一组文件，损坏的移到隔离目录
+    Check a list of files, quarantining broken ones
+
+    Returns:
+        通过检查的路径列表（保持原顺序）/ Paths that passed, in their original order
+    """
+    passed = []
+    for path in paths:
+        ok, reason, _ = check_mp4(path, require_faststart)
+        if ok:
+            passed.append(path)
+        else:
+            quarantine(path, reason)
+    return passed
+
+
+if __name__ == "__main__":
+    import sys
+    import glob
+
+    targets = []
+    for arg in sys.argv[1:] or ["."]:
+        targets += sorted(glob.glob(os.path.join(arg, "*.mp4"))) if os.path.isdir(arg) else [arg]
+    failures = 0
+    for target_path in targets:
+        passed, why, summary = check_mp4(target_path)
+        if passed:
+            duration = f"{summary['duration']:.2f}" if summary["duration"] else "?"
+            logger.info(f"✅ {target_path}: {duration}秒, {summary['tracks']} 轨道, "
+                  f"faststart={'是' if summary['faststart'] else '否'}")
+        else:
+            failures += 1
+            logger.error(f"❌ {target_path}: {why}")
+    sys.exit(1 if failures else 0)
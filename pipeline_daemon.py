@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+下载、合并、上传流水线的常驻调度进程
+Long-running scheduler for the download / merge / upload pipeline
+
+替代cron定时执行test_main.py -a：模块只导入一次，登录用户、已合并记录、片段时长和上传浏览器都常驻内存，
+在多次循环之间复用。内部调度规则：
+    - 每隔DOWNLOAD_INTERVAL分钟下载一次新视频
+    - 未合并片段的总时长达到MERGE_MIN_SECONDS后合并
+    - 每天在UPLOAD_TIMES的时间点上传本进程合并出、尚未上传的视频（通过upload_daemon的队列和常驻浏览器）；
+      合并目录里以前的视频不会被自动上传，PIPELINE_UPLOAD_DRY_RUN=1时只记录不上传
+    - 设置了PIPELINE_RETENTION_INTERVAL时，每隔这么多秒在后台线程里执行一次保留策略（retention.py）；
+      保留策略会删除和归档文件，默认关闭
+收到SIGINT/SIGTERM后完成当前步骤再退出。
+Replaces running test_main.py -a from cron: modules are imported once, and the logged-in user, the
+merged-clip records, clip durations and the upload browser stay in memory between cycles. Schedule:
+    - download new videos every DOWNLOAD_INTERVAL minutes
+    - merge once the unmerged footage reaches MERGE_MIN_SECONDS
+    - at each UPLOAD_TIMES slot, upload the videos this daemon merged that are not uploaded yet (via the
+      upload_daemon queue and warm browser); older videos in the merged directory are never uploaded
+      automatically, and PIPELINE_UPLOAD_DRY_RUN=1 only logs what would be published
+    - if PIPELINE_RETENTION_INTERVAL is set, apply the retention policies (retention.py) that often on a
+      background thread; retention deletes and archives files, so it is off by default
+On SIGINT/SIGTERM the current step finishes and the daemon exits.
+
+存在pipelines.json时改为多租户模式：每个流水线在自己的线程里按自己的调度运行，路径、会话、频道都互相隔离，
+标准化任务提交到共享的FairShareExecutor。
+If pipelines.json exists the daemon runs in multi-tenant mode: each pipeline runs its own schedule in
+its own thread with isolated paths, session and channel, and standardization jobs go to a shared
+FairShareExecutor.
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import metrics
+from log_setup import get_logger
+
+logger = get_logger("daemon")
+
+DOWNLOAD_INTERVAL = float(os.environ.get("PIPELINE_DOWNLOAD_INTERVAL", 60))  # 下载间隔（分钟）/ Download interval (minutes)
+MERGE_MIN_SECONDS = float(os.environ.get("PIPELINE_MERGE_MIN_SECONDS", 600))  # 触发合并的素材总时长（秒）/ Footage that triggers a merge (seconds)
+UPLOAD_TIMES = os.environ.get("PIPELINE_UPLOAD_TIMES", "12:00,20:00")  # 每天的上传时间 / Daily upload times
+TICK_SECONDS = 30  # 调度检查间隔（秒）/ Scheduler check interval (seconds)
+MERGE_RETRY_DELAY = 600  # 合并失败后再次尝试前的等待（秒）/ Wait before retrying a failed merge (seconds)
+RETENTION_INTERVAL = float(os.environ.get("PIPELINE_RETENTION_INTERVAL", 0))  # 保留策略执行间隔（秒），默认0即关闭 / Retention interval (seconds), 0 (the default) disables it
+UPLOAD_DRY_RUN = os.environ.get("PIPELINE_UPLOAD_DRY_RUN") == "1"  # 只记录要上传的视频，不发布 / Only log what would be uploaded, don't publish
+STATE_FILE = os.path.join("test_logs", "pipeline_state.json")  # 调度状态，重启后不会重复执行 / Schedule state, so restarts don't repeat work
+
+
+def parse_upload_times(value):
+    """解析"12:00,20:00"格式的上传时间
+    Parse upload times like "12:00,20:00\""""
+    slots = []
+    for part in (value or "").split(","):
+        part = part.strip()
+        if part:
+            hour, minute = part.split(":")
+            slots.append((int(hour), int(minute)))
+    return sorted(slots)
+
+
+class PipelineState:
+    """在多次循环之间常驻内存的状态
+    State kept warm in memory between cycles
+
+    Args:
+        pipeline: 可选，pipelines.Pipeline；为None时使用单租户的默认目录和全局调度设置
+                  Optional pipelines.Pipeline; None uses the single-tenant default directories and global schedule
+        executor: 可选，多租户共享的FairShareExecutor / Optional FairShareExecutor shared by the tenants
+    """
+
+    def __init__(self, pipeline=None, executor=None):
+        from test_merge import DOWNLOADS_DIR, MERGED_DIR, LOG_DIR, LOG_FILE
+
+        self.pipeline = pipeline
+        self.executor = executor
+        self.name = pipeline.name if pipeline else None
+        self.labels = {"tenant": pipeline.name} if pipeline else {}  # 指标中的租户标签 / Tenant label for metrics
+        self.logger = get_logger(f"daemon.{pipeline.name}") if pipeline else logger
+        self.state_file = pipeline.state_file if pipeline else STATE_FILE
+        self.downloads_dir = pipeline.downloads_dir if pipeline else DOWNLOADS_DIR
+        self.merged_dir = pipeline.merged_dir if pipeline else MERGED_DIR
+        self.merge_log = pipeline.merge_log if pipeline else LOG_FILE
+        self.uploaded_log = pipeline.channel["uploaded_log"] if pipeline else os.path.join(LOG_DIR, "uploaded.log")
+        self.slots = parse_upload_times(pipeline.upload_times if pipeline and pipeline.upload_times else UPLOAD_TIMES)
+        self.download_interval = float(pipeline.download_interval or DOWNLOAD_INTERVAL) if pipeline else DOWNLOAD_INTERVAL
+        self.merge_min_seconds = float(pipeline.merge_min_seconds or MERGE_MIN_SECONDS) if pipeline else MERGE_MIN_SECONDS
+        self.username = pipeline.ig_username if pipeline else None
+        self.browser = None
+        self.durations = {}  # (路径, 修改时间) -> 时长 / (path, mtime) -> duration
+        self.merged = set()
+        self.merged_mtime = None
+        self.merge_retry_after = 0
+        self.retention_thread = None  # 正在运行的保留策略线程 / Retention thread in progress
+        self.schedule = self._load_schedule()
+
+    def _load_schedule(self):
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {"last_download": 0, "last_upload_slot": None, "produced": []}
+
+    def save_schedule(self):
+        """原子地写入调度状态
+        Atomically write the schedule state"""
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.schedule, f)
+        os.replace(tmp_file, self.state_file)
+
+    def merged_clips(self):
+        """已合并的片段名，只有merged.log变化时才重新读取
+        Names of merged clips, re-read only when merged.log changes"""
+        mtime = os.path.getmtime(self.merge_log) if os.path.exists(self.merge_log) else None
+        if mtime != self.merged_mtime:
+            self.merged = set()
+            if mtime is not None:
+                with open(self.merge_log, "r", encoding="utf-8") as f:
+                    self.merged = set(line.strip() for line in f)
+            self.merged_mtime = mtime
+        return self.merged
+
+    def unmerged_footage(self):
+        """未合并片段的数量和总时长（秒），时长按文件缓存
+        Count and total duration (seconds) of unmerged clips, durations cached per file"""
+        from test_duration import get_video_duration_native
+
+        if not os.path.isdir(self.downloads_dir):
+            return 0, 0.0
+        merged = self.merged_clips()
+        count, total = 0, 0.0
+        for name in os.listdir(self.downloads_dir):
+            if not name.endswith(".mp4") or name in merged:
+                continue
+            path = os.path.join(self.downloads_dir, name)
+            key = (path, os.path.getmtime(path))
+            if key not in self.durations:
+                self.durations[key] = get_video_duration_native(path) or 0.0
+            count += 1
+            total += self.durations[key]
+        return count, total
+
+
+@contextmanager
+def metrics_run(state):
+    """单租户时每个步骤是一次独立的指标运行；多租户时共用守护进程的运行，span带租户标签
+    Single tenant: each step is its own metrics run; multi-tenant: steps share the daemon's run and spans carry the tenant"""
+    if state.pipeline is None:
+        metrics.start_run("daemon")
+    try:
+        yield
+    finally:
+        if state.pipeline is None:
+            metrics.end_run()
+
+
+def run_download(state):
+    """下载新视频，登录用户只确认一次
+    Download new videos, resolving the logged-in user only once"""
+    from test_login import ensure_logged_in_user
+    from test_download import download_saved_videos
+
+    if not state.username:
+        state.username = ensure_logged_in_user()
+    if not state.username:
+        state.logger.info("未找到已登录用户，跳过下载")
+        return 0
+    from session_manager import get_manager
+
+    pipeline = state.pipeline
+    with metrics.span("stage.download", **state.labels) as span:
+        # 验证结果有缓存，Instaloader在多次循环之间共享 / Validation is cached and the Instaloader is shared across cycles
+        if pipeline:
+            loader = get_manager(state.username, pipeline.session_file).get_loader()
+            count = download_saved_videos(state.username, loader=loader, target_dir=pipeline.downloads_dir,
+                                          log_file=pipeline.download_log, session_path=pipeline.session_file)
+        else:
+            count = download_saved_videos(state.username, loader=get_manager(state.username).get_loader())
+        span.set(downloaded=count)
+    return count
+
+
+def run_merge(state):
+    """合并所有未合并的片段
+    Merge every unmerged clip"""
+    from test_merge import merge_specific_videos
+
+    pipeline = state.pipeline
+    with metrics.span("stage.merge", **state.labels) as span:
+        if pipeline:
+            output_path, count = merge_specific_videos(
+                pipeline.downloads_dir, merged_dir=pipeline.merged_dir, temp_dir=pipeline.temp_dir,
+                merge_log=pipeline.merge_log, executor=state.executor, tenant=pipeline.name, **pipeline.merge_options,
+            )
+        else:
+            output_path, count = merge_specific_videos()
+        span.status = "ok" if output_path else "error"
+        span.set(clips=count)
+    return output_path
+
+
+def is_fresh_output(path):
+    """合并输出是新生成的，而不是merge_cache复用旧结果挂出来的链接（那份内容已经上传过）
+    The merge output was newly produced, not a link to a reused earlier result from merge_cache (that content was already published)"""
+    from merge_cache import load_manifest
+
+    path = os.path.abspath(path)
+    return any(record.get("output") == path for record in load_manifest()["outputs"].values())
+
+
+def record_produced(state, output_path):
+    """记录本进程合并出的视频，只有这些会被自动上传
+    Record a video this daemon merged; only these are uploaded automatically"""
+    if not is_fresh_output(output_path):
+        state.logger.info(f"合并结果复用了已有视频，不加入上传: {os.path.basename(output_path)}")
+        return
+    produced = state.schedule.setdefault("produced", [])
+    if os.path.abspath(output_path) not in produced:
+        produced.append(os.path.abspath(output_path))
+        state.save_schedule()
+
+
+def pending_uploads(state, uploaded):
+    """本进程合并出、还没上传且文件仍在的视频；已上传或已删除的从记录中去掉
+    Videos this daemon merged that are not uploaded yet and still exist; uploaded or deleted ones are dropped from the record"""
+    produced = state.schedule.setdefault("produced", [])
+    pending = [path for path in produced if os.path.exists(path) and os.path.basename(path) not in uploaded]
+    if pending != produced:
+        state.schedule["produced"] = pending
+        state.save_schedule()
+    return pending
+
+
+def run_upload(state, stop_event):
+    """用常驻浏览器上传本进程合并出、尚未上传的视频
+    Upload the videos this daemon merged that are not uploaded yet, with the warm browser"""
+    if state.pipeline:
+        return run_tenant_upload(state, stop_event)
+    from test_upload import load_uploaded
+    from upload_daemon import WarmBrowser, submit_videos, serve
+
+    videos = pending_uploads(state, load_uploaded())
+    if UPLOAD_DRY_RUN:
+        logger.info(f"[dry-run] 将上传 {len(videos)} 个视频: {', '.join(os.path.basename(v) for v in videos) or '无'}")
+        return
+    submitted = submit_videos(videos)
+    logger.info(f"已提交 {submitted} 个待上传视频")
+    if state.browser is None:
+        state.browser = WarmBrowser()
+    with metrics.span("stage.upload", submitted=submitted):
+        serve(stop_event, state.browser, once=True, keep_warm=True)
+
+
+def run_tenant_upload(state, stop_event):
+    """把一个流水线合并出、尚未上传的视频上传到它自己的频道
+    Upload the videos a pipeline merged that are not uploaded yet to its own channel
+
+    全局上传队列和其中的浏览器属于默认频道，所以每个流水线用自己的浏览器配置（或HTTP上传）直接上传。
+    The global upload queue and its browsers belong to the default channel, so each pipeline uploads
+    directly with its own browser profile (or over HTTP).
+    """
+    from test_upload import load_uploaded
+
+    pipeline = state.pipeline
+    videos = pending_uploads(state, load_uploaded(pipeline.channel["uploaded_log"]))
+    if UPLOAD_DRY_RUN:
+        state.logger.info(f"[dry-run] 将上传 {len(videos)} 个视频: {', '.join(os.path.basename(v) for v in videos) or '无'}")
+        return
+    state.logger.info(f"待上传视频 {len(videos)} 个")
+    with metrics.span("stage.upload", submitted=len(videos), **state.labels) as span:
+        for video in videos:
+            if stop_event.is_set():
+                break
+            if pipeline.upload_backend == "http":
+                from http_upload import upload_video_http
+                success, _ = upload_video_http(video, channel=pipeline.channel)
+            else:
+                if state.browser is None:
+                    from upload_daemon import WarmBrowser
+                    state.browser = WarmBrowser(profile_path=pipeline.profile_path, channel=pipeline.channel)
+                success, _ = state.browser.upload(video)
+            span.add("uploaded" if success else "failed")
+
+
+def due_upload_slot(now, slots, last_slot):
+    """返回当前应该执行、且还没执行过的上传时间点
+    Return the upload slot that is due now and has not run yet"""
+    due = None
+    for hour, minute in slots:
+        if (now.hour, now.minute) >= (hour, minute):
+            due = f"{now.strftime('%Y-%m-%d')} {hour:02d}:{minute:02d}"
+    return due if due and due != last_slot else None
+
+
+def run_retention(state):
+    """对这个流水线的下载和合并目录执行保留策略
+    Apply the retention policies to this pipeline's download and merge directories"""
+    import retention
+
+    with metrics.span("stage.retention", **state.labels):
+        return retention.run_retention(state.downloads_dir, state.merged_dir, state.merge_log, state.uploaded_log)
+
+
+def start_retention(state):
+    """在后台线程里执行保留策略，压缩转码不会挡住调度线程的下载、合并和上传；上一次还没结束时不重复启动
+    Apply the retention policies on a background thread so compaction never blocks the scheduling
+    thread's downloads, merges and uploads; nothing starts while the previous run is still going
+
+    Returns:
+        bool: 是否启动了新的线程 / Whether a new thread was started
+    """
+    if state.retention_thread is not None and state.retention_thread.is_alive():
+        return False
+
+    def work():
+        try:
+            run_retention(state)
+        except Exception as e:
+            state.logger.error(f"保留策略出错: {e}")
+
+    name = f"retention-{state.name}" if state.name else "retention"
+    state.retention_thread = threading.Thread(target=work, name=name, daemon=True)
+    state.retention_thread.start()
+    return True
+
+
+def run_cycle(state, stop_event):
+    """检查一次调度规则并执行到期的步骤
+    Check the schedule once and run whatever is due"""
+    now = datetime.now()
+    if time.time() - state.schedule["last_download"] >= state.download_interval * 60:
+        with metrics_run(state):
+            try:
+                run_download(state)
+            except Exception as e:
+                state.logger.error(f"下载出错: {e}")
+            state.schedule["last_download"] = time.time()
+            state.save_schedule()
+
+    if stop_event.is_set():
+        return
+    count, footage = state.unmerged_footage()
+    if count and footage >= state.merge_min_seconds and time.time() >= state.merge_retry_after:
+        state.logger.info(f"未合并素材 {count} 个，共 {footage:.0f} 秒，开始合并")
+        with metrics_run(state):
+            output_path = None
+            try:
+                output_path = run_merge(state)
+                if output_path:
+                    record_produced(state, output_path)
+            except Exception as e:
+                state.logger.error(f"合并出错: {e}")
+            if not output_path:
+                state.merge_retry_after = time.time() + MERGE_RETRY_DELAY
+
+    if stop_event.is_set():
+        return
+    slot = due_upload_slot(now, state.slots, state.schedule.get("last_upload_slot"))
+    if slot:
+        state.logger.info(f"到达上传时间: {slot}")
+        with metrics_run(state):
+            try:
+                run_upload(state, stop_event)
+            except Exception as e:
+                state.logger.error(f"上传出错: {e}")
+            state.schedule["last_upload_slot"] = slot
+            state.save_schedule()
+
+    if stop_event.is_set() or not RETENTION_INTERVAL:
+        return
+    if time.time() - state.schedule.get("last_retention", 0) >= RETENTION_INTERVAL and start_retention(state):
+        state.schedule["last_retention"] = time.time()
+        state.save_schedule()
+
+
+def run_loop(state, stop_event):
+    """运行一个流水线的调度循环直到收到停止信号
+    Run one pipeline's scheduling loop until stopped"""
+    state.logger.info(f"每 {state.download_interval:.0f} 分钟下载，素材达到 {state.merge_min_seconds:.0f} 秒时合并，"
+                      f"上传时间 {', '.join(f'{h:02d}:{m:02d}' for h, m in state.slots) or '无'}")
+    try:
+        while not stop_event.is_set():
+            run_cycle(state, stop_event)
+            stop_event.wait(TICK_SECONDS)
+    finally:
+        if state.retention_thread is not None:
+            # 等正在进行的保留策略结束，不留下写了一半的文件 / Wait for a running retention pass so no file is left half-written
+            state.retention_thread.join()
+        if state.browser is not None:
+            state.browser.recycle()
+
+
+def run_daemon(stop_event=None, pipelines_file=None):
+    """运行调度循环直到收到停止信号；有流水线配置时每个流水线一个线程
+    Run the scheduling loop until stopped; with a pipeline config, one thread per pipeline
+
+    Args:
+        pipelines_file: 可选，流水线配置文件，默认PIPELINES_FILE存在时使用它 / Optional pipeline config, defaults to PIPELINES_FILE if it exists
+    """
+    from upload_daemon import install_signal_handlers
+    from pipelines import PIPELINES_FILE
+
+    stop_event = stop_event or threading.Event()
+    install_signal_handlers(stop_event)
+    pipelines_file = pipelines_file or (PIPELINES_FILE if os.path.exists(PIPELINES_FILE) else None)
+    if not pipelines_file:
+        logger.info("流水线守护进程已启动")
+        try:
+            run_loop(PipelineState(), stop_event)
+        finally:
+            logger.info("流水线守护进程已退出")
+        return
+    run_tenants(pipelines_file, stop_event)
+
+
+def run_tenants(pipelines_file, stop_event):
+    """在一个进程里运行配置中的所有流水线，标准化任务共享一个公平调度的编码线程池
+    Run every configured pipeline in one process, sharing one fair-share encode pool for standardization"""
+    from pipelines import load_pipelines
+    from encode_scheduler import FairShareExecutor
+
+    pipelines, encode_workers = load_pipelines(pipelines_file)
+    if not pipelines:
+        logger.error(f"❌ {pipelines_file} 中没有配置流水线")
+        return
+    executor = FairShareExecutor(encode_workers, {pipeline.name: pipeline.weight for pipeline in pipelines})
+    logger.info(f"流水线守护进程已启动：{len(pipelines)} 个流水线，共享 {encode_workers} 个编码线程")
+    metrics.start_run("daemon")
+    threads = []
+    for pipeline in pipelines:
+        pipeline.ensure_dirs()
+        state = PipelineState(pipeline, executor)
+        thread = threading.Thread(target=run_loop, args=(state, stop_event), name=f"pipeline-{pipeline.name}")
+        thread.start()
+        threads.append(thread)
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        executor.shutdown()
+        metrics.end_run()
+        logger.info("流水线守护进程已退出")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="流水线守护进程 / Pipeline daemon")
+    parser.add_argument("--pipelines", help="流水线配置文件，默认pipelines.json / Pipeline config file, defaults to pipelines.json")
+    args = parser.parse_args()
+    run_daemon(pipelines_file=args.pipelines)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+多租户流水线配置：一个进程运行多个命名流水线（IG来源账号 -> B站频道）
+Multi-tenant pipeline configuration: one process hosts several named pipelines (IG source -> Bilibili channel)
+
+每个流水线有自己的目录（pipelines/<名称>/下的下载、合并、临时文件和日志）、Instagram会话、浏览器配置、
+标题前缀和序列号文件，互不干扰；所有流水线的标准化任务共享同一个编码线程池（encode_scheduler.FairShareExecutor），
+按weight公平分配。
+Each pipeline has its own directories (downloads, merged output, temp files and logs under
+pipelines/<name>/), Instagram session, browser profile, title prefix and serial file, so they never
+interfere; the standardization jobs of every pipeline share one encode pool
+(encode_scheduler.FairShareExecutor), shared fairly by weight.
+
+pipelines.json示例 / Example pipelines.json:
+    {
+        "encode_workers": 4,
+        "pipelines": [
+            {"name": "funny", "ig_username": "source_a", "title_prefix": "海外离大谱#", "weight": 2},
+            {"name": "pets", "ig_username": "source_b", "title_prefix": "萌宠日常#",
+             "upload_times": "18:00", "upload_backend": "http"}
+        ]
+    }
+除name和ig_username外都可以省略；路径类的键（downloads_dir、merged_dir、profile_path、session_file等）
+也可以单独覆盖。
+Everything except name and ig_username is optional; path keys (downloads_dir, merged_dir,
+profile_path, session_file, ...) can be overridden individually.
+"""
+
+import os
+import re
+import json
+
+PIPELINES_FILE = os.environ.get("PIPELINES_FILE", "pipelines.json")  # 流水线配置文件 / Pipeline config file
+PIPELINES_ROOT = "pipelines"  # 每个流水线的目录都在这里 / Every pipeline's directory lives here
+ENCODE_WORKERS = int(os.environ.get("PIPELINE_ENCODE_WORKERS", max(1, (os.cpu_count() or 2) // 4)))  # 共享编码线程数 / Shared encode workers
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")  # 流水线名只能用作目录名的字符 / Pipeline names must be safe directory names
+
+
+class Pipeline:
+    """一个命名流水线的设置，路径都在自己的目录下
+    Settings of one named pipeline, with every path in its own directory"""
+
+    def __init__(self, config):
+        name = config.get("name", "")
+        if not NAME_PATTERN.match(name):
+            raise ValueError(f"流水线名称无效: {name!r}")
+        if not config.get("ig_username"):
+            raise ValueError(f"流水线 {name} 缺少ig_username")
+        root = config.get("root") or os.path.join(PIPELINES_ROOT, name)
+        log_dir = config.get("log_dir") or os.path.join(root, "logs")
+
+        self.name = name
+        self.ig_username = config["ig_username"]
+        self.root = root
+        self.weight = float(config.get("weight", 1.0))
+        self.downloads_dir = config.get("downloads_dir") or os.path.join(root, "downloads")
+        self.merged_dir = config.get("merged_dir") or os.path.join(root, "merged")
+        self.temp_dir = config.get("temp_dir") or os.path.join(root, "temp")
+        self.log_dir = log_dir
+        self.download_log = os.path.join(log_dir, "downloaded.log")
+        self.merge_log = os.path.join(log_dir, "merged.log")
+        self.state_file = os.path.join(log_dir, "pipeline_state.json")
+        self.session_file = config.get("session_file") or os.path.join(root, f"session-{self.ig_username}")
+        self.profile_path = config.get("profile_path") or os.path.abspath(os.path.join(root, "selenium_profile"))
+        self.upload_backend = config.get("upload_backend", "selenium")
+        self.upload_times = config.get("upload_times")
+        self.download_interval = config.get("download_interval")
+        self.merge_min_seconds = config.get("merge_min_seconds")
+        self.merge_options = config.get("merge_options", {})  # 传给merge_specific_videos的参数 / Extra merge_specific_videos arguments
+        self.channel = {
+            "title_prefix": config.get("title_prefix", ""),
+            "serial_file": config.get("serial_file") or os.path.join(root, "serial_number.txt"),
+            "uploaded_log": os.path.join(log_dir, "uploaded.log"),
+            "profile_path": self.profile_path,
+            "cookie_file": config.get("cookie_file") or os.path.join(root, "bilibili_cookies.json"),
+        }
+
+    def ensure_dirs(self):
+        """创建流水线的目录 / Create the pipeline's directories"""
+        for folder in (self.downloads_dir, self.merged_dir, self.temp_dir, self.log_dir):
+            os.makedirs(folder, exist_ok=True)
+
+
+def load_pipelines(path=PIPELINES_FILE):
+    """读取流水线配置
+    Load the pipeline configuration
+
+    Returns:
+        (pipelines, encode_workers): Pipeline列表和共享编码线程数 / List of Pipeline and the shared encode worker count
+
+    Raises:
+        ValueError: 配置无效（名称重复、缺少必填项等）/ Invalid configuration (duplicate names, missing keys, ...)
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    pipelines = [Pipeline(config) for config in data.get("pipelines", [])]
+    names = [pipeline.name for pipeline in pipelines]
+    if len(set(names)) != len(names):
+        raise ValueError(f"流水线名称重复: {names}")
+    return pipelines, int(data.get("encode_workers", ENCODE_WORKERS))
+
+
+if __name__ == "__main__":
+    from log_setup import get_logger
+
+    logger = get_logger("daemon")
+    pipelines, workers = load_pipelines()
+    logger.info(f"共享编码线程: {workers}")
+    for pipeline in pipelines:
+        logger.info(f"{pipeline.name}: {pipeline.ig_username} -> {pipeline.channel['title_prefix'] or '(无标题前缀)'}  "
+                    f"权重 {pipeline.weight:g}  目录 {pipeline.root}")
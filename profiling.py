@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+命令行入口的性能分析
+Profiling hooks for the CLI entry points
+
+各个入口（test_main、test_merge、fix_merge、fix_concat、test_download）加上--profile后，每个阶段都在分析器下运行，
+在logs/profiles/下写出分析文件和一份简短的热点摘要：
+    - cprofile（默认）：确定性分析，只覆盖调用线程，写.prof文件（可用pstats或snakeviz查看）
+    - sample：每隔SAMPLE_INTERVAL秒对所有线程采样，开销小，也能看到线程池里的工作，写.folded文件（可用flamegraph.pl生成火焰图）
+子进程（ffmpeg/ffprobe）的用时通过ffmpeg_supervisor的资源记录单独统计，和Python自身的CPU时间分开，
+摘要中还有两者之外的等待时间。
+With --profile each entry point (test_main, test_merge, fix_merge, fix_concat, test_download) runs
+every stage under a profiler and writes a profile file plus a short hotspot summary to logs/profiles/:
+    - cprofile (default): deterministic, covers only the calling thread, writes a .prof file (pstats, snakeviz)
+    - sample: samples every thread each SAMPLE_INTERVAL seconds, low overhead and sees work in thread
+      pools, writes a .folded file (flamegraph.pl)
+Time spent in child processes (ffmpeg/ffprobe) is collected separately from ffmpeg_supervisor's
+usage records, apart from Python's own CPU time; the summary also shows the waiting time left over.
+"""
+
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from log_setup import get_logger
+
+logger = get_logger("profile")
+
+PROFILE_DIR = os.path.join("logs", "profiles")  # 分析文件和摘要目录 / Directory for profiles and summaries
+PROFILE_MODES = ("cprofile", "sample")  # 支持的分析方式 / Supported profiling modes
+TOP_N = int(os.environ.get("PROFILE_TOP_N", 20))  # 摘要中列出的热点数 / Hotspots listed in the summary
+SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))  # 采样间隔（秒）/ Sampling interval (seconds)
+
+_state = {"mode": None, "session": None}
+
+
+class ChildUsage:
+    """汇总分析期间的子进程资源占用（来自ffmpeg_supervisor的记录）
+    Aggregates child process usage during profiling (from ffmpeg_supervisor's records)"""
+
+    def __init__(self):
+        self.programs = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            totals = self.programs.setdefault(record.get("program") or "?", {"count": 0, "wall": 0.0, "cpu": 0.0})
+            totals["count"] += 1
+            totals["wall"] += record.get("wall", 0.0)
+            totals["cpu"] += record.get("user_cpu", 0.0) + record.get("sys_cpu", 0.0)
+
+
+class Sampler:
+    """对所有线程定时采样调用栈的分析器
+    Profiler that periodically samples the call stacks of every thread"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}  # 折叠的调用栈 -> 样本数 / Folded stack -> samples
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+
+    def write(self, path):
+        """写出flamegraph.pl使用的折叠格式 / Write the folded format used by flamegraph.pl"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+
+    def hotspots(self, top_n):
+        """按自身样本和累计样本排序的热点函数 / Hotspot functions by self and total samples"""
+        own, total = {}, {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total[frame] = total.get(frame, 0) + count
+        samples = max(self.samples, 1)
+        lines = [f"采样 / Samples: {self.samples}（间隔 {self.interval * 1000:.1f}ms，所有线程 / all threads）", "",
+                 "自身 / Self:"]
+        for frame, count in sorted(own.items(), key=lambda item: -item[1])[:top_n]:
+            lines.append(f"  {count / samples:6.1%}  {frame}")
+        lines += ["", "累计 / Total:"]
+        for frame, count in sorted(total.items(), key=lambda item: -item[1])[:top_n]:
+            lines.append(f"  {count / samples:6.1%}  {frame}")
+        return lines
+
+
+class ProfileSession:
+    """一个阶段的分析：Python分析器、子进程统计和计时
+    Profiling of one stage: the Python profiler, child process totals and timing"""
+
+    def __init__(self, stage, mode):
+        self.stage = stage
+        self.mode = mode
+        self.children = ChildUsage()
+        self.profiler = None
+        self.base = os.path.join(PROFILE_DIR, f"{stage}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+
+    def start(self):
+        from ffmpeg_supervisor import add_usage_listener
+
+        add_usage_listener(self.children)
+        if self.mode == "sample":
+            self.profiler = Sampler()
+            self.profiler.start()
+        else:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        if self.mode != "sample":
+            self.profiler.enable()
+
+    def stop(self, top_n=TOP_N):
+        """停止分析并写出分析文件和摘要，返回摘要路径
+        Stop profiling, write the profile and the summary, and return the summary path"""
+        from ffmpeg_supervisor import remove_usage_listener
+
+        if self.mode == "sample":
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+        wall = time.perf_counter() - self.wall_start
+        python_cpu = time.process_time() - self.cpu_start
+        remove_usage_listener(self.children)
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if self.mode == "sample":
+            profile_path = self.base + ".folded"
+            self.profiler.write(profile_path)
+            hotspots = self.profiler.hotspots(top_n)
+        else:
+            import io
+            import pstats
+            profile_path = self.base + ".prof"
+            self.profiler.dump_stats(profile_path)
+            output = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=output).strip_dirs()
+            stats.sort_stats("cumulative").print_stats(top_n)
+            stats.sort_stats("tottime").print_stats(top_n)
+            hotspots = ["只覆盖调用线程 / Calling thread only", output.getvalue()]
+
+        child_cpu = sum(totals["cpu"] for totals in self.children.programs.values())
+        lines = [
+            f"阶段 / Stage: {self.stage}  ({self.mode})",
+            f"墙钟 / Wall: {wall:.2f}s",
+            f"Python CPU（本进程 / this process）: {python_cpu:.2f}s",
+            f"子进程CPU / Child CPU: {child_cpu:.2f}s",
+            f"等待（墙钟 - Python CPU）/ Waiting (wall - Python CPU): {max(wall - python_cpu, 0.0):.2f}s",
+            "",
+            "子进程 / Child processes:",
+        ]
+        for program, totals in sorted(self.children.programs.items(), key=lambda item: -item[1]["wall"]):
+            lines.append(f"  {program:<12} x{totals['count']:<4} 墙钟/wall {totals['wall']:8.2f}s  CPU {totals['cpu']:8.2f}s")
+        if not self.children.programs:
+            lines.append("  （无 / none）")
+        lines += ["", *hotspots]
+
+        summary_path = self.base + ".txt"
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        logger.info(f"⏱ {self.stage}: 墙钟 {wall:.1f}s，Python CPU {python_cpu:.1f}s，子进程CPU {child_cpu:.1f}s"
+                    f"（{sum(t['count'] for t in self.children.programs.values())} 个进程）")
+        logger.info(f"分析结果: {profile_path}，摘要: {summary_path}")
+        return summary_path
+
+
+def enable(mode="cprofile"):
+    """开启分析，之后的start/stop会真正分析 / Turn profiling on so later start/stop calls really profile"""
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"未知的分析方式: {mode}")
+    _state["mode"] = mode
+
+
+def start(stage):
+    """开始分析一个阶段，未开启分析时什么也不做；上一个阶段还在分析时先结束它
+    Start profiling a stage; a no-op when profiling is off. A stage still being profiled is stopped first"""
+    if not _state["mode"]:
+        return
+    stop()
+    session = ProfileSession(stage, _state["mode"])
+    session.start()
+    _state["session"] = session
+
+
+def stop():
+    """结束当前阶段的分析，返回摘要路径（没有在分析时返回None）
+    Stop profiling the current stage and return the summary path (None if nothing was being profiled)"""
+    session, _state["session"] = _state["session"], None
+    return session.stop() if session else None
+
+
+@contextmanager
+def stage(name, mode=None):
+    """在分析器下运行一个阶段；mode为None且没有调用过enable时不分析
+    Run a stage under the profiler; no profiling when mode is None and enable was not called"""
+    if mode:
+        enable(mode)
+    start(name)
+    try:
+        yield
+    finally:
+        stop()
+
+
+def add_argument(parser):
+    """给命令行加上--profile [cprofile|sample] / Add --profile [cprofile|sample] to a command line"""
+    parser.add_argument(
+        "--profile", nargs="?", const="cprofile", choices=PROFILE_MODES, default=None,
+        help="在分析器下运行并写出热点摘要到logs/profiles / Run under a profiler and write a hotspot summary to logs/profiles",
+    )
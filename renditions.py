@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+一次解码生成多个输出规格（预览版、横屏版等）
+Several output renditions (preview, landscape, ...) from a single decode pass
+
+合并后的主文件（1080x1920）由concat复制流生成，不再重新编码；其他规格在同一个FFmpeg进程里生成：
+主文件只解码一次，滤镜图用split分成多路，每路有自己的缩放和编码器，所以多加一个预览版只多花它自己的编码时间。
+输出放在合并目录的renditions/子目录下（<主文件名>.<规格名>.mp4），不会被上传流程当成新的合并视频。
+The merged master (1080x1920) comes from the stream-copied concat and is never re-encoded; the other
+renditions come from one FFmpeg process: the master is decoded once and the filter graph is split,
+with its own scaling and encoder per rendition, so adding a preview costs only its own encode time.
+Outputs go to the renditions/ subdirectory of the merged directory (<master name>.<rendition>.mp4),
+so the upload flow never mistakes them for new merged videos.
+
+规格可以是预设名（RENDITION_PRESETS），也可以是字典，例如
+A rendition is a preset name (RENDITION_PRESETS) or a dict such as
+    {"name": "square", "width": 1080, "height": 1080, "fit": "pad", "crf": 24}
+"""
+
+import os
+
+from test_merge import FFMPEG_PATH
+from ffmpeg_supervisor import run_process
+import metrics
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
+RENDITIONS_SUBDIR = "renditions"  # 合并目录下的子目录 / Subdirectory of the merged directory
+MASTER = "master"  # 主文件的规格名，就是合并输出本身 / Rendition name of the master, i.e. the merge output itself
+RENDITION_PRESETS = {
+    # 小尺寸预览 / Small preview
+    "preview": {"width": 540, "height": 960, "fit": "scale", "preset": "veryfast", "crf": 28, "audio_bitrate": "96k"},
+    # 横屏版：竖屏画面居中，两侧加黑边 / Landscape: the portrait picture centered with black bars
+    "landscape": {"width": 1920, "height": 1080, "fit": "pad", "preset": "fast", "crf": 23, "audio_bitrate": None},
+}
+DEFAULT_RENDITION = {"fit": "scale", "preset": "fast", "crf": 23, "audio_bitrate": None}  # audio_bitrate为None时复制音频 / None copies the audio
+
+
+def resolve(renditions):
+    """把预设名和字典统一成完整的规格，去掉master
+    Turn preset names and dicts into complete specs, dropping the master
+
+    Raises:
+        ValueError: 未知的预设名或缺少尺寸 / Unknown preset name or missing size
+    """
+    specs = []
+    for item in renditions or []:
+        if isinstance(item, str):
+            if item == MASTER:
+                continue
+            if item not in RENDITION_PRESETS:
+                raise ValueError(f"未知的输出规格: {item}")
+            item = {"name": item, **RENDITION_PRESETS[item]}
+        spec = {**DEFAULT_RENDITION, **item}
+        if spec.get("name") == MASTER:
+            continue
+        if not spec.get("name") or not spec.get("width") or not spec.get("height"):
+            raise ValueError(f"输出规格缺少name/width/height: {item}")
+        specs.append(spec)
+    return specs
+
+
+def rendition_path(master_path, name):
+    """规格的输出路径 / Output path of a rendition"""
+    folder = os.path.join(os.path.dirname(master_path), RENDITIONS_SUBDIR)
+    base = os.path.splitext(os.path.basename(master_path))[0]
+    return os.path.join(folder, f"{base}.{name}.mp4")
+
+
+def _scale_filter(spec):
+    width, height = spec["width"], spec["height"]
+    if spec["fit"] == "pad":
+        # 按比例缩小后的边长可能是奇数，libx264的yuv420p要求偶数 / The fitted size can be odd; libx264 yuv420p needs even dimensions
+        return (f"scale={width}:{height}:force_original_aspect_ratio=decrease:force_divisible_by=2,"
+                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1")
+    return f"scale={width}:{height},setsar=1"
+
+
+def render(master_path, renditions):
+    """从主文件一次解码生成所有规格；已经存在且比主文件新的规格跳过
+    Produce every rendition from one decode of the master; renditions that exist and are newer than the master are skipped
+
+    Returns:
+        dict: 规格名 -> 输出路径，失败时为None；master对应主文件本身
+              Rendition name -> output path, None on failure; master maps to the master itself
+    """
+    specs = resolve(renditions)
+    outputs = {MASTER: master_path} if MASTER in (renditions or []) else {}
+    master_mtime = os.path.getmtime(master_path)
+    todo = []
+    for spec in specs:
+        path = rendition_path(master_path, spec["name"])
+        if os.path.exists(path) and os.path.getmtime(path) >= master_mtime:
+            outputs[spec["name"]] = path
+        else:
+            todo.append((spec, path))
+    if not todo:
+        return outputs
+
+    os.makedirs(os.path.dirname(todo[0][1]), exist_ok=True)
+    labels = "".join(f"[s{idx}]" for idx in range(len(todo)))
+    graph = [f"[0:v]split={len(todo)}{labels}" if len(todo) > 1 else "[0:v]null[s0]"]
+    command = [FFMPEG_PATH, "-y", "-i", master_path]
+    for idx, (spec, _) in enumerate(todo):
+        graph.append(f"[s{idx}]{_scale_filter(spec)}[r{idx}]")
+    command += ["-filter_complex", ";".join(graph)]
+    # 每个规格一个输出，各自有自己的编码器 / One output per rendition, each with its own encoder
+    for idx, (spec, path) in enumerate(todo):
+        audio = ["-c:a", "aac", "-b:a", spec["audio_bitrate"]] if spec["audio_bitrate"] else ["-c:a", "copy"]
+        command += [
+            "-map", f"[r{idx}]", "-map", "0:a?",
+            "-c:v", "libx264", "-preset", spec["preset"], "-crf", str(spec["crf"]),
+            *audio,
+            "-movflags", "+faststart",
+            path,
+        ]
+
+    names = [spec["name"] for spec, _ in todo]
+    logger.info(f"生成输出规格: {', '.join(names)}（一次解码）")
+    with metrics.span("merge.renditions", renditions=",".join(names)) as span:
+        result = run_process(command, job_name="merge.renditions")
+        span.status = "ok" if result.returncode == 0 else "error"
+    if result.returncode != 0:
+        logger.error(f"生成输出规格失败: {result.stderr[-500:] if result.stderr else ''}")
+        for spec, path in todo:
+            if os.path.exists(path):
+                os.remove(path)
+            outputs[spec["name"]] = None
+        return outputs
+    for spec, path in todo:
+        outputs[spec["name"]] = path
+    return outputs
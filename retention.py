@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+下载片段和合并视频的保留策略与分层存储
+Retention and tiered storage for downloaded clips and merged videos
+
+根据流水线状态（merged.log、uploaded.log和merge_jobs记录）给每个文件分类：
+    源片段：unmerged（未合并）、merged（已合并，输出未上传）、uploaded（所在的合并视频已上传）
+    合并视频：pending（未上传）、uploaded（已上传）
+然后按策略处理：
+    - 年龄：HOT_DAYS天内的文件都留在原处（热数据）
+    - 状态：已上传的源片段超过SOURCE_DELETE_DAYS天、已上传的合并视频超过MERGED_DELETE_DAYS天后删除
+    - 冷数据：超过HOT_DAYS天的已处理文件移到归档目录（RETENTION_ARCHIVE_DIR，"s3"或"s3://bucket/prefix"表示S3桶），
+      没有归档目录时在机器空闲时把源片段重新编码为较低码率
+    - 配额：下载和合并目录超过RETENTION_QUOTA_GB时，按从旧到新归档（或删除已上传的）文件，直到低于配额
+未合并的片段、未上传的合并视频和未完成合并任务用到的片段永远不会被删除。每个操作都记录在索引中，
+归档的文件可以用--restore找回；--dry-run只显示计划。
+Every file is classified from pipeline state (merged.log, uploaded.log and merge_jobs records):
+    source clips: unmerged, merged (output not uploaded yet), uploaded (its merged video was uploaded)
+    merged videos: pending (not uploaded), uploaded
+then the policies apply:
+    - age: files younger than HOT_DAYS days stay where they are (hot)
+    - state: uploaded sources older than SOURCE_DELETE_DAYS and uploaded merged videos older than
+      MERGED_DELETE_DAYS are deleted
+    - cold: processed files older than HOT_DAYS move to the archive tier (RETENTION_ARCHIVE_DIR; "s3" or
+      "s3://bucket/prefix" means an S3 bucket); without an archive tier, source clips are re-encoded to a
+      compact bitrate while the machine is idle
+    - quota: when the download and merge directories exceed RETENTION_QUOTA_GB, files are archived
+      (or deleted if uploaded) oldest first until usage is under the quota
+Unmerged clips, merged videos not yet uploaded and clips used by unfinished merge jobs are never
+deleted. Every action is recorded in an index; archived files can be brought back with --restore,
+and --dry-run only prints the plan.
+"""
+
+import os
+import json
+import time
+import shutil
+import threading
+from datetime import datetime
+
+from test_merge import DOWNLOADS_DIR, MERGED_DIR, LOG_DIR, LOG_FILE, FFMPEG_PATH
+from log_setup import get_logger
+
+logger = get_logger("retention")
+
+HOT_DAYS = float(os.environ.get("RETENTION_HOT_DAYS", 3))  # 热数据保留天数 / Days files stay hot
+SOURCE_DELETE_DAYS = float(os.environ.get("RETENTION_SOURCE_DAYS", 7))  # 已上传的源片段保留天数 / Days uploaded sources are kept
+MERGED_DELETE_DAYS = float(os.environ.get("RETENTION_MERGED_DAYS", 30))  # 已上传的合并视频保留天数 / Days uploaded merged videos are kept
+QUOTA_BYTES = int(float(os.environ.get("RETENTION_QUOTA_GB", 0)) * 1024 ** 3) or None  # 磁盘配额，0表示不限制 / Disk quota, 0 for none
+ARCHIVE_DIR = os.environ.get("RETENTION_ARCHIVE_DIR") or None  # 归档目录（较慢的存储）/ Archive tier (slower storage)
+IDLE_LOAD = float(os.environ.get("RETENTION_IDLE_LOAD", (os.cpu_count() or 2) * 0.3))  # 低于该负载视为空闲 / Load below which the box is idle
+COMPACT_VIDEO_ARGS = ["-c:v", "libx264", "-preset", "slow", "-crf", "30"]  # 压缩编码设置 / Compact encode settings
+COMPACT_AUDIO_ARGS = ["-c:a", "aac", "-b:a", "96k"]
+COMPACT_MIN_SAVING = 0.2  # 压缩后至少小这么多才替换 / Replace only if the compact copy is at least this much smaller
+INDEX_FILE = os.path.join(LOG_DIR, "retention_index.json")  # 操作索引 / Action index
+UPLOADED_LOG = os.path.join(LOG_DIR, "uploaded.log")  # 与test_upload.UPLOADED_LOG相同（避免导入selenium）/ Same as test_upload.UPLOADED_LOG (avoids importing selenium)
+DAY = 24 * 3600
+
+_index_lock = threading.Lock()
+
+
+def load_index():
+    """读取操作索引 / Load the action index"""
+    if not os.path.exists(INDEX_FILE):
+        return {"files": {}}
+    try:
+        with open(INDEX_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}}
+    data.setdefault("files", {})
+    return data
+
+
+def save_index(data):
+    """原子地写入操作索引 / Atomically write the action index"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    tmp_file = INDEX_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, INDEX_FILE)
+
+
+def _record(path, **fields):
+    with _index_lock:
+        data = load_index()
+        entry = data["files"].setdefault(os.path.abspath(path), {})
+        entry.update(fields, time=datetime.now().isoformat(timespec="seconds"))
+        save_index(data)
+
+
+def _read_lines(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def _list_mp4(folder):
+    paths = []
+    for root, _, files in os.walk(folder):
+        paths += [os.path.join(root, name) for name in files if name.endswith(".mp4") and ".compact." not in name]
+    return paths
+
+
+def is_idle():
+    """机器是否空闲（1分钟平均负载低于IDLE_LOAD，不支持getloadavg时视为不空闲）
+    Whether the machine is idle (1-minute load below IDLE_LOAD; not idle where getloadavg is unsupported)"""
+    try:
+        return os.getloadavg()[0] < IDLE_LOAD
+    except (AttributeError, OSError):
+        return False
+
+
+def scan_files(downloads_dir=DOWNLOADS_DIR, merged_dir=MERGED_DIR, merge_log=LOG_FILE, uploaded_log=UPLOADED_LOG):
+    """按流水线状态给下载片段和合并视频分类
+    Classify downloaded clips and merged videos from pipeline state
+
+    Returns:
+        文件列表，每项为 {"path", "kind", "state", "age", "size", "protected", "compacted"}
+        List of {"path", "kind", "state", "age", "size", "protected", "compacted"}
+    """
+    from merge_jobs import list_jobs
+    from renditions import RENDITIONS_SUBDIR
+
+    merged = _read_lines(merge_log)
+    uploaded = _read_lines(uploaded_log)
+    compacted = {path for path, entry in load_index()["files"].items() if entry.get("action") == "compact"}
+    protected, uploaded_sources = set(), set()
+    for job in list_jobs():
+        sources = [clip["source"] for clip in job.data["clips"]]
+        if job.step != "done":
+            protected.update(sources)
+        elif os.path.basename(job.output) in uploaded:
+            uploaded_sources.update(sources)
+
+    now = time.time()
+    files = []
+    for kind, folder in (("source", downloads_dir), ("output", merged_dir)):
+        if not os.path.isdir(folder):
+            continue
+        for path in _list_mp4(folder):
+            stat = os.stat(path)
+            abs_path = os.path.abspath(path)
+            if kind == "source":
+                name = os.path.relpath(path, folder)
+                state = "uploaded" if abs_path in uploaded_sources else "merged" if name in merged else "unmerged"
+            else:
+                name = os.path.basename(path)
+                if os.path.basename(os.path.dirname(path)) == RENDITIONS_SUBDIR:
+                    # 输出规格跟随主文件的状态 / Renditions follow their master's state
+                    name = os.path.splitext(os.path.splitext(name)[0])[0] + ".mp4"
+                state = "uploaded" if name in uploaded else "pending"
+            files.append({
+                "path": path, "kind": kind, "state": state, "age": (now - stat.st_mtime) / DAY,
+                "size": stat.st_size, "protected": abs_path in protected, "compacted": abs_path in compacted,
+                "root": folder,
+            })
+    return files
+
+
+def plan_actions(files, archive_dir=ARCHIVE_DIR, quota=QUOTA_BYTES, compact=True):
+    """按策略生成操作计划
+    Build the action plan from the policies
+
+    Returns:
+        操作列表，每项为 {"action": delete/archive/compact, "file", "reason"} / List of {"action", "file", "reason"}
+    """
+    actions, planned = [], set()
+
+    def plan(action, file, reason):
+        actions.append({"action": action, "file": file, "reason": reason})
+        planned.add(file["path"])
+
+    for file in sorted(files, key=lambda f: -f["age"]):
+        # 未合并的片段、未上传的视频和进行中的合并任务用到的片段永远保留 / Never touch work still in flight
+        if file["protected"] or file["state"] in ("unmerged", "pending"):
+            continue
+        if file["kind"] == "source" and file["state"] == "uploaded" and file["age"] >= SOURCE_DELETE_DAYS:
+            plan("delete", file, f"已上传且超过{SOURCE_DELETE_DAYS:g}天 / uploaded, older than {SOURCE_DELETE_DAYS:g} days")
+        elif file["kind"] == "output" and file["state"] == "uploaded" and file["age"] >= MERGED_DELETE_DAYS:
+            plan("delete", file, f"已上传且超过{MERGED_DELETE_DAYS:g}天 / uploaded, older than {MERGED_DELETE_DAYS:g} days")
+        elif file["age"] >= HOT_DAYS:
+            if archive_dir:
+                plan("archive", file, f"冷数据，超过{HOT_DAYS:g}天 / cold, older than {HOT_DAYS:g} days")
+            elif compact and file["kind"] == "source" and not file["compacted"]:
+                plan("compact", file, f"冷数据，超过{HOT_DAYS:g}天 / cold, older than {HOT_DAYS:g} days")
+
+    if quota:
+        usage = sum(f["size"] for f in files) - sum(a["file"]["size"] for a in actions if a["action"] != "compact")
+        if usage > quota:
+            for file in sorted(files, key=lambda f: -f["age"]):
+                if usage <= quota:
+                    break
+                if file["protected"] or file["state"] in ("unmerged", "pending"):
+                    continue
+                if not archive_dir and file["state"] != "uploaded":
+                    continue
+                if file["path"] in planned:
+                    # 已计划压缩的文件在配额压力下直接归档或删除 / Under quota pressure, planned compactions become archive/delete
+                    previous = next(a for a in actions if a["file"]["path"] == file["path"])
+                    if previous["action"] != "compact":
+                        continue
+                    actions.remove(previous)
+                plan("archive" if archive_dir else "delete", file, "超出配额 / over quota")
+                usage -= file["size"]
+            if usage > quota:
+                logger.warning(f"⚠️ 处理后仍超出配额 {usage / 1024 ** 3:.1f}GB > {quota / 1024 ** 3:.1f}GB（剩余文件都还在使用中）")
+    return actions
+
+
+def archive_file(file, archive_dir):
+    """把文件移到归档目录（或"s3"/"s3://bucket/prefix"表示的S3桶，见s3_archive），保持相对目录结构
+    Move a file to the archive tier (or the S3 bucket given as "s3"/"s3://bucket/prefix", see s3_archive),
+    keeping its relative layout"""
+    import s3_archive
+
+    relative = os.path.relpath(file["path"], file["root"])
+    folder = "sources" if file["kind"] == "source" else "merged"
+    mtime = os.path.getmtime(file["path"])
+    if archive_dir == "s3" or s3_archive.is_s3_uri(archive_dir):
+        bucket, prefix = s3_archive.archive_root(archive_dir)
+        key = "/".join(part for part in (prefix, folder, relative.replace(os.sep, "/")) if part)
+        target = s3_archive.upload_file(file["path"], bucket, key)
+        os.remove(file["path"])
+    else:
+        target = os.path.join(archive_dir, folder, relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(file["path"], target)  # 跨设备时复制后删除 / Copies and deletes across devices
+        target = os.path.abspath(target)
+    _record(file["path"], action="archive", archived=target, size=file["size"], kind=file["kind"], mtime=mtime)
+    return target
+
+
+def compact_file(file):
+    """空闲时把源片段重新编码为较低码率，保留原来的修改时间；压缩效果不明显时保留原文件
+    Re-encode a source clip to a compact bitrate while idle, keeping its mtime; the original is kept if the saving is small
+
+    Returns:
+        节省的字节数，未替换时为0 / Bytes saved, 0 if not replaced
+    """
+    from ffmpeg_supervisor import run_process
+    from mp4_check import check_mp4
+
+    path = file["path"]
+    tmp_path = os.path.splitext(path)[0] + ".compact.mp4"
+    command = [
+        FFMPEG_PATH, "-y", "-i", path,
+        *COMPACT_VIDEO_ARGS, *COMPACT_AUDIO_ARGS,
+        "-movflags", "+faststart",
+        tmp_path,
+    ]
+    result = run_process(command, nice=19, ionice="3", job_name="retention.compact")
+    ok = result.returncode == 0 and check_mp4(tmp_path)[0]
+    saved = file["size"] - os.path.getsize(tmp_path) if ok else 0
+    if not ok or saved < file["size"] * COMPACT_MIN_SAVING:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _record(path, action="compact", size=file["size"], saved=0)
+        return 0
+    stat = os.stat(path)
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))  # 保留年龄 / Keep the file's age
+    os.replace(tmp_path, path)
+    _record(path, action="compact", size=file["size"], saved=saved)
+    return saved
+
+
+def apply_actions(actions, archive_dir=ARCHIVE_DIR, dry_run=False):
+    """执行操作计划；压缩只在机器空闲时进行，变忙后剩下的留到下次
+    Carry out the plan; compaction runs only while idle, and the rest waits for the next run once busy
+
+    Returns:
+        dict: 每种操作的文件数和释放的字节数 / Files and bytes freed per action
+    """
+    summary = {action: {"files": 0, "bytes": 0} for action in ("delete", "archive", "compact")}
+    for item in actions:
+        action, file = item["action"], item["file"]
+        label = f"{action:<7} {file['path']}  ({file['size'] / 1024 ** 2:.1f}MB, {file['age']:.1f}天/days, {item['reason']})"
+        if dry_run:
+            logger.info(f"[dry-run] {label}")
+            summary[action]["files"] += 1
+            summary[action]["bytes"] += file["size"] if action != "compact" else 0
+            continue
+        try:
+            if action == "delete":
+                os.remove(file["path"])
+                _record(file["path"], action="delete", size=file["size"], kind=file["kind"])
+                freed = file["size"]
+            elif action == "archive":
+                archive_file(file, archive_dir)
+                freed = file["size"]
+            else:
+                if not is_idle():
+                    logger.info("机器不空闲，压缩留到下次 / Machine busy, compaction deferred")
+                    continue
+                freed = compact_file(file)
+        except Exception as e:
+            logger.error(f"❌ {action} 失败: {file['path']}: {e}")
+            continue
+        logger.info(label)
+        summary[action]["files"] += 1
+        summary[action]["bytes"] += freed
+    return summary
+
+
+def run_retention(downloads_dir=DOWNLOADS_DIR, merged_dir=MERGED_DIR, merge_log=LOG_FILE, uploaded_log=UPLOADED_LOG,
+                  archive_dir=ARCHIVE_DIR, quota=QUOTA_BYTES, compact=True, dry_run=False):
+    """扫描、生成计划并执行（或只显示）保留策略
+    Scan, plan and apply (or just show) the retention policies"""
+    files = scan_files(downloads_dir, merged_dir, merge_log, uploaded_log)
+    actions = plan_actions(files, archive_dir, quota, compact)
+    summary = apply_actions(actions, archive_dir, dry_run)
+    total = sum(f["size"] for f in files)
+    logger.info(f"保留策略: {len(files)} 个文件共 {total / 1024 ** 3:.2f}GB，"
+                + "，".join(f"{action} {values['files']} 个（{values['bytes'] / 1024 ** 2:.0f}MB）"
+                           for action, values in summary.items()))
+    return summary
+
+
+def _restore_entry(original, entry):
+    archived = entry["archived"]
+    if archived.startswith("s3://"):
+        import s3_archive
+
+        # S3中的对象保留，再次归档时内容相同会直接跳过上传 / The object stays in S3; re-archiving identical content skips the upload
+        s3_archive.download_file(*s3_archive.parse_uri(archived), original)
+    else:
+        if not os.path.exists(archived):
+            logger.error(f"❌ 归档文件不存在: {archived}")
+            return None
+        os.makedirs(os.path.dirname(original), exist_ok=True)
+        shutil.move(archived, original)
+    _record(original, action="restore", size=entry.get("size"))
+    logger.info(f"已恢复: {original}")
+    return original
+
+
+def restore(name, index=None):
+    """把归档的文件移回原来的位置，name可以是原路径或文件名
+    Move an archived file back to its original location; name may be the original path or the file name
+
+    Returns:
+        恢复后的路径，找不到时返回None / The restored path, None if not found
+    """
+    index = index or load_index()
+    for original, entry in index["files"].items():
+        if entry.get("action") == "archive" and name in (original, os.path.basename(original)):
+            return _restore_entry(original, entry)
+    logger.error(f"❌ 索引中没有归档文件: {name}")
+    return None
+
+
+def archived_sources(folder):
+    """原来在folder下、现在只在归档里的文件
+    Files that lived under folder and are now only in the archive
+
+    Returns:
+        dict: 相对folder的路径 -> 原来的修改时间（用于按时间排序）/ Path relative to folder -> original mtime (for ordering)
+    """
+    root = os.path.abspath(folder) + os.sep
+    archived = {}
+    for original, entry in load_index()["files"].items():
+        if entry.get("action") == "archive" and original.startswith(root) and not os.path.exists(original):
+            mtime = entry.get("mtime") or datetime.fromisoformat(entry["time"]).timestamp()
+            archived[os.path.relpath(original, folder)] = mtime
+    return archived
+
+
+def restore_paths(paths):
+    """只恢复指定的归档文件（合并实际选中的片段）
+    Restore only the given archived files (the clips a merge actually selected)
+
+    Returns:
+        恢复成功的路径列表 / Paths that were restored
+    """
+    index = load_index()
+    restored = []
+    for path in paths:
+        original = os.path.abspath(path)
+        entry = index["files"].get(original)
+        if not entry or entry.get("action") != "archive":
+            continue
+        try:
+            if _restore_entry(original, entry):
+                restored.append(path)
+        except Exception as e:
+            logger.error(f"❌ 恢复失败: {original}: {e}")
+    return restored
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="下载和合并文件的保留策略 / Retention for downloads and merged outputs")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="只显示计划，不做任何修改 / Show the plan without changing anything")
+    parser.add_argument("--no-compact", action="store_true", help="不重新编码冷数据 / Don't re-encode cold clips")
+    parser.add_argument("--restore", metavar="NAME", help="从归档中恢复一个文件 / Restore one file from the archive")
+    parser.add_argument("--pipeline", metavar="NAME", help="对pipelines.json中的某个流水线执行 / Run for one pipeline from pipelines.json")
+    args = parser.parse_args()
+
+    if args.restore:
+        restore(args.restore)
+    elif args.pipeline:
+        from pipelines import load_pipelines
+        pipeline = next((p for p in load_pipelines()[0] if p.name == args.pipeline), None)
+        if pipeline is None:
+            logger.error(f"❌ 没有这个流水线: {args.pipeline}")
+        else:
+            run_retention(pipeline.downloads_dir, pipeline.merged_dir, pipeline.merge_log,
+                          pipeline.channel["uploaded_log"], compact=not args.no_compact, dry_run=args.dry_run)
+    else:
+        run_retention(compact=not args.no_compact, dry_run=args.dry_run)
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+S3兼容存储的归档后端：并行分块上传/下载、校验和断点续传
+S3-compatible archive backend: parallel multipart upload/download with checksums and resume
+
+    - 上传：大于一个分块的文件用multipart上传，多个线程各自从文件中读取自己的分块（内存占用只有
+      分块大小 x 线程数，与文件大小无关），每个分块带Content-MD5；UploadId记录在test_logs/s3_transfers/下，
+      中断后再次上传时用list_parts跳过已完成的分块。对象元数据中保存整个文件的SHA-256和修改时间，
+      内容相同的对象已存在时直接跳过。
+    - 下载：按分块并行发送Range请求，流式写入预分配的.s3part文件的对应位置，已完成的分块记录在旁边的状态文件中，
+      中断后继续；完成后用SHA-256校验，再原子地替换成目标文件，并恢复原来的修改时间。
+    - Upload: files larger than one part go up as multipart uploads; each thread reads its own parts
+      straight from the file (memory is part size x threads, independent of file size) and sends
+      them with Content-MD5. The UploadId is kept under test_logs/s3_transfers/, and a later upload
+      of the same file skips finished parts via list_parts. Object metadata holds the whole file's
+      SHA-256 and mtime; an object with the same content is skipped.
+    - Download: parallel Range requests per part, streamed into their offsets of a preallocated
+      .s3part file, with finished parts recorded in a state file next to it so an interrupted
+      download continues; the result is checked against the SHA-256, atomically moved into place
+      and given back its original mtime.
+
+需要boto3（pip install boto3）。用S3_ENDPOINT_URL指向MinIO等本地兼容服务即可测试，凭证使用boto3的标准环境变量
+（AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY）。
+Requires boto3 (pip install boto3). Point S3_ENDPOINT_URL at a local MinIO-style service to test;
+credentials come from boto3's standard environment variables (AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY).
+"""
+
+import os
+import json
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from test_merge import LOG_DIR
+from log_setup import get_logger
+
+logger = get_logger("archive")
+
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None  # S3兼容服务地址，None为AWS / S3-compatible endpoint, None for AWS
+S3_BUCKET = os.environ.get("S3_BUCKET", "")  # 归档桶 / Archive bucket
+S3_PREFIX = os.environ.get("S3_PREFIX", "archive")  # 对象键前缀 / Object key prefix
+PART_SIZE = int(float(os.environ.get("S3_PART_SIZE_MB", 16)) * 1024 * 1024)  # 分块大小 / Part size
+TRANSFER_WORKERS = int(os.environ.get("S3_WORKERS", 8))  # 并行传输线程数 / Parallel transfer threads
+MAX_PARTS = 10000  # S3的分块数上限 / S3's part count limit
+STATE_DIR = os.path.join(LOG_DIR, "s3_transfers")  # 断点续传状态 / Resume state
+STREAM_CHUNK_SIZE = 1024 * 1024  # 下载时每次写入的字节数 / Bytes written per step when downloading
+
+_client_lock = threading.Lock()
+_clients = {}
+
+
+def get_client(workers=TRANSFER_WORKERS):
+    """共享的S3客户端（boto3客户端是线程安全的）
+    Shared S3 client (boto3 clients are thread-safe)
+
+    Raises:
+        RuntimeError: 没有安装boto3 / boto3 is not installed
+    """
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError:
+        raise RuntimeError("S3归档需要boto3: pip install boto3")
+    with _client_lock:
+        if workers not in _clients:
+            config = Config(max_pool_connections=workers + 2, retries={"max_attempts": 5, "mode": "standard"})
+            _clients[workers] = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL, config=config)
+        return _clients[workers]
+
+
+def is_s3_uri(value):
+    return bool(value) and value.startswith("s3://")
+
+
+def parse_uri(uri):
+    """把s3://bucket/key拆成(bucket, key) / Split s3://bucket/key into (bucket, key)"""
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def make_uri(bucket, key):
+    return f"s3://{bucket}/{key}"
+
+
+def archive_root(archive_dir):
+    """归档目录设置为"s3"或"s3://bucket/prefix"时对应的(bucket, prefix) / (bucket, prefix) for an archive setting of "s3" or "s3://bucket/prefix\""""
+    if archive_dir == "s3":
+        return S3_BUCKET, S3_PREFIX
+    bucket, prefix = parse_uri(archive_dir)
+    return bucket, prefix.strip("/")
+
+
+def _part_size(size, part_size):
+    # 超过MAX_PARTS个分块时按MB向上放大 / Grow to whole MBs when the file would exceed MAX_PARTS parts
+    minimum = -(-size // MAX_PARTS)
+    if minimum > part_size:
+        part_size = -(-minimum // (1024 * 1024)) * 1024 * 1024
+    return part_size
+
+
+def _state_path(kind, bucket, key):
+    name = hashlib.sha256(f"{kind}|{bucket}/{key}".encode("utf-8")).hexdigest()[:24]
+    return os.path.join(STATE_DIR, f"{name}.json")
+
+
+def _load_state(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, path)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _head(client, bucket, key):
+    from botocore.exceptions import ClientError
+
+    try:
+        return client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def _read_part(path, offset, length):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _content_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+def _existing_parts(client, bucket, key, upload_id):
+    from botocore.exceptions import ClientError
+
+    parts = {}
+    try:
+        for page in client.get_paginator("list_parts").paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+            for part in page.get("Parts", []):
+                parts[part["PartNumber"]] = {"ETag": part["ETag"], "Size": part["Size"]}
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "NoSuchUpload":
+            return None
+        raise
+    return parts
+
+
+def _abort_upload(client, bucket, key, upload_id):
+    from botocore.exceptions import ClientError
+
+    try:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except ClientError:
+        pass  # 已经失效 / Already gone
+
+
+def abort_stale_uploads(bucket, prefix="", older_than_days=7):
+    """中止超过older_than_days天仍未完成的分块上传（也可以在桶上配置AbortIncompleteMultipartUpload生命周期规则）
+    Abort multipart uploads left unfinished for more than older_than_days days (a bucket lifecycle rule
+    with AbortIncompleteMultipartUpload does the same)
+
+    Returns:
+        中止的上传数 / Number of aborted uploads
+    """
+    from datetime import datetime, timedelta, timezone
+
+    client = get_client()
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    count = 0
+    for page in client.get_paginator("list_multipart_uploads").paginate(Bucket=bucket, Prefix=prefix):
+        for upload in page.get("Uploads", []):
+            if upload["Initiated"] < cutoff:
+                _abort_upload(client, bucket, upload["Key"], upload["UploadId"])
+                count += 1
+    return count
+
+
+def upload_file(path, bucket, key, part_size=PART_SIZE, workers=TRANSFER_WORKERS):
+    """把文件上传到S3，大文件并行分块上传，中断后可以继续
+    Upload a file to S3; large files go up as parallel multipart uploads that resume after an interruption
+
+    Returns:
+        对象的s3:// URI / The object's s3:// URI
+    """
+    from content_store import hash_file
+
+    client = get_client(workers)
+    stat = os.stat(path)
+    size = stat.st_size
+    digest = hash_file(path)
+    metadata = {"sha256": digest, "mtime-ns": str(stat.st_mtime_ns)}
+
+    head = _head(client, bucket, key)
+    if head and head["ContentLength"] == size and head.get("Metadata", {}).get("sha256") == digest:
+        logger.info(f"已归档，跳过: {make_uri(bucket, key)}")
+        return make_uri(bucket, key)
+
+    part_size = _part_size(size, part_size)
+    if size <= part_size:
+        with open(path, "rb") as f:
+            data = f.read()
+        client.put_object(Bucket=bucket, Key=key, Body=data, ContentMD5=_content_md5(data), Metadata=metadata)
+        return make_uri(bucket, key)
+
+    state_path = _state_path("upload", bucket, key)
+    state = _load_state(state_path)
+    done = None
+    if state and state["sha256"] == digest and state["part_size"] == part_size:
+        done = _existing_parts(client, bucket, key, state["upload_id"])
+    if done is None:
+        if state:
+            # 旧的分块上传不能继续（文件变了或已失效），中止它，免得未完成的分块一直占用存储
+            # The old multipart upload can't be resumed (file changed or upload expired); abort it so its parts don't linger in storage
+            _abort_upload(client, bucket, key, state["upload_id"])
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata)["UploadId"]
+        state = {"upload_id": upload_id, "sha256": digest, "part_size": part_size, "size": size}
+        _save_state(state_path, state)
+        done = {}
+    upload_id = state["upload_id"]
+
+    part_count = -(-size // part_size)
+    parts = {}
+    for number, part in done.items():
+        expected = min(part_size, size - (number - 1) * part_size)
+        if part["Size"] == expected:
+            parts[number] = part["ETag"]
+    if parts:
+        logger.info(f"继续上传 {key}: 已完成 {len(parts)}/{part_count} 个分块")
+
+    def send(number):
+        offset = (number - 1) * part_size
+        data = _read_part(path, offset, min(part_size, size - offset))
+        md5 = hashlib.md5(data)
+        response = client.upload_part(
+            Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+            Body=data, ContentMD5=base64.b64encode(md5.digest()).decode("ascii"),
+        )
+        # 未加密对象的分块ETag就是MD5 / A part's ETag is its MD5 for unencrypted objects
+        if response["ETag"].strip('"') != md5.hexdigest():
+            raise IOError(f"分块 {number} 校验失败: {response['ETag']}")
+        return number, response["ETag"]
+
+    pending = [number for number in range(1, part_count + 1) if number not in parts]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending) or 1))) as pool:
+        for number, etag in pool.map(send, pending):
+            parts[number] = etag
+
+    client.complete_multipart_upload(
+        Bucket=bucket, Key=key, UploadId=upload_id,
+        MultipartUpload={"Parts": [{"PartNumber": number, "ETag": parts[number]} for number in sorted(parts)]},
+    )
+    _remove(state_path)
+    head = _head(client, bucket, key)
+    if not head or head["ContentLength"] != size:
+        raise IOError(f"上传后大小不一致: {make_uri(bucket, key)}")
+    return make_uri(bucket, key)
+
+
+def download_file(bucket, key, path, part_size=PART_SIZE, workers=TRANSFER_WORKERS):
+    """从S3并行分段下载文件，中断后继续；校验SHA-256后原子地写到path，并恢复原来的修改时间
+    Download a file from S3 in parallel ranges, resuming after an interruption; it is checked against its
+    SHA-256, atomically written to path and given back its original mtime
+
+    Returns:
+        path
+
+    Raises:
+        FileNotFoundError: 对象不存在 / The object does not exist
+        IOError: 校验失败 / Checksum mismatch
+    """
+    from content_store import hash_file
+
+    client = get_client(workers)
+    head = _head(client, bucket, key)
+    if head is None:
+        raise FileNotFoundError(make_uri(bucket, key))
+    size, etag, metadata = head["ContentLength"], head["ETag"], head.get("Metadata", {})
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".s3part"
+    state_path = tmp_path + ".json"
+    state = _load_state(state_path)
+    if not state or state["etag"] != etag or state["part_size"] != part_size or not os.path.exists(tmp_path):
+        state = {"etag": etag, "part_size": part_size, "done": []}
+        with open(tmp_path, "wb") as f:
+            f.truncate(size)
+        _save_state(state_path, state)
+
+    lock = threading.Lock()
+    done = set(state["done"])
+    part_count = max(1, -(-size // part_size))
+    pending = [number for number in range(part_count) if number not in done]
+    if done:
+        logger.info(f"继续下载 {key}: 已完成 {len(done)}/{part_count} 段")
+
+    def fetch(number):
+        start = number * part_size
+        end = min(start + part_size, size) - 1
+        if end < start:
+            return
+        response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)
+        # 每个线程单独打开文件再seek，Windows上没有os.pwrite / Each thread opens the file and seeks; Windows has no os.pwrite
+        offset = start
+        with open(tmp_path, "r+b") as f:
+            f.seek(start)
+            for chunk in response["Body"].iter_chunks(STREAM_CHUNK_SIZE):
+                f.write(chunk)
+                offset += len(chunk)
+        if offset != end + 1:
+            raise IOError(f"分段 {number} 不完整: {offset - start}/{end - start + 1}")
+        with lock:
+            state["done"].append(number)
+            _save_state(state_path, state)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending) or 1))) as pool:
+        list(pool.map(fetch, pending))
+
+    expected = metadata.get("sha256")
+    if expected and hash_file(tmp_path) != expected:
+        _remove(tmp_path)
+        _remove(state_path)
+        raise IOError(f"SHA-256校验失败: {make_uri(bucket, key)}")
+    if metadata.get("mtime-ns"):
+        mtime_ns = int(metadata["mtime-ns"])
+        os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp_path, path)
+    _remove(state_path)
+    return path
+
+
+def delete_object(bucket, key):
+    get_client().delete_object(Bucket=bucket, Key=key)
+
+
+def list_objects(bucket, prefix=""):
+    """列出前缀下的对象 / List objects under a prefix"""
+    objects = []
+    for page in get_client().get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        objects += page.get("Contents", [])
+    return objects
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="S3归档 / S3 archive")
+    parser.add_argument("--bucket", default=S3_BUCKET, help="桶名，默认S3_BUCKET / Bucket, defaults to S3_BUCKET")
+    sub = parser.add_subparsers(dest="command", required=True)
+    push = sub.add_parser("push", help="上传文件 / Upload files")
+    push.add_argument("paths", nargs="+")
+    push.add_argument("--prefix", default=S3_PREFIX)
+    pull = sub.add_parser("pull", help="下载对象 / Download an object")
+    pull.add_argument("key")
+    pull.add_argument("dest", nargs="?")
+    listing = sub.add_parser("ls", help="列出对象 / List objects")
+    listing.add_argument("prefix", nargs="?", default=S3_PREFIX)
+    cleanup = sub.add_parser("abort-stale", help="中止过期的未完成分块上传 / Abort stale unfinished multipart uploads")
+    cleanup.add_argument("--days", type=float, default=7)
+    args = parser.parse_args()
+
+    if not args.bucket:
+        parser.error("需要--bucket或S3_BUCKET")
+    if args.command == "push":
+        for local_path in args.paths:
+            logger.info(upload_file(local_path, args.bucket, f"{args.prefix.strip('/')}/{os.path.basename(local_path)}"))
+    elif args.command == "pull":
+        logger.info(download_file(args.bucket, args.key, args.dest or os.path.basename(args.key)))
+    elif args.command == "abort-stale":
+        logger.info(f"已中止 {abort_stale_uploads(args.bucket, S3_PREFIX, args.days)} 个未完成的分块上传")
+    else:
+        for item in list_objects(args.bucket, args.prefix):
+            logger.info(f"{item['Size'] / 1024 ** 2:10.1f}MB  {item['LastModified']:%Y-%m-%d %H:%M}  {item['Key']}")
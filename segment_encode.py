@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+分段并行编码：把重新编码的合并拆成多个可以独立编码的段，在多个核上同时编码，再复制流拼接
+Segment-parallel encoding: split a re-encoded merge into independently encodable segments, encode them
+on several cores at once, then join them by stream copy
+
+重新编码拼接（merge_specific_videos的reencode方式）原来只有一个libx264进程，30分钟的合集用不满所有核，
+用时随总时长增长。分段模式下：
+    - 在片段边界处把输出时间线分成若干段（每段至少SEGMENT_MIN_SECONDS秒），每段用concat滤镜单独编码视频，
+      写成MPEG-TS；每段都从关键帧开始，可以直接复制流拼接
+    - 音频仍然一次编码整条音轨（AAC在分段边界处会有编码器延迟造成的空隙），和视频段一起并行运行
+    - 最后用concat demuxer复制流拼接视频段并混入音轨
+    - 校验时长；verify=True时再用SSIM和标准化后的片段比较，低于SEGMENT_SSIM_MIN时视为失败，
+      调用方退回单次编码
+The re-encoding concat (the reencode strategy of merge_specific_videos) used to run one libx264 process, so a
+30-minute compilation left cores idle and its wall time grew with the total duration. In segment mode:
+    - the output timeline is split at clip boundaries into segments (at least SEGMENT_MIN_SECONDS
+      each); each segment's video is encoded on its own with the concat filter into MPEG-TS, starting
+      on a keyframe so the segments join by stream copy
+    - audio is still encoded as one track in a single pass (AAC encoder delay would leave gaps at
+      segment joins), in parallel with the video segments
+    - the concat demuxer then joins the video segments by stream copy and muxes in the audio
+    - the duration is checked; with verify=True the result is also compared to the standardized clips
+      by SSIM, and anything below SEGMENT_SSIM_MIN counts as a failure so the caller falls back to a
+      single-pass encode
+"""
+
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from test_merge import FFMPEG_PATH, TEMP_DIR, STANDARD_VIDEO_ARGS, STANDARD_AUDIO_ARGS
+from ffmpeg_supervisor import run_process
+import metrics
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", max(2, (os.cpu_count() or 2) // 4)))  # 并行编码的段数 / Segments encoded in parallel
+SEGMENT_MIN_SECONDS = float(os.environ.get("SEGMENT_MIN_SECONDS", 20))  # 每段的最短时长 / Minimum segment length
+SEGMENT_SSIM_MIN = float(os.environ.get("SEGMENT_SSIM_MIN", 0.95))  # 校验时允许的最低SSIM / Lowest SSIM accepted when verifying
+DURATION_TOLERANCE = 0.2  # 拼接后时长允许的误差（秒）/ Allowed duration error after joining (seconds)
+
+
+def plan_segments(durations, workers=SEGMENT_WORKERS, min_seconds=SEGMENT_MIN_SECONDS):
+    """在片段边界处把时间线分段，段数约为并行数的两倍以便均衡负载
+    Split the timeline at clip boundaries into about twice as many segments as workers, for load balancing
+
+    Args:
+        durations: 按顺序排列的片段时长 / Clip durations in order
+
+    Returns:
+        list: 每段包含的片段下标列表 / Clip index lists, one per segment
+    """
+    total = sum(durations)
+    target = max(min_seconds, total / max(1, workers * 2))
+    segments, current, length = [], [], 0.0
+    for idx, duration in enumerate(durations):
+        current.append(idx)
+        length += duration
+        if length >= target:
+            segments.append(current)
+            current, length = [], 0.0
+    if current:
+        # 太短的最后一段并入前一段 / A short trailing segment joins the previous one
+        if segments and length < target / 2:
+            segments[-1] += current
+        else:
+            segments.append(current)
+    return segments
+
+
+def _concat_filter(count, video, audio):
+    inputs = "".join(f"[{idx}:v:0]" if video else f"[{idx}:a:0]" for idx in range(count))
+    label = "[outv]" if video else "[outa]"
+    return f"{inputs}concat=n={count}:v={int(video)}:a={int(audio)}{label}"
+
+
+def encode_video_segment(paths, output_path, threads):
+    """用concat滤镜把一段内的片段编码成一个纯视频的MPEG-TS
+    Encode one segment's clips into a video-only MPEG-TS with the concat filter"""
+    command = [FFMPEG_PATH, "-y"]
+    for path in paths:
+        command += ["-i", path]
+    command += [
+        "-filter_complex", _concat_filter(len(paths), video=True, audio=False),
+        "-map", "[outv]",
+        *STANDARD_VIDEO_ARGS,
+        "-threads", str(threads),
+        "-an",
+        "-bsf:v", "h264_mp4toannexb",
+        "-f", "mpegts",
+        output_path
+    ]
+    return run_process(command, job_name="merge.segment").returncode == 0
+
+
+def encode_audio_track(paths, output_path):
+    """一次编码整条音轨 / Encode the whole audio track in one pass"""
+    command = [FFMPEG_PATH, "-y"]
+    for path in paths:
+        command += ["-i", path]
+    command += [
+        "-filter_complex", _concat_filter(len(paths), video=False, audio=True),
+        "-map", "[outa]",
+        "-vn",
+        *STANDARD_AUDIO_ARGS,
+        output_path
+    ]
+    return run_process(command, job_name="merge.audio").returncode == 0
+
+
+def stitch(segment_paths, audio_path, output_path, temp_dir=TEMP_DIR):
+    """复制流拼接视频段并混入音轨 / Join the video segments by stream copy and mux in the audio"""
+    list_path = os.path.join(temp_dir, "segments.txt")
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in segment_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+    command = [
+        FFMPEG_PATH, "-y",
+        "-f", "concat", "-safe", "0", "-i", list_path,
+        "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-c", "copy",
+        "-movflags", "+faststart",
+        output_path
+    ]
+    return run_process(command, job_name="merge.stitch").returncode == 0
+
+
+def measure_ssim(output_path, reference_paths, temp_dir=TEMP_DIR):
+    """输出与参考片段（按顺序拼接）之间的平均SSIM，失败时返回None
+    Mean SSIM of the output against the reference clips joined in order, None on failure"""
+    list_path = os.path.join(temp_dir, "ssim_reference.txt")
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in reference_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+    command = [
+        FFMPEG_PATH, "-i", output_path,
+        "-f", "concat", "-safe", "0", "-i", list_path,
+        "-lavfi", "[0:v][1:v]ssim",
+        "-f", "null", "-"
+    ]
+    result = run_process(command, job_name="merge.ssim")
+    match = re.search(r"All:\s*([0-9.]+)", result.stderr or "")
+    return float(match.group(1)) if result.returncode == 0 and match else None
+
+
+def segmented_concat(video_paths, output_path, temp_dir=TEMP_DIR, workers=SEGMENT_WORKERS, verify=False):
+    """分段并行地重新编码拼接标准化后的片段
+    Re-encode and join standardized clips with segment-parallel encoding
+
+    Args:
+        video_paths: 按顺序排列的标准化片段 / Standardized clips in order
+        workers: 并行编码的段数，每个libx264进程分到cpu_count/workers个线程
+                 Segments encoded in parallel; each libx264 process gets cpu_count/workers threads
+        verify: 是否用SSIM和标准化片段比较 / Compare against the standardized clips with SSIM
+
+    Returns:
+        bool: 是否成功；失败时调用方应退回单次编码 / Whether it succeeded; on failure the caller should fall back to a single-pass encode
+    """
+    from test_duration import get_video_duration_native
+
+    durations = [get_video_duration_native(path) or 0.0 for path in video_paths]
+    segments = plan_segments(durations, workers)
+    if len(segments) < 2:
+        return False
+    threads = max(1, (os.cpu_count() or 2) // workers)
+    segment_paths = [os.path.join(temp_dir, f"segment_{idx:03d}.ts") for idx in range(len(segments))]
+    audio_path = os.path.join(temp_dir, "segment_audio.m4a")
+    logger.info(f"分段并行编码: {len(segments)} 段，{workers} 个并行编码，每个 {threads} 线程")
+
+    start = time.time()
+    with metrics.span("merge.segmented", segments=len(segments), workers=workers) as span:
+        with ThreadPoolExecutor(max_workers=workers + 1) as pool:
+            audio_future = pool.submit(encode_audio_track, video_paths, audio_path)
+            # 先提交最长的段 / Longest segments first
+            order = sorted(range(len(segments)), key=lambda idx: -sum(durations[i] for i in segments[idx]))
+            futures = {
+                idx: pool.submit(encode_video_segment, [video_paths[i] for i in segments[idx]], segment_paths[idx], threads)
+                for idx in order
+            }
+            ok = audio_future.result() and all(futures[idx].result() for idx in range(len(segments)))
+        ok = ok and stitch(segment_paths, audio_path, output_path, temp_dir)
+
+        if ok:
+            actual = get_video_duration_native(output_path) or 0.0
+            if abs(actual - sum(durations)) > DURATION_TOLERANCE + 0.05 * len(segments):
+                logger.warning(f"分段拼接后时长不一致: {actual:.2f}s / {sum(durations):.2f}s")
+                ok = False
+        if ok and verify:
+            ssim = measure_ssim(output_path, video_paths, temp_dir)
+            span.set(ssim=ssim)
+            logger.info(f"SSIM: {ssim if ssim is not None else '?'}（最低 {SEGMENT_SSIM_MIN}）")
+            if ssim is None or ssim < SEGMENT_SSIM_MIN:
+                ok = False
+        span.status = "ok" if ok else "error"
+
+    for path in segment_paths + [audio_path]:
+        if os.path.exists(path):
+            os.remove(path)
+    if ok:
+        logger.info(f"分段并行编码完成，用时 {time.time() - start:.1f}s")
+    return ok
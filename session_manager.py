@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Instagram会话管理：只验证一次，并共享同一个已登录的Instaloader
+Instagram session manager: validate once and share one authenticated Instaloader
+
+验证结果缓存在会话文件旁边（session-<用户名>.validated.json），有效期内不再调用test_login()；
+ensure_logged_in_user和download_saved_videos使用同一个Instaloader。只有请求真的因为登录失效而失败时
+才重新验证。
+The validation result is cached next to the session file (session-<username>.validated.json) and
+test_login() is not called again within its TTL; ensure_logged_in_user and download_saved_videos share
+one Instaloader. The session is re-validated only when a request actually fails with an auth error.
+"""
+
+import os
+import json
+import time
+import random
+import threading
+
+from instaloader import Instaloader
+
+from test_login import get_session_file_path
+import metrics
+from log_setup import get_logger
+
+logger = get_logger("login")
+
+VALIDATION_TTL = float(os.environ.get("IG_SESSION_TTL", 6 * 3600))  # 验证结果有效期（秒）/ Validation cache TTL (seconds)
+MAX_RETRIES = 3  # 验证的最大尝试次数 / Max validation attempts
+RETRY_DELAY_INITIAL = 15  # 初始重试延迟（秒）/ Initial retry delay (seconds)
+RETRY_DELAY_FACTOR = 1.5  # 重试延迟递增因子 / Retry delay growth factor
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def create_loader():
+    """创建下载使用的Instaloader
+    Create the Instaloader used for downloads"""
+    return Instaloader(
+        sleep=True,                 # 启用请求间延迟
+        quiet=True,                 # 不显示额外信息
+        download_comments=False,    # 不下载评论
+        download_geotags=False,     # 不下载地理标签
+        compress_json=False,        # 不压缩JSON
+        download_video_thumbnails=False,  # 不下载视频缩略图
+        request_timeout=60,         # 请求超时设置为60秒
+        max_connection_attempts=3   # 限制连接尝试次数
+    )
+
+
+def is_rate_limited(error):
+    """Instagram要求等待几分钟的401错误
+    The 401 error where Instagram asks to wait a few minutes"""
+    return "401 Unauthorized" in str(error) and "Please wait a few minutes" in str(error)
+
+
+class SessionManager:
+    """一个用户的会话：加载一次，验证结果带有效期缓存
+    One user's session: loaded once, with a TTL-cached validation result"""
+
+    def __init__(self, username, session_path=None):
+        self.username = username
+        self.session_path = session_path or get_session_file_path(username)
+        self.cache_path = self.session_path + ".validated.json"
+        self.loader = None
+        self.validated = False
+
+    def _cache_is_fresh(self):
+        """验证缓存是否仍然有效（未过期，会话文件也没有变化）
+        Whether the validation cache is still valid (not expired, session file unchanged)"""
+        if not os.path.exists(self.cache_path) or not os.path.exists(self.session_path):
+            return False
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (
+            cache.get("username") == self.username
+            and cache.get("session_mtime") == os.path.getmtime(self.session_path)
+            and time.time() - cache.get("validated_at", 0) < VALIDATION_TTL
+        )
+
+    def _write_cache(self):
+        tmp_file = self.cache_path + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({
+                "username": self.username,
+                "validated_at": time.time(),
+                "session_mtime": os.path.getmtime(self.session_path),
+            }, f)
+        os.replace(tmp_file, self.cache_path)
+
+    def invalidate(self):
+        """丢弃验证缓存，下次使用时重新验证
+        Drop the validation cache so the next use validates again"""
+        self.validated = False
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    def _load(self):
+        """从会话文件加载Instaloader（不访问网络）
+        Load the Instaloader from the session file (no network access)"""
+        if self.loader is None:
+            loader = create_loader()
+            loader.load_session_from_file(self.username, filename=self.session_path)
+            self.loader = loader
+        return self.loader
+
+    def validate(self, force=False):
+        """确认会话有效：缓存有效时直接返回，否则调用test_login()（遇到限流会等待重试）
+        Make sure the session is valid: trust a fresh cache, otherwise call test_login() (waiting on rate limits)
+
+        Returns:
+            bool: 会话是否有效 / Whether the session is valid
+        """
+        if not os.path.exists(self.session_path):
+            logger.error(f"❌ 会话文件不存在: {self.session_path}")
+            return False
+        if self.validated and not force:
+            return True
+        if not force and self._cache_is_fresh():
+            self._load()
+            self.validated = True
+            return True
+
+        for attempt in range(MAX_RETRIES):
+            try:
+                loader = self._load()
+                logger.info("正在验证Instagram登录状态...")
+                if loader.test_login():
+                    logger.info(f"✅ 成功登录为: {self.username}")
+                    self.validated = True
+                    self._write_cache()
+                    return True
+                logger.error("❌ 现有会话已过期，需要重新登录")
+                self.invalidate()
+                return False
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                wait_time = RETRY_DELAY_INITIAL * (RETRY_DELAY_FACTOR ** attempt)
+                if is_rate_limited(e):
+                    metrics.incr("rate_limit_wait_seconds", wait_time, stage="login")
+                    logger.warning(f"\n⚠️ Instagram要求等待! 将等待 {wait_time:.0f} 秒后重试...")
+                else:
+                    logger.error(f"❌ 验证会话时出错: {str(e)}，{wait_time:.0f} 秒后重试")
+                    self.loader = None  # 会话文件可能已损坏，重新加载 / The session file may be broken, reload it
+                metrics.incr("retries", stage="login")
+                if attempt + 1 < MAX_RETRIES:
+                    time.sleep(wait_time)
+        logger.error(f"❌ 已达到最大重试次数 ({MAX_RETRIES})，放弃尝试")
+        return False
+
+    def get_loader(self):
+        """返回已验证的Instaloader，会话无效时返回None
+        Return the validated Instaloader, None if the session is invalid"""
+        return self.loader if self.validate() else None
+
+    def revalidate(self):
+        """请求因为登录失效而失败后调用：丢弃缓存并重新验证
+        Call after a request failed with an auth error: drop the cache and validate again
+
+        Returns:
+            bool: 会话是否仍然有效 / Whether the session is still valid
+        """
+        self.invalidate()
+        self.loader = None  # 会话文件可能已被重新登录更新 / The session file may have been refreshed by a new login
+        time.sleep(random.uniform(1, 3))
+        return self.validate(force=True)
+
+
+def get_manager(username, session_path=None):
+    """返回用户共享的SessionManager
+    Return the shared SessionManager for a user
+
+    Args:
+        session_path: 可选，会话文件路径（多租户时每个流水线一个），默认按用户名查找
+                      Optional session file path (one per pipeline with several tenants), looked up by username by default
+    """
+    with _managers_lock:
+        if username not in _managers:
+            _managers[username] = SessionManager(username, session_path)
+        return _managers[username]
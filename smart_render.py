@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+智能渲染合并：只重新编码片段拼接处的关键帧区间
+Smart-render merge: re-encode only the keyframe intervals at clip joins
+
+符合标准规格的片段，内部直接复制流，只把开头和结尾的GOP重新编码；
+不符合规格的片段仍然先完整标准化。所有片段先写成MPEG-TS（参数集随流携带），
+最后用concat demuxer复制流拼接成MP4。
+Conforming clips have their interior stream-copied and only the first/last GOPs re-encoded;
+non-conforming clips are still fully standardized first. All pieces are written as MPEG-TS
+(parameter sets in-band), then joined into an MP4 by stream copy with the concat demuxer.
+"""
+
+import os
+
+from test_merge import (
+    FFMPEG_PATH, FFPROBE_PATH, TEMP_DIR,
+    STANDARD_VIDEO_FILTER, STANDARD_VIDEO_ARGS, STANDARD_AUDIO_ARGS,
+    probe_video, is_standard_spec, standardize_video,
+)
+from ffmpeg_supervisor import run_process, PROBE_TIMEOUT
+from log_setup import get_logger
+
+logger = get_logger("merge")
+
+# 每个拼接点两侧重新编码的GOP数量 / Number of GOPs re-encoded on each side of a join
+BOUNDARY_GOPS = 1
+# 内部复制区间短于该时长时直接整段重新编码 / Re-encode the whole clip if the copyable interior is shorter than this
+MIN_COPY_SECONDS = 2.0
+
+# ffprobe的profile名称到x264参数的映射 / Map ffprobe profile names to x264 options
+X264_PROFILES = {
+    "Constrained Baseline": "baseline",
+    "Baseline": "baseline",
+    "Main": "main",
+    "High": "high",
+}
+
+
+def get_keyframe_times(video_path):
+    """只读取数据包标志获取关键帧时间（不解码）
+    Get keyframe timestamps by reading packet flags only (no decoding)"""
+    command = [
+        FFPROBE_PATH if os.path.exists(FFPROBE_PATH) else "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0",
+        video_path
+    ]
+    result = run_process(command, timeout=PROBE_TIMEOUT)
+    if result.returncode != 0:
+        return []
+
+    times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def plan_clip(info, keyframes, boundary_gops=BOUNDARY_GOPS):
+    """计算片段的头部编码区间、复制区间和尾部编码区间
+    Compute the head (encode), interior (copy) and tail (encode) ranges of a clip
+
+    Returns:
+        (head_end, tail_start) 或 None（片段太短，需要整段重新编码）
+        (head_end, tail_start) or None if the clip is too short and must be fully re-encoded
+    """
+    if len(keyframes) < 2 * boundary_gops + 1:
+        return None
+    head_end = keyframes[boundary_gops]
+    tail_start = keyframes[-boundary_gops]
+    if tail_start >= info["duration"] or tail_start - head_end < MIN_COPY_SECONDS:
+        return None
+    return head_end, tail_start
+
+
+def _encoder_match_args(info):
+    """让边界编码的码流参数与被复制的内部一致
+    Make the boundary encodes match the stream parameters of the copied interior"""
+    args = []
+    profile = X264_PROFILES.get(info.get("profile"))
+    if profile:
+        args += ["-profile:v", profile]
+    if info.get("level"):
+        args += ["-level:v", f"{info['level'] / 10:.1f}"]
+    return args
+
+
+def encode_range(input_path, start, end, output_path, info):
+    """按标准参数重新编码[start, end)区间，输出为MPEG-TS
+    Re-encode the [start, end) range with standard parameters, output as MPEG-TS"""
+    command = [FFMPEG_PATH, "-y"]
+    if start > 0:
+        command += ["-ss", f"{start:.6f}"]
+    command += ["-i", input_path]
+    if end is not None:
+        command += ["-t", f"{end - start:.6f}"]
+    command += [
+        "-vf", STANDARD_VIDEO_FILTER,
+        *STANDARD_VIDEO_ARGS,
+        *_encoder_match_args(info),
+        *STANDARD_AUDIO_ARGS,
+        "-bsf:v", "h264_mp4toannexb",
+        "-f", "mpegts",
+        output_path
+    ]
+    result = run_process(command)
+    return result.returncode == 0
+
+
+def copy_range(input_path, start, end, output_path):
+    """直接复制[start, end)区间的流（start必须是关键帧）
+    Stream-copy the [start, end) range (start must be a keyframe)"""
+    command = [
+        FFMPEG_PATH, "-y",
+        "-ss", f"{start:.6f}",
+        "-i", input_path,
+        "-t", f"{end - start:.6f}",
+        "-c", "copy",
+        "-bsf:v", "h264_mp4toannexb",
+        "-avoid_negative_ts", "make_zero",
+        "-f", "mpegts",
+        output_path
+    ]
+    result = run_process(command)
+    return result.returncode == 0
+
+
+def crossfade_join(left_path, left_start, right_path, right_end, duration, output_path, info):
+    """把左片段的尾部和右片段的头部一起编码成一个交叉淡化的连接段
+    Encode the tail of the left clip and the head of the right clip into one crossfaded join piece"""
+    left_length = info["duration"] - left_start
+    filter_complex = (
+        f"[0:v]{STANDARD_VIDEO_FILTER}[va];"
+        f"[1:v]{STANDARD_VIDEO_FILTER}[vb];"
+        f"[va][vb]xfade=transition=fade:duration={duration}:offset={left_length - duration:.6f}[v];"
+        f"[0:a]aresample=48000[aa];[1:a]aresample=48000[ab];"
+        f"[aa][ab]acrossfade=d={duration}[a]"
+    )
+    command = [
+        FFMPEG_PATH, "-y",
+        "-ss", f"{left_start:.6f}", "-i", left_path,
+        "-t", f"{right_end:.6f}", "-i", right_path,
+        "-filter_complex", filter_complex,
+        "-map", "[v]", "-map", "[a]",
+        *STANDARD_VIDEO_ARGS,
+        *_encoder_match_args(info),
+        *STANDARD_AUDIO_ARGS,
+        "-bsf:v", "h264_mp4toannexb",
+        "-f", "mpegts",
+        output_path
+    ]
+    result = run_process(command)
+    return result.returncode == 0
+
+
+def prepare_clips(video_paths, temp_dir=TEMP_DIR, boundary_gops=BOUNDARY_GOPS):
+    """探测每个片段：符合规格的保留原文件，不符合的先完整标准化
+    Probe each clip: conforming clips are kept as-is, the rest are fully standardized first
+
+    Returns:
+        列表，每项为 {"path", "info", "plan"}；plan为None表示整段使用 / list of {"path", "info", "plan"}; plan None means use whole file
+    """
+    clips = []
+    for idx, path in enumerate(video_paths):
+        info = probe_video(path)
+        if is_standard_spec(info):
+            keyframes = get_keyframe_times(path)
+            clips.append({"path": path, "info": info, "plan": plan_clip(info, keyframes, boundary_gops), "conforming": True})
+            continue
+
+        logger.info(f"片段不符合标准规格，完整标准化: {os.path.basename(path)}")
+        standardized = os.path.join(temp_dir, f"smart_std_{idx:03d}.mp4")
+        if not standardize_video(path, standardized):
+            logger.error(f"❌ 标准化视频失败: {path}")
+            return None
+        info = probe_video(standardized)
+        if not info:
+            return None
+        keyframes = get_keyframe_times(standardized)
+        clips.append({"path": standardized, "info": info, "plan": plan_clip(info, keyframes, boundary_gops), "conforming": False})
+    return clips
+
+
+def build_pieces(clips, temp_dir=TEMP_DIR, crossfade=0.0):
+    """为所有片段生成按顺序排列的TS分段
+    Produce the ordered TS pieces for all clips
+
+    Returns:
+        (clip_pieces, encoded_seconds, copied_seconds)，clip_pieces每项是一个片段的分段列表；失败时 (None, 0, 0)
+        (clip_pieces, encoded_seconds, copied_seconds), clip_pieces holds one piece list per clip; (None, 0, 0) on failure
+    """
+    clip_pieces = []
+    encoded_seconds = 0.0
+    copied_seconds = 0.0
+
+    def piece_path(idx, part):
+        return os.path.join(temp_dir, f"smart_{idx:03d}_{part}.ts")
+
+    for idx, clip in enumerate(clips):
+        path, info, plan = clip["path"], clip["info"], clip["plan"]
+        pieces = []
+        clip_pieces.append(pieces)
+        duration = info["duration"]
+        fade_in = crossfade > 0 and idx > 0
+        fade_out = crossfade > 0 and idx < len(clips) - 1
+
+        if plan is None:
+            # 片段太短，无法拆分 / Clip too short to split
+            if fade_in or fade_out:
+                logger.info(f"片段太短，跳过交叉淡化: {os.path.basename(path)}")
+            out = piece_path(idx, "full")
+            if not encode_range(path, 0, None, out, info):
+                return None, 0, 0
+            pieces.append(out)
+            encoded_seconds += duration
+            continue
+
+        head_end, tail_start = plan
+        left = clips[idx - 1] if idx > 0 else None
+
+        # 头部：交叉淡化时已经包含在上一个连接段里 / Head: already part of the previous join when crossfading
+        if not (fade_in and left["plan"] is not None):
+            out = piece_path(idx, "head")
+            if not encode_range(path, 0, head_end, out, info):
+                return None, 0, 0
+            pieces.append(out)
+            encoded_seconds += head_end
+
+        out = piece_path(idx, "body")
+        if not copy_range(path, head_end, tail_start, out):
+            return None, 0, 0
+        pieces.append(out)
+        copied_seconds += tail_start - head_end
+
+        right = clips[idx + 1] if idx < len(clips) - 1 else None
+        if fade_out and right["plan"] is not None:
+            # 尾部和下一个片段的头部合成一个连接段 / Tail and the next head become one join piece
+            out = piece_path(idx, "join")
+            fade = min(crossfade, 0.9 * (duration - tail_start), 0.9 * right["plan"][0])
+            if not crossfade_join(path, tail_start, right["path"], right["plan"][0], fade, out, info):
+                return None, 0, 0
+            encoded_seconds += (duration - tail_start) + right["plan"][0]
+        else:
+            out = piece_path(idx, "tail")
+            if not encode_range(path, tail_start, duration, out, info):
+                return None, 0, 0
+            encoded_seconds += duration - tail_start
+        pieces.append(out)
+
+    return clip_pieces, encoded_seconds, copied_seconds
+
+
+def smart_merge(video_paths, output_path, temp_dir=TEMP_DIR, boundary_gops=BOUNDARY_GOPS, crossfade=0.0, bumpers=None):
+    """智能渲染合并视频：只重新编码拼接处的GOP，其余部分复制流
+    Smart-render merge: re-encode only the GOPs at joins, stream-copy everything else
+
+    Args:
+        video_paths: 按顺序排列的源视频路径 / Ordered source video paths
+        output_path: 输出MP4路径 / Output MP4 path
+        temp_dir: 中间文件目录 / Directory for intermediate files
+        boundary_gops: 每个拼接点两侧重新编码的GOP数 / GOPs re-encoded on each side of a join
+        crossfade: 交叉淡化时长（秒），0表示直接切换 / Crossfade length in seconds, 0 for hard cuts
+        bumpers: 可选，TS格式的片头/片尾/转场素材，见bumpers.get_bumpers / Optional TS bumpers, see bumpers.get_bumpers
+
+    Returns:
+        bool: 是否成功 / Whether the merge succeeded
+    """
+    os.makedirs(temp_dir, exist_ok=True)
+    clips = prepare_clips(video_paths, temp_dir, boundary_gops)
+    if not clips:
+        return False
+
+    conforming = sum(1 for clip in clips if clip["conforming"])
+    logger.info(f"智能渲染: {conforming}/{len(clips)} 个片段符合标准规格，内部直接复制")
+
+    clip_pieces, encoded_seconds, copied_seconds = build_pieces(clips, temp_dir, crossfade)
+    if not clip_pieces:
+        logger.error("❌ 生成分段失败")
+        return False
+
+    if bumpers:
+        from bumpers import splice_bumpers
+        if crossfade > 0 and bumpers.get("transition"):
+            # 交叉淡化的连接段跨越两个片段，不能再插入转场 / Crossfade joins span two clips, no room for a transition
+            logger.info("已启用交叉淡化，忽略转场素材")
+            bumpers = {name: path for name, path in bumpers.items() if name != "transition"}
+        pieces = [piece for group in splice_bumpers(clip_pieces, bumpers)
+                  for piece in (group if isinstance(group, list) else [group])]
+    else:
+        pieces = [piece for group in clip_pieces for piece in group]
+
+    list_file = os.path.join(temp_dir, "smart_list.txt")
+    with open(list_file, "w", encoding="utf-8") as f:
+        for piece in pieces:
+            abs_path = os.path.abspath(piece).replace('\\', '\\\\')
+            f.write(f"file '{abs_path}'\n")
+
+    command = [
+        FFMPEG_PATH, "-y",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", list_file,
+        "-c", "copy",
+        "-bsf:a", "aac_adtstoasc",
+        "-movflags", "+faststart",
+        output_path
+    ]
+    result = run_process(command)
+    if result.returncode != 0:
+        logger.error(f"合并失败: {result.stderr}")
+        return False
+
+    logger.info(f"重新编码 {encoded_seconds:.1f} 秒，直接复制 {copied_seconds:.1f} 秒")
+    return True
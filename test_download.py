@@ -5,9 +5,14 @@ import time
 import random
 import json
 from contextlib import contextmanager
-from instaloader import Instaloader, Profile, Post, LoginRequiredException
-from test_login import get_session_file_path, ensure_logged_in_user
+from instaloader import Profile, Post, LoginRequiredException
+from test_login import ensure_logged_in_user
+from session_manager import get_manager, is_rate_limited
 from tqdm import tqdm
+import metrics
+from log_setup import get_logger
+
+logger = get_logger("download")
 
 download_dir = "test_downloads"
 LOG_DIR = "test_logs"
@@ -15,7 +20,6 @@ LOG_FILE = os.path.join(LOG_DIR, "test_downloaded.log")
 
 # 修改重试配置，减少等待时间
 MAX_RETRIES = 3  # 减少最大重试次数，避免用户等待太久
-RETRY_DELAY_INITIAL = 15  # 减少初始重试延迟（秒）
 RETRY_DELAY_FACTOR = 1.5  # 重试延迟递增因子
 RATE_LIMIT_DELAY = 30  # 遇到速率限制时的初始等待时间
 
@@ -71,110 +75,59 @@ def format_duration(seconds: float) -> str:
         return f"{sec}秒"
 
 
-def download_saved_videos(username: str) -> int:
+def download_saved_videos(username: str, loader=None, target_dir: str = None, log_file: str = None,
+                          session_path: str = None) -> int:
+    """下载已保存的视频帖子
+    Download saved video posts
+
+    Args:
+        username: Instagram用户名 / Instagram username
+        loader: 已验证的Instaloader（来自session_manager），为None时使用该用户共享的会话
+                A validated Instaloader (from session_manager); the user's shared session is used if None
+        target_dir: 可选，下载目录，默认download_dir / Optional download directory, defaults to download_dir
+        log_file: 可选，已下载记录文件，默认LOG_FILE / Optional downloaded-shortcode log, defaults to LOG_FILE
+        session_path: 可选，会话文件路径（多租户流水线）/ Optional session file path (multi-tenant pipelines)
+
+    Returns:
+        int: 下载的视频数量 / Number of downloaded videos
+    """
     start_time = time.time()
+    target_dir = target_dir or download_dir
+    log_file = log_file or LOG_FILE
 
-    os.makedirs(LOG_DIR, exist_ok=True)
-    os.makedirs(download_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+    os.makedirs(target_dir, exist_ok=True)
     
-    # 尝试恢复会话
-    retry_count = 0
-    L = None
-    session_path = get_session_file_path(username)
+    # 使用共享的已验证会话，验证结果有缓存，不会重复调用test_login()
+    # Use the shared validated session; validation is cached so test_login() is not repeated
+    manager = get_manager(username, session_path)
 
     # Add session file existence check
-    if not os.path.exists(session_path):
-        print(f"❌ 会话文件不存在: {session_path}")
-        print(f"❌ 请先运行登录程序创建会话")
+    if not os.path.exists(manager.session_path):
+        logger.error(f"❌ 会话文件不存在: {manager.session_path}")
+        logger.error(f"❌ 请先运行登录程序创建会话")
         return 0
 
-    print("\n🔄 正在连接Instagram...(按Ctrl+C可随时取消)")
-    
-    while retry_count < MAX_RETRIES:
+    L = loader
+    if L is None:
+        logger.info("\n🔄 正在连接Instagram...(按Ctrl+C可随时取消)")
         try:
-            print(f"尝试加载Instagram会话... (尝试 {retry_count + 1}/{MAX_RETRIES})")
-            L = Instaloader(
-                sleep=True,                 # 启用请求间延迟
-                quiet=True,                 # 不显示额外信息
-                download_comments=False,    # 不下载评论
-                download_geotags=False,     # 不下载地理标签
-                compress_json=False,        # 不压缩JSON
-                download_video_thumbnails=False,  # 不下载视频缩略图
-                request_timeout=60,         # 请求超时设置为60秒
-                max_connection_attempts=3   # 限制连接尝试次数
-            )
-            
-            L.load_session_from_file(username, filename=session_path)
-            
-            # 添加随机延迟，避免被限制，但减少等待时间
-            delay = random.uniform(1, 3)  # 减少等待时间
-            print(f"准备验证登录状态，等待 {delay:.1f} 秒...")
-            time.sleep(delay)
-            
-            # 检查登录状态
-            try:
-                # 添加明确的提示
-                print("正在验证Instagram登录状态...")
-                if L.test_login():
-                    print(f"✅ 成功登录为: {username}")
-                    break
-                else:
-                    print("❌ 登录测试失败，等待后重试...")
-            except KeyboardInterrupt:
-                print("\n\n⚠️ 用户取消操作")
-                return 0
-            except Exception as e:
-                if "401 Unauthorized" in str(e) and "Please wait a few minutes" in str(e):
-                    wait_time = RETRY_DELAY_INITIAL * (RETRY_DELAY_FACTOR ** retry_count)
-                    print(f"\n⚠️ Instagram要求等待! 将等待 {wait_time:.0f} 秒后重试...")
-                    print("(您可以按Ctrl+C取消操作)")
-                    try:
-                        # 使用分段等待，让用户可以更容易取消
-                        step = 5
-                        for i in range(0, int(wait_time), step):
-                            time.sleep(step)
-                            remaining = wait_time - i - step
-                            if remaining > 0:
-                                print(f"⏳ 还需等待 {remaining:.0f} 秒...")
-                    except KeyboardInterrupt:
-                        print("\n\n⚠️ 用户取消等待")
-                        return 0
-                    retry_count += 1
-                    continue
-                else:
-                    raise
-                    
+            L = manager.get_loader()
         except KeyboardInterrupt:
-            print("\n\n⚠️ 用户取消操作")
+            logger.warning("\n\n⚠️ 用户取消操作")
             return 0
         except LoginRequiredException:
-            print("❌ 会话已过期，需要重新登录")
-            print("提示：请运行 test_login.py 重新登录")
+            logger.error("❌ 会话已过期，需要重新登录")
+            logger.info("提示：请运行 test_login.py 重新登录")
             return 0
-        except Exception as e:
-            print(f"❌ 加载会话时出错: {str(e)}")
-            wait_time = RETRY_DELAY_INITIAL * (RETRY_DELAY_FACTOR ** retry_count)
-            print(f"等待 {wait_time:.0f} 秒后重试...")
-            try:
-                time.sleep(wait_time)
-            except KeyboardInterrupt:
-                print("\n\n⚠️ 用户取消等待")
-                return 0
-            retry_count += 1
-            
-            if retry_count >= MAX_RETRIES:
-                print(f"❌ 已达到最大重试次数 ({MAX_RETRIES})，放弃尝试")
-                print("建议：稍后再试或运行 test_login.py 重新登录")
-                return 0
-    
-    # 如果所有重试都失败
-    if L is None or retry_count >= MAX_RETRIES:
-        print("❌ 无法连接到Instagram，请稍后再试")
-        print("建议：Instagram可能暂时限制了您的访问，请等待几小时后再尝试")
+
+    if L is None:
+        logger.error("❌ 无法连接到Instagram，请稍后再试")
+        logger.info("建议：Instagram可能暂时限制了您的访问，请等待几小时后再尝试，或运行 test_login.py 重新登录")
         return 0
         
     try:
-        print("\n🔍 正在获取已保存的帖子...")
+        logger.info("\n🔍 正在获取已保存的帖子...")
         
         # 添加获取个人资料的重试逻辑
         profile = None
@@ -184,38 +137,46 @@ def download_saved_videos(username: str) -> int:
             try:
                 # 添加较短的随机延迟
                 delay = random.uniform(1, 3)
-                print(f"请求前等待 {delay:.1f} 秒...")
+                logger.info(f"请求前等待 {delay:.1f} 秒...")
                 time.sleep(delay)
                 
                 profile = Profile.from_username(L.context, username)
             except KeyboardInterrupt:
-                print("\n\n⚠️ 用户取消操作")
+                logger.warning("\n\n⚠️ 用户取消操作")
                 return 0
+            except LoginRequiredException:
+                # 请求真的因为登录失效而失败时才重新验证 / Re-validate only when a request actually fails on auth
+                logger.warning("⚠️ 登录状态失效，重新验证会话...")
+                if not manager.revalidate():
+                    raise
+                L = manager.loader
+                retry_count += 1
             except Exception as e:
-                if "401 Unauthorized" in str(e) and "Please wait a few minutes" in str(e):
+                if is_rate_limited(e):
                     wait_time = RATE_LIMIT_DELAY * (RETRY_DELAY_FACTOR ** retry_count)
-                    print(f"\n⚠️ 请求被限制! 将等待 {wait_time:.0f} 秒后重试...")
-                    print("(您可以按Ctrl+C取消操作)")
+                    metrics.incr("rate_limit_wait_seconds", wait_time, stage="profile")
+                    logger.warning(f"\n⚠️ 请求被限制! 将等待 {wait_time:.0f} 秒后重试...")
+                    logger.info("(您可以按Ctrl+C取消操作)")
                     try:
                         for i in range(0, int(wait_time), 5):
                             time.sleep(5)
                             remaining = wait_time - i - 5
                             if remaining > 0:
-                                print(f"⏳ 还需等待 {remaining:.0f} 秒...")
+                                logger.info(f"⏳ 还需等待 {remaining:.0f} 秒...")
                     except KeyboardInterrupt:
-                        print("\n\n⚠️ 用户取消等待")
+                        logger.warning("\n\n⚠️ 用户取消等待")
                         return 0
                     retry_count += 1
                 else:
-                    print(f"❌ 获取个人资料时出错: {str(e)}")
+                    logger.error(f"❌ 获取个人资料时出错: {str(e)}")
                     raise
                     
         if profile is None:
-            print("❌ 无法获取个人资料，请稍后再试")
+            logger.error("❌ 无法获取个人资料，请稍后再试")
             return 0
             
         # 以分批方式获取已保存的帖子，避免一次性请求过多
-        print("正在分批获取已保存的帖子...")
+        logger.info("正在分批获取已保存的帖子...")
         all_posts = []
         
         # 创建一个生成器
@@ -226,6 +187,7 @@ def download_saved_videos(username: str) -> int:
         try:
             while True:
                 batch = []
+                page_start = time.time()
                 for _ in range(batch_size):
                     try:
                         post = next(saved_posts_generator)
@@ -233,37 +195,38 @@ def download_saved_videos(username: str) -> int:
                     except StopIteration:
                         break
                     except KeyboardInterrupt:
-                        print("\n\n⚠️ 用户取消操作")
+                        logger.warning("\n\n⚠️ 用户取消操作")
                         return 0
                 
                 if not batch:
                     break
+                metrics.record_span("download.listing_page", time.time() - page_start, posts=len(batch))
                     
                 all_posts.extend(batch)
-                print(f"已获取 {len(all_posts)} 个保存的帖子...")
+                logger.info(f"已获取 {len(all_posts)} 个保存的帖子...")
                 
                 # 添加较短的随机延迟，避免被限制
                 if len(all_posts) % (batch_size * 2) == 0:
                     delay = random.uniform(2, 5)  # 减少等待时间
-                    print(f"休息一下，等待 {delay:.1f} 秒...")
+                    logger.info(f"休息一下，等待 {delay:.1f} 秒...")
                     try:
                         time.sleep(delay)
                     except KeyboardInterrupt:
-                        print("\n\n⚠️ 用户取消操作")
+                        logger.warning("\n\n⚠️ 用户取消操作")
                         return 0
         except KeyboardInterrupt:
-            print("\n\n⚠️ 用户取消操作")
+            logger.warning("\n\n⚠️ 用户取消操作")
             return len(all_posts) > 0
         except Exception as e:
-            print(f"⚠️ 获取帖子时遇到错误: {str(e)}")
-            print(f"将使用已获取的 {len(all_posts)} 个帖子继续处理")
+            logger.warning(f"⚠️ 获取帖子时遇到错误: {str(e)}")
+            logger.info(f"将使用已获取的 {len(all_posts)} 个帖子继续处理")
             
         if not all_posts:
-            print("❌ 没有找到任何已保存的帖子")
+            logger.error("❌ 没有找到任何已保存的帖子")
             return 0
             
-        print(f"共获取 {len(all_posts)} 个已保存的帖子")
-        downloaded_codes = load_downloaded_shortcodes(LOG_FILE)
+        logger.info(f"共获取 {len(all_posts)} 个已保存的帖子")
+        downloaded_codes = load_downloaded_shortcodes(log_file)
 
         # 只保留未下载的视频
         video_posts = [p for p in all_posts if is_video_post(p) and p.shortcode not in downloaded_codes]
@@ -273,15 +236,17 @@ def download_saved_videos(username: str) -> int:
         newly_downloaded = []
 
         if not video_posts:
-            print("没有新的视频需要下载")
+            logger.info("没有新的视频需要下载")
             return 0
             
-        print(f"\n📥 发现 {len(video_posts)} 个新视频需要下载")
+        logger.info(f"\n📥 发现 {len(video_posts)} 个新视频需要下载")
             
         progress_bar = tqdm(video_posts, desc="正在下载视频", unit="个")
 
         for post in progress_bar:
             retry_count = 0
+            post_start = time.time()
+            downloaded = False
             while retry_count < MAX_RETRIES:
                 try:
                     # 添加较短的下载前随机延迟
@@ -289,30 +254,38 @@ def download_saved_videos(username: str) -> int:
                     time.sleep(delay)
                     
                     with suppress_stdout_stderr():
-                        L.download_post(post, target=download_dir)
+                        L.download_post(post, target=target_dir)
 
                     # 清理非视频文件
-                    clean_non_video_files(download_dir)
+                    clean_non_video_files(target_dir)
                     newly_downloaded.append(post.shortcode)
                     count_downloaded += 1
+                    downloaded = True
                     break
                 except KeyboardInterrupt:
-                    print("\n\n⚠️ 用户取消下载")
+                    logger.warning("\n\n⚠️ 用户取消下载")
                     # 保存已下载的内容
                     if newly_downloaded:
-                        save_new_shortcodes(newly_downloaded, LOG_FILE)
+                        save_new_shortcodes(newly_downloaded, log_file)
                     return count_downloaded
+                except LoginRequiredException:
+                    retry_count += 1
+                    logger.warning("⚠️ 登录状态失效，重新验证会话...")
+                    if not manager.revalidate():
+                        raise
+                    L = manager.loader
                 except Exception as e:
-                    if "401 Unauthorized" in str(e) and "Please wait a few minutes" in str(e):
+                    if is_rate_limited(e):
                         retry_count += 1
                         wait_time = min(RATE_LIMIT_DELAY * (RETRY_DELAY_FACTOR ** retry_count), 120)  # 限制最大等待时间
+                        metrics.incr("rate_limit_wait_seconds", wait_time, stage="download")
                         progress_bar.set_description(f"⚠️ 请求被限制! 等待 {wait_time:.0f} 秒")
                         try:
                             time.sleep(wait_time)
                         except KeyboardInterrupt:
-                            print("\n\n⚠️ 用户取消等待")
+                            logger.warning("\n\n⚠️ 用户取消等待")
                             if newly_downloaded:
-                                save_new_shortcodes(newly_downloaded, LOG_FILE)
+                                save_new_shortcodes(newly_downloaded, log_file)
                             return count_downloaded
                         progress_bar.set_description("正在下载视频")
                     else:
@@ -321,33 +294,44 @@ def download_saved_videos(username: str) -> int:
                         time.sleep(3)  # 减少等待时间
                         
                     if retry_count >= MAX_RETRIES:
-                        progress_bar.write(f"❌ 无法下载视频 {post.shortcode}: 已达到最大重试次数")
+                        logger.error(f"❌ 无法下载视频 {post.shortcode}: 已达到最大重试次数")
                         break
 
+            # instaloader默认按发布时间命名文件 / instaloader names files by post time by default
+            video_file = os.path.join(target_dir, post.date_utc.strftime("%Y-%m-%d_%H-%M-%S") + "_UTC.mp4")
+            metrics.record_span(
+                "download.post", time.time() - post_start, status="ok" if downloaded else "error",
+                shortcode=post.shortcode, retries=retry_count,
+                bytes=os.path.getsize(video_file) if downloaded and os.path.exists(video_file) else 0,
+            )
+            if retry_count:
+                metrics.incr("retries", retry_count, stage="download")
+
         progress_bar.close()
 
         if newly_downloaded:
-            save_new_shortcodes(newly_downloaded, LOG_FILE)
+            save_new_shortcodes(newly_downloaded, log_file)
 
         duration = format_duration(time.time() - start_time)
 
-        print(f"\n✅ 下载完成: {count_downloaded} 个视频")
+        logger.info(f"\n✅ 下载完成: {count_downloaded} 个视频")
         if skipped_count > 0:
-            print(f"已跳过: {skipped_count} 个已下载或非视频的帖子")
-        print(f"总耗时: {duration}")
+            logger.info(f"已跳过: {skipped_count} 个已下载或非视频的帖子")
+        logger.info(f"总耗时: {duration}")
 
         return count_downloaded
 
     except KeyboardInterrupt:
-        print("\n\n⚠️ 用户取消操作")
+        logger.warning("\n\n⚠️ 用户取消操作")
         return 0
     except LoginRequiredException:
-        print("❌ 登录已失效，请重新运行登录程序")
+        manager.invalidate()
+        logger.error("❌ 登录已失效，请重新运行登录程序")
         return 0
     except Exception as e:
-        print(f"❌ 发生错误: {str(e)}")
+        logger.error(f"❌ 发生错误: {str(e)}")
         import traceback
-        traceback.print_exc()
+        logger.error(traceback.format_exc())
         return 0
 
 
@@ -361,13 +345,13 @@ def download_new_videos():
     try:
         username = ensure_logged_in_user()
         if not username:
-            print("未找到登录用户，请先运行登录程序")
+            logger.info("未找到登录用户，请先运行登录程序")
             return 0
         
-        print(f"开始为用户 {username} 下载新视频...")
+        logger.info(f"开始为用户 {username} 下载新视频...")
         return download_saved_videos(username)
     except Exception as e:
-        print(f"下载过程中出错: {e}")
+        logger.error(f"下载过程中出错: {e}")
         return 0
 
 
@@ -375,8 +359,16 @@ def download_new_videos():
 download_instagram_videos = download_new_videos
 
 if __name__ == "__main__":
+    import argparse
+    import profiling
+
+    parser = argparse.ArgumentParser(description="下载已保存的视频 / Download saved videos")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+
     username = ensure_logged_in_user()
-    download_saved_videos(username)
+    with profiling.stage("download", args.profile):
+        download_saved_videos(username)
 
 # Import unittest modules only if needed for testing
 # import unittest
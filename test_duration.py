@@ -3,6 +3,16 @@ import os
 import sys
 import glob
 import time
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from log_setup import get_logger
+
+logger = get_logger("duration")
+
+MP4_EXTENSIONS = (".mp4", ".m4v", ".mov", ".m4a")  # 可以直接读取盒子头的格式 / Containers whose box headers are read directly
+VIDEO_EXTENSIONS = MP4_EXTENSIONS + (".mkv", ".webm", ".flv", ".ts", ".avi")  # 扫描目录时包含的格式 / Containers included in scans
+SCAN_WORKERS = 8  # 并行读取的文件数 / Files read in parallel
 
 def format_time(seconds):
     """将秒数格式化为分:秒格式
@@ -18,11 +28,11 @@ def find_latest_video(folder="merged_videos"):
     abs_folder = os.path.abspath(folder)
     videos = glob.glob(os.path.join(abs_folder, "*.mp4"))
     if not videos:
-        print(f"错误: 在 {abs_folder} 文件夹中没有找到视频")  # Error: No videos found in folder
+        logger.error(f"错误: 在 {abs_folder} 文件夹中没有找到视频")  # Error: No videos found in folder
         return None
     
     latest_video = max(videos, key=os.path.getmtime)
-    print(f"找到最新视频: {latest_video}")  # Found latest video
+    logger.info(f"找到最新视频: {latest_video}")  # Found latest video
     return latest_video
 
 def get_video_duration_moviepy(video_path):
@@ -37,11 +47,11 @@ def get_video_duration_moviepy(video_path):
             moviepy_module = importlib.import_module('moviepy.editor')
             VideoFileClip = getattr(moviepy_module, 'VideoFileClip')
         except ImportError:
-            print("MoviePy库未安装，请使用以下命令安装:")  # MoviePy library not installed
-            print("pip install moviepy")
+            logger.info("MoviePy库未安装，请使用以下命令安装:")  # MoviePy library not installed
+            logger.info("pip install moviepy")
             return None
             
-        print("使用MoviePy读取视频时长...")  # Reading video duration using MoviePy
+        logger.info("使用MoviePy读取视频时长...")  # Reading video duration using MoviePy
         
         # 尝试打开视频文件
         try:
@@ -53,26 +63,26 @@ def get_video_duration_moviepy(video_path):
             except:
                 pass
                 
-            print(f"MoviePy方法成功，视频时长: {format_time(duration)}")  # MoviePy method successful
-            print(f"耗时: {format_time(time.time() - start)}")  # Time used
+            logger.info(f"MoviePy方法成功，视频时长: {format_time(duration)}")  # MoviePy method successful
+            logger.info(f"耗时: {format_time(time.time() - start)}")  # Time used
             return duration
         except Exception as clip_error:
-            print(f"打开视频文件失败: {str(clip_error)}")  # Failed to open video file
+            logger.error(f"打开视频文件失败: {str(clip_error)}")  # Failed to open video file
             return None
     except Exception as e:
-        print(f"MoviePy方法失败: {str(e)}")  # MoviePy method failed
+        logger.error(f"MoviePy方法失败: {str(e)}")  # MoviePy method failed
         return None
 
 def get_video_duration_ffprobe(video_path):
     """使用ffprobe获取视频时长"""
     start = time.time()
     try:
-        import subprocess
+        from ffmpeg_supervisor import run_process, PROBE_TIMEOUT
         
         # 检查是否有ffprobe
         ffprobe_path = os.path.join("tools", "ffmpeg", "bin", "ffprobe.exe")
         if not os.path.exists(ffprobe_path):
-            print("本地ffprobe未找到，尝试使用系统路径...")
+            logger.info("本地ffprobe未找到，尝试使用系统路径...")
             ffprobe_path = "ffprobe"  # 尝试使用系统路径
         
         # 使用ffprobe获取视频时长
@@ -84,25 +94,95 @@ def get_video_duration_ffprobe(video_path):
             video_path
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_process(cmd, timeout=PROBE_TIMEOUT)
         duration = float(result.stdout.strip())
         
-        print(f"FFprobe方法成功，视频时长: {format_time(duration)}")
-        print(f"耗时: {format_time(time.time() - start)}")
+        logger.info(f"FFprobe方法成功，视频时长: {format_time(duration)}")
+        logger.info(f"耗时: {format_time(time.time() - start)}")
         return duration
     except Exception as e:
-        print(f"FFprobe方法失败: {str(e)}")
+        logger.error(f"FFprobe方法失败: {str(e)}")
+        return None
+
+def _read_tkhd_duration(f, payload):
+    """读取tkhd中的轨道时长（以mvhd的时间刻度为单位）
+    Read the track duration from tkhd (in the mvhd timescale)"""
+    f.seek(payload)
+    version = f.read(4)[0]
+    if version == 1:
+        return struct.unpack(">QQIIQ", f.read(32))[4]
+    return struct.unpack(">IIIII", f.read(20))[4]
+
+def get_video_duration_native(video_path):
+    """直接从MP4文件头的mvhd/tkhd读取时长，只需要几次小的读取
+    Read the duration straight from the MP4 header (mvhd/tkhd) with a few small reads
+
+    mvhd时长为0时（例如分片MP4）取最长的tkhd时长。不是MP4或结构损坏时返回None。
+    Falls back to the longest tkhd duration when mvhd says 0 (e.g. fragmented MP4).
+    Returns None for non-MP4 or broken files.
+    """
+    from mp4_check import iter_boxes, read_mvhd
+
+    try:
+        file_size = os.path.getsize(video_path)
+        with open(video_path, "rb") as f:
+            for box_type, _, payload, end in iter_boxes(f, 0, file_size):
+                if box_type != b"moov":
+                    continue
+                timescale, duration, track_durations = 0, 0, []
+                for child, _, child_payload, child_end in iter_boxes(f, payload, end):
+                    if child == b"mvhd":
+                        timescale, duration = read_mvhd(f, child_payload)
+                    elif child == b"trak":
+                        for track_box, _, track_payload, _ in iter_boxes(f, child_payload, child_end):
+                            if track_box == b"tkhd":
+                                track_durations.append(_read_tkhd_duration(f, track_payload))
+                if not timescale:
+                    return None
+                # 0xFFFFFFFF表示时长未知 / 0xFFFFFFFF means the duration is unknown
+                track_durations = [value for value in track_durations if value not in (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF)]
+                if not duration and track_durations:
+                    duration = max(track_durations)
+                return duration / timescale if duration else None
+    except (OSError, ValueError, struct.error, IndexError):
         return None
+    return None
+
+def get_video_duration(video_path):
+    """获取视频时长：MP4直接读取文件头，其它格式或读取失败时用ffprobe
+    Get a video's duration: read MP4 headers directly, use ffprobe for other containers or on failure"""
+    if video_path.lower().endswith(MP4_EXTENSIONS):
+        duration = get_video_duration_native(video_path)
+        if duration is not None:
+            return duration
+    return get_video_duration_ffprobe(video_path)
+
+def scan_directory(folder, workers=SCAN_WORKERS):
+    """并行读取目录中所有视频的时长，供合并规划使用
+    Read the durations of every video in a directory in parallel, for merge planning
+
+    Returns:
+        (durations, total): 按文件名排序的{路径: 时长}（无法读取为None）和总时长（秒）
+                            {path: duration} sorted by name (None if unreadable) and the total in seconds
+    """
+    paths = sorted(
+        os.path.join(folder, name) for name in os.listdir(folder)
+        if name.lower().endswith(VIDEO_EXTENSIONS)
+    )
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        durations = dict(zip(paths, executor.map(get_video_duration, paths)))
+    total = sum(value for value in durations.values() if value)
+    return durations, total
 
 def get_serial_number(file_path="serial_number.txt"):
     """从序号文件中读取当前序号"""
     try:
         with open(file_path, "r") as file:
             serial_number = file.read().strip()
-            print(f"当前序号: {serial_number}")
+            logger.info(f"当前序号: {serial_number}")
             return int(serial_number)
     except Exception as e:
-        print(f"读取序号失败: {str(e)}")
+        logger.error(f"读取序号失败: {str(e)}")
         return None
 
 def check_next_video_name():
@@ -113,29 +193,48 @@ def check_next_video_name():
         with open(serial_file, "r") as f:
             try:
                 serial = int(f.read().strip())
-                print(f"\n下一个视频标题将是: 海外离大谱#{serial}")
+                logger.info(f"\n下一个视频标题将是: 海外离大谱#{serial}")
             except:
-                print(f"\n无法读取序号文件: {serial_file}")
+                logger.info(f"\n无法读取序号文件: {serial_file}")
     else:
-        print(f"\n序号文件不存在，下一个视频标题将是: 海外离大谱#1")
+        logger.info(f"\n序号文件不存在，下一个视频标题将是: 海外离大谱#1")
 
 if __name__ == "__main__":
-    print("=== 视频时长测试 ===")
+    import argparse
+
+    parser = argparse.ArgumentParser(description="视频时长工具 / Video duration tool")
+    parser.add_argument("--scan", metavar="DIR", help="统计目录中所有视频的时长 / Total the durations of every video in a directory")
+    parser.add_argument("--workers", "-w", type=int, default=SCAN_WORKERS, help="并行读取的文件数 / Files read in parallel")
+    args = parser.parse_args()
+
+    if args.scan:
+        scan_start = time.time()
+        clip_durations, total_duration = scan_directory(args.scan, args.workers)
+        for clip_path, clip_duration in clip_durations.items():
+            shown = f"{clip_duration:.2f}秒" if clip_duration is not None else "无法读取"
+            logger.info(f"{os.path.basename(clip_path)}\t{shown}")
+        unreadable = sum(1 for value in clip_durations.values() if value is None)
+        logger.info(f"\n共 {len(clip_durations)} 个视频，总时长: {format_time(total_duration)} ({total_duration:.2f}秒)"
+              + (f"，{unreadable} 个无法读取" if unreadable else ""))
+        logger.info(f"耗时: {time.time() - scan_start:.2f}秒")
+        sys.exit(0)
+
+    logger.info("=== 视频时长测试 ===")
     
     # 查找最新视频
     video_path = find_latest_video()
     if not video_path:
         sys.exit(1)
     
-    # 仅使用FFprobe方法，不再使用MoviePy
-    print("\n使用FFprobe获取视频时长")
-    duration = get_video_duration_ffprobe(video_path)
+    # 直接读取文件头，不是MP4时才使用FFprobe
+    logger.info("\n读取视频时长")
+    duration = get_video_duration(video_path)
     
-    print("\n=== 测试结果 ===")
+    logger.info("\n=== 测试结果 ===")
     if duration is not None:
-        print(f"视频时长: {format_time(duration)} ({duration:.2f}秒)")
+        logger.info(f"视频时长: {format_time(duration)} ({duration:.2f}秒)")
     
-    print("\n=== 获取下一个视频序号 ===")
+    logger.info("\n=== 获取下一个视频序号 ===")
     # 检查下一个视频名称
     check_next_video_name()
     check_next_video_name()
@@ -7,6 +7,10 @@ from sqlite3 import OperationalError, connect
 from instaloader import Instaloader, ConnectionException
 from dotenv import load_dotenv
 
+from log_setup import get_logger
+
+logger = get_logger("login")
+
 load_dotenv()
 
 # 🔍 获取 Firefox cookies.sqlite 文件路径
@@ -49,7 +53,7 @@ def validate_login(cookiefile, input_username):
 
 # 🔐 从 cookie 登录并保存 session 文件
 def import_session(cookiefile, username):
-    print(f"使用的 cookie 文件路径为：{cookiefile}")
+    logger.info(f"使用的 cookie 文件路径为：{cookiefile}")
 
     conn = connect(f"file:{cookiefile}?immutable=1", uri=True)
     try:
@@ -65,33 +69,32 @@ def import_session(cookiefile, username):
     loader.context._session.cookies.update(cookie_data)
     loader.context.username = username
 
-    print(f"正在验证账号：{username}")
+    logger.info(f"正在验证账号：{username}")
     if not loader.test_login():
         raise SystemExit("❌ Login failed. 请确认你已在 Firefox 中登录 Instagram。")
 
     session_path = get_session_file_path(username)
     loader.save_session_to_file(session_path)
-    print(f"Session 文件已保存到：{session_path}")
+    logger.info(f"Session 文件已保存到：{session_path}")
 
 # 🚀 确保用户已登录（首次输入并保存到 .env）
 def ensure_logged_in_user():
     username = os.getenv("IG_USERNAME")
     if username:
         # Verify session is valid
+        # 验证结果有缓存，加载好的Instaloader会共享给下载 / Validation is cached and the loaded Instaloader is shared with downloads
+        from session_manager import get_manager
         session_path = get_session_file_path(username)
         if os.path.exists(session_path):
             try:
-                loader = Instaloader(max_connection_attempts=1)
-                loader.load_session_from_file(username, filename=session_path)
-                if loader.test_login():
+                if get_manager(username).validate():
                     return username
-                print("❌ 现有会话已过期，需要重新登录")
             except Exception:
-                print("❌ 会话文件损坏，需要重新登录")
+                logger.error("❌ 会话文件损坏，需要重新登录")
         else:
-            print("❌ 会话文件不存在，需要创建新会话")
+            logger.error("❌ 会话文件不存在，需要创建新会话")
     
-    print("🔑 IG_USERNAME not found in .env file.")
+    print("🔑 IG_USERNAME not found in .env file.")  # 交互提示直接输出，保证出现在输入提示之前 / Interactive prompt, printed directly so it precedes input()
     while True:
         username = input("🔑 Enter your Instagram username (请输入 Instagram 用户名): ").strip()
         cookiefile = get_cookiefile()
@@ -102,7 +105,7 @@ def ensure_logged_in_user():
                 content = f.read()
                 if f"IG_USERNAME={username}" not in content:
                     f.write(f"IG_USERNAME={username}\n")
-            print(f"✅ IG_USERNAME saved to .env: {username}")
+            logger.info(f"✅ IG_USERNAME saved to .env: {username}")
             return username
         else:
             print("❌ Login failed or the account does not match the session.\n❌ 登录失败，或当前浏览器已登录账号与输入不一致，请重试。")
@@ -110,14 +113,14 @@ def ensure_logged_in_user():
 # 在文件末尾添加以下代码用于测试
 if __name__ == "__main__":
     # 简单的功能测试
-    print("测试会话路径生成:")
+    logger.info("测试会话路径生成:")
     test_path = get_session_file_path("test_user")
-    print(f"生成的路径: {test_path}")
+    logger.info(f"生成的路径: {test_path}")
     
-    print("\n测试用户登录验证:")
+    logger.info("\n测试用户登录验证:")
     try:
         # 注意：这会尝试实际连接Instagram
         username = ensure_logged_in_user()
-        print(f"获取到的用户名: {username}")
+        logger.info(f"获取到的用户名: {username}")
     except Exception as e:
-        print(f"登录验证出错: {e}")
+        logger.error(f"登录验证出错: {e}")
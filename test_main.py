@@ -6,10 +6,12 @@ import argparse
 from datetime import datetime, date
 import glob
 
-from test_login import ensure_logged_in_user, import_session, get_cookiefile
-from test_download import download_saved_videos
-from test_merge import merge_all_downloaded_videos
-from test_upload import upload_latest_merged_video  # 导入上传功能
+from log_setup import get_logger
+
+logger = get_logger("main")
+
+# 各阶段的模块（instaloader、selenium等）只在执行该阶段时才导入，保证启动速度，见bench_startup.py
+# Stage modules (instaloader, selenium, ...) are imported only when their stage runs to keep startup fast, see bench_startup.py
 
 def merge_todays_videos(downloads_dir="test_downloads", output_name=None):
     """合并今天下载的视频
@@ -32,10 +34,10 @@ def merge_todays_videos(downloads_dir="test_downloads", output_name=None):
                     today_videos.append(file_path)
     
     if not today_videos:
-        print(f"今天没有下载任何视频")
+        logger.info(f"今天没有下载任何视频")
         return None, 0
     
-    print(f"找到今天下载的 {len(today_videos)} 个视频")
+    logger.info(f"找到今天下载的 {len(today_videos)} 个视频")
     
     # 如果没有指定输出名称，使用带日期的名称
     if not output_name:
@@ -56,9 +58,16 @@ def main():
     # 新增参数
     parser.add_argument("--last", "-l", type=int, help="只合并最后N个视频 / Only merge last N videos")
     parser.add_argument("--force", "-f", action="store_true", help="强制合并所有视频，不跳过已合并的 / Force merge all videos")
+    parser.add_argument("--restore-archived", action="store_true", help="合并前先从归档（本地或S3）恢复源片段 / Restore archived source clips (local or S3) before merging")
     parser.add_argument("--today", "-t", action="store_true", help="只合并今天下载的视频 / Only merge videos downloaded today")
     parser.add_argument("--output", "-o", help="指定合并输出文件名 / Specify merge output filename")
     parser.add_argument("--batch", "-b", type=int, default=15, help="每批处理的最大视频数 / Maximum videos per batch")
+    parser.add_argument("--reencode", action="store_true", help="合并时重新编码拼接，而不是复制流 / Re-encode the join instead of stream copying")
+    parser.add_argument("--segmented", action=argparse.BooleanOptionalAction, default=None,
+                        help="重新编码时分段并行编码（默认按MERGE_SEGMENTED，隐含--reencode）/ Segment-parallel re-encode (defaults to MERGE_SEGMENTED, implies --reencode)")
+    parser.add_argument("--daemon", action="store_true", help="常驻运行，按内部调度下载、合并、上传；有pipelines.json时运行其中所有流水线 / Run as a daemon with an internal download/merge/upload schedule; runs every pipeline in pipelines.json if present")
+    import profiling
+    profiling.add_argument(parser)
     
     args = parser.parse_args()
     
@@ -66,144 +75,151 @@ def main():
     if len(sys.argv) == 1:
         parser.print_help()
         return
+
+    if args.daemon:
+        from pipeline_daemon import run_daemon
+        run_daemon()
+        return
     
     # 执行操作
     start_time = time.time()
+    import metrics
+    metrics.start_run("pipeline")
+    if args.profile:
+        # 每个阶段单独写分析文件 / One profile per stage
+        profiling.enable(args.profile)
     
     try:
-        # 添加详细的日志记录，帮助调试
-        log_dir = "logs"
-        os.makedirs(log_dir, exist_ok=True)
-        log_file = os.path.join(log_dir, f"main_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-        
-        def log_message(msg):
-            print(msg)
-            with open(log_file, "a", encoding="utf-8") as f:
-                f.write(f"{datetime.now().strftime('%H:%M:%S')} - {msg}\n")
-        
-        log_message("=== 开始执行操作 ===")
+        logger.info("=== 开始执行操作 ===")
         
         # 检查环境
-        log_message(f"Python版本: {sys.version}")
-        log_message(f"当前工作目录: {os.getcwd()}")
+        logger.info(f"Python版本: {sys.version}")
+        logger.info(f"当前工作目录: {os.getcwd()}")
         
         # 检查必要目录
         for dir_name in ["test_downloads", "merged_videos", "screenshots", "temp"]:
             os.makedirs(dir_name, exist_ok=True)
-            log_message(f"确保目录存在: {dir_name}")
+            logger.info(f"确保目录存在: {dir_name}")
         
         # 下载视频
         if args.download or args.all:
+            stage_start = time.time()
+            profiling.start("download")
+            download_count = 0
             try:
-                log_message("开始下载新视频...")
+                logger.info("开始下载新视频...")
                 # 使用更简单直接的方式调用已导入的函数
                 try:
                     # 导入和确保用户已登录
+                    from test_login import ensure_logged_in_user
+                    from test_download import download_saved_videos
                     username = ensure_logged_in_user()
                     if username:
-                        log_message(f"已登录用户: {username}")
-                        # 直接调用已导入的函数
-                        download_count = download_saved_videos(username)
-                        log_message(f"下载完成，共 {download_count} 个视频")
+                        logger.info(f"已登录用户: {username}")
+                        # 共享ensure_logged_in_user已经验证过的会话 / Reuse the session ensure_logged_in_user already validated
+                        from session_manager import get_manager
+                        download_count = download_saved_videos(username, loader=get_manager(username).loader)
+                        logger.info(f"下载完成，共 {download_count} 个视频")
                     else:
-                        log_message("未找到已登录用户，请先确保登录成功")
+                        logger.warning("未找到已登录用户，请先确保登录成功")
                 except Exception as e:
-                    log_message(f"调用下载函数时出错: {str(e)}")
+                    logger.error(f"调用下载函数时出错: {str(e)}")
                     import traceback
-                    log_message(traceback.format_exc())
+                    logger.error(traceback.format_exc())
             except Exception as e:
-                log_message(f"下载过程中出错: {e}")
+                logger.error(f"下载过程中出错: {e}")
                 import traceback
-                log_message(traceback.format_exc())
-                log_message("继续执行后续步骤")
+                logger.error(traceback.format_exc())
+                logger.info("继续执行后续步骤")
+            profiling.stop()
+            metrics.record_span("stage.download", time.time() - stage_start, downloaded=download_count)
         
         merged_path = None  # 记录合并后的视频路径
         
         # 合并视频
         if args.merge or args.all:
+            stage_start = time.time()
+            profiling.start("merge")
+            count = 0
             try:
-                log_message("开始合并视频...")
+                logger.info("开始合并视频...")
                 
                 if args.today:
                     # 合并今天下载的视频
-                    log_message("合并今天下载的视频...")
+                    logger.info("合并今天下载的视频...")
                     merged_path, count = merge_todays_videos(
                         "test_downloads", 
                         args.output
                     )
                 else:
-                    # 使用普通合并
-                    try:
-                        # 直接调用导入的函数，简化参数处理
-                        if args.last:
-                            # 如果指定了last参数
-                            merged_path, count = merge_all_downloaded_videos(
-                                "test_downloads",
-                                output_name=args.output,
-                                max_per_batch=args.batch,
-                                last_n=args.last,
-                                force_all=args.force
-                            )
-                        else:
-                            # 不带last参数的调用
-                            merged_path, count = merge_all_downloaded_videos(
-                                "test_downloads",
-                                output_name=args.output,
-                                max_per_batch=args.batch,
-                                force_all=args.force
-                            )
-                    except TypeError as e:
-                        # 如果参数不匹配，尝试基本调用
-                        log_message(f"合并函数参数不匹配: {e}, 尝试使用基本参数")
-                        merged_path, count = merge_all_downloaded_videos()
+                    # 使用普通合并；中断过的合并任务会从断点继续 / Regular merge; an interrupted merge job resumes from its checkpoint
+                    from test_merge import merge_specific_videos
+                    merged_path, count = merge_specific_videos(
+                        "test_downloads",
+                        output_name=args.output,
+                        max_per_batch=args.batch,
+                        last_n=args.last,
+                        force_all=args.force,
+                        restore_archived=args.restore_archived,
+                        strategy="reencode" if args.reencode or args.segmented else "concat",
+                        segmented=args.segmented
+                    )
                 
                 if merged_path:
-                    log_message(f"视频合并完成，共 {count} 个视频，保存为：{merged_path}")
+                    logger.info(f"视频合并完成，共 {count} 个视频，保存为：{merged_path}")
                 else:
-                    log_message("合并视频失败或没有视频需要合并")
+                    logger.warning("合并视频失败或没有视频需要合并")
             except Exception as e:
-                log_message(f"合并过程中出错: {e}")
+                logger.error(f"合并过程中出错: {e}")
                 import traceback
-                log_message(traceback.format_exc())
-                log_message("继续执行后续步骤")
+                logger.error(traceback.format_exc())
+                logger.info("继续执行后续步骤")
+            profiling.stop()
+            metrics.record_span(
+                "stage.merge", time.time() - stage_start, status="ok" if merged_path else "error", clips=count,
+                bytes=os.path.getsize(merged_path) if merged_path and os.path.exists(merged_path) else 0,
+            )
         
         # 合并成功后，检查是否自动上传
         if merged_path and args.merge and not args.upload and not args.all:
-            log_message("\n合并完成后自动执行上传操作...")
-            try_upload_video(merged_path, log_message)
+            logger.info("\n合并完成后自动执行上传操作...")
+            try_upload_video(merged_path)
         
         # 显式的上传命令 (或者作为all命令的一部分)
         if args.upload or args.all:
             if not merged_path:
                 # 先尝试获取视频路径
-                log_message("尝试查找最新的合并视频用于上传...")
+                logger.info("尝试查找最新的合并视频用于上传...")
                 merged_folder = "merged_videos"
                 os.makedirs(merged_folder, exist_ok=True)
                 videos = glob.glob(os.path.join(merged_folder, "*.mp4"))
                 if videos:
                     merged_path = max(videos, key=os.path.getmtime)
-                    log_message(f"找到最新合并视频: {merged_path}")
+                    logger.info(f"找到最新合并视频: {merged_path}")
                 else:
-                    log_message("未找到可上传的视频")
+                    logger.warning("未找到可上传的视频")
                     videos = glob.glob(os.path.join("test_downloads", "*.mp4"))
                     if videos:
                         merged_path = max(videos, key=os.path.getmtime)
-                        log_message(f"尝试使用下载目录中的最新视频: {merged_path}")
+                        logger.info(f"尝试使用下载目录中的最新视频: {merged_path}")
                     else:
-                        log_message("下载目录中也没有找到视频")
+                        logger.warning("下载目录中也没有找到视频")
                         raise FileNotFoundError("没有可上传的视频文件")
         
             if merged_path:
-                try_upload_video(merged_path, log_message)
+                try_upload_video(merged_path)
         
         # 显示总用时
         total_time = time.time() - start_time
-        log_message(f"\n全部操作完成，总用时：{format_duration(total_time)}")
+        logger.info(f"\n全部操作完成，总用时：{format_duration(total_time)}")
+        metrics.end_run()
     
     except Exception as e:
-        print(f"执行过程中出现错误: {str(e)}")
+        profiling.stop()
+        metrics.end_run("error")
+        logger.error(f"执行过程中出现错误: {str(e)}")
         import traceback
-        traceback.print_exc()
+        logger.error(traceback.format_exc())
         
         # 尝试记录错误到文件
         try:
@@ -213,27 +229,46 @@ def main():
                 f.write(f"错误: {str(e)}\n")
                 f.write(traceback.format_exc())
                 f.write("\n")
-            print(f"详细错误已记录到: {error_log}")
+            logger.error(f"详细错误已记录到: {error_log}")
         except:
             pass
 
 # 修改上传视频的函数，增加日志记录参数
-def try_upload_video(video_path, log_func=print):
+def try_upload_video(video_path, log_func=None):
     """尝试上传指定的视频文件到B站"""
+    log_func = log_func or logger.info
     log_func(f"准备上传视频到B站: {video_path}")
     
     # 确保视频文件存在
     if not os.path.exists(video_path):
         log_func(f"错误: 视频文件不存在: {video_path}")
         return False
+
+    # 上传前先检查文件结构，避免上传几分钟后才发现文件损坏 / Check the structure before spending minutes uploading
+    from mp4_check import check_mp4, quarantine
+    ok, reason, _ = check_mp4(video_path)
+    if not ok:
+        log_func(f"错误: 视频文件结构损坏: {reason}")
+        quarantine(video_path, reason)
+        return False
         
     # 导入上传模块并调用函数
+    import metrics
+    import profiling
+    upload_start = time.time()
+    profiling.start("upload")
     try:
         log_func("开始上传流程...")
         
         try:
-            # 直接调用，新版本支持指定路径
-            success, duration = upload_latest_merged_video(video_path=video_path)
+            if os.environ.get("UPLOAD_BACKEND") == "http":
+                # 不经过浏览器的分块上传 / Browser-free chunked upload
+                from http_upload import upload_video_http
+                success, duration = upload_video_http(video_path)
+            else:
+                # 直接调用，新版本支持指定路径
+                from test_upload import upload_latest_merged_video
+                success, duration = upload_latest_merged_video(video_path=video_path)
         except TypeError:
             # 如果函数不接受视频路径参数，确保视频在正确位置后使用无参数调用
             log_func("上传函数不支持路径参数，使用自动查找方式上传")
@@ -241,12 +276,19 @@ def try_upload_video(video_path, log_func=print):
             if not video_path.startswith(os.path.abspath(merged_folder)):
                 target_path = os.path.join(merged_folder, os.path.basename(video_path))
                 if not os.path.exists(target_path) or os.path.getsize(target_path) != os.path.getsize(video_path):
-                    log_func(f"复制视频到上传目录: {target_path}")
-                    import shutil
-                    shutil.copy2(video_path, target_path)
+                    from content_store import clone_file
+                    # reflink或硬链接，不支持时才复制字节 / Reflink or hard link, byte copy only as a last resort
+                    method = clone_file(video_path, target_path)
+                    log_func(f"复制视频到上传目录（{method}）: {target_path}")
             
+            from test_upload import upload_latest_merged_video
             success, duration = upload_latest_merged_video()
         
+        profiling.stop()
+        metrics.record_span(
+            "stage.upload", time.time() - upload_start, status="ok" if success else "error",
+            bytes=os.path.getsize(video_path), backend=os.environ.get("UPLOAD_BACKEND", "selenium"),
+        )
         if success:
             log_func(f"🎉 上传成功！用时：{format_duration(duration)}")
         else:
@@ -254,6 +296,7 @@ def try_upload_video(video_path, log_func=print):
             
         return success
     except Exception as e:
+        profiling.stop()
         log_func(f"上传过程中出错: {e}")
         import traceback
         log_func(traceback.format_exc())
@@ -273,5 +316,5 @@ if __name__ == "__main__":
     try:
         sys.exit(main())
     except KeyboardInterrupt:
-        print("\n\n用户已取消操作，程序退出")
+        logger.info("\n\n用户已取消操作，程序退出")
         sys.exit(0)
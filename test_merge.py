@@ -1,10 +1,16 @@
 import os
 import glob
-import subprocess
 import time
+import json
+import hashlib
 from datetime import datetime
 from datetime import date
-from tqdm import tqdm
+
+from ffmpeg_supervisor import run_process, PROBE_TIMEOUT
+import metrics
+from log_setup import get_logger
+
+logger = get_logger("merge")
 
 # 项目目录结构配置 / Project directory structure configuration
 DOWNLOADS_DIR = "test_downloads"  # 下载目录 / Downloads directory
@@ -17,6 +23,26 @@ LOG_FILE = os.path.join(LOG_DIR, "merged.log")  # 合并记录日志 / Merge rec
 # FFmpeg路径配置，优先使用环境变量，否则使用相对路径
 # FFmpeg path configuration, use environment variable first, otherwise use relative path
 FFMPEG_PATH = os.environ.get("FFMPEG_PATH", os.path.join("tools", "ffmpeg", "bin", "ffmpeg.exe"))
+FFPROBE_PATH = os.environ.get("FFPROBE_PATH", os.path.join("tools", "ffmpeg", "bin", "ffprobe.exe"))
+
+# 标准化参数，所有片段都会被统一到这个规格 / Standardization parameters, every clip is unified to this spec
+STANDARD_VIDEO_FILTER = "scale=1080:1920,fps=30,format=yuv420p,setsar=1"  # 视频滤镜：缩放、帧率、格式 / Video filters: scale, fps, format
+STANDARD_VIDEO_ARGS = ["-r", "30", "-c:v", "libx264", "-preset", "fast", "-crf", "23"]  # 视频编码设置 / Video codec settings
+STANDARD_AUDIO_ARGS = ["-ar", "48000", "-c:a", "aac", "-b:a", "128k"]  # 音频编码设置 / Audio codec settings
+# 并行标准化任务数，libx264本身也是多线程的 / Parallel standardization jobs, libx264 is multi-threaded itself
+STANDARDIZE_WORKERS = int(os.environ.get("STANDARDIZE_WORKERS", max(1, (os.cpu_count() or 2) // 4)))
+# 重新编码拼接时是否分段并行编码（见segment_encode）/ Use segment-parallel encoding for re-encoding concats (see segment_encode)
+SEGMENTED_ENCODE = os.environ.get("MERGE_SEGMENTED", "1") == "1"
+# 标准化输出的流参数，用于判断片段是否已经符合规格 / Stream parameters of standardized output, used to check if a clip already conforms
+STANDARD_SPEC = {
+    "video_codec": "h264",
+    "width": 1080,
+    "height": 1920,
+    "fps": 30.0,
+    "pix_fmt": "yuv420p",
+    "audio_codec": "aac",
+    "sample_rate": 48000,
+}
 
 def is_ffmpeg_installed():
     """检查FFmpeg是否已安装
@@ -25,103 +51,170 @@ def is_ffmpeg_installed():
 
 def prepare_temp_directory():
     """准备临时目录，如果存在则清空，不存在则创建
-    Prepare temporary directory, clear if exists, create if not"""
+    Prepare temporary directory, clear if exists, create if not
+
+    子目录是合并任务的断点中间文件（见merge_jobs），保留不删 / Subdirectories hold merge job checkpoints (see merge_jobs) and are kept
+    """
     if os.path.exists(TEMP_DIR):
         for f in glob.glob(os.path.join(TEMP_DIR, "*")):
-            os.remove(f)
+            if os.path.isfile(f):
+                os.remove(f)
     else:
         os.makedirs(TEMP_DIR)
 
-def standardize_video(input_path, output_path):
+def standardize_video(input_path, output_path, loudness=None, add_silence=False):
     """使用FFmpeg标准化视频：统一分辨率、帧率和编码
-    Standardize video using FFmpeg: unify resolution, framerate and encoding"""
+    Standardize video using FFmpeg: unify resolution, framerate and encoding
+
+    Args:
+        loudness: 可选，loudness.analyze_clips的测量值，用于在同一次编码中做响度归一化
+                  Optional measurement from loudness.analyze_clips, normalizes loudness in the same encode pass
+        add_silence: 输入没有音轨时传True，用anullsrc补一条静音音轨，输出才符合标准规格
+                     Pass True for inputs without audio; an anullsrc silent track is added so the output matches the spec
+    """
+    audio_filter = []
+    if loudness:
+        from loudness import loudnorm_filter
+        audio_filter = ["-af", loudnorm_filter(loudness)]
+    silence = []
+    if add_silence:
+        silence = [
+            "-f", "lavfi", "-i", "anullsrc=channel_layout=stereo:sample_rate=48000",
+            "-map", "0:v:0", "-map", "1:a:0", "-shortest",
+        ]
     command = [
         FFMPEG_PATH, "-y",
         "-i", input_path,
-        "-vf", "scale=1080:1920,fps=30,format=yuv420p,setsar=1",  # 视频滤镜：缩放、帧率、格式 / Video filters: scale, fps, format
-        "-r", "30",  # 输出帧率30fps / Output framerate 30fps
-        "-ar", "48000",  # 音频采样率48kHz / Audio sample rate 48kHz
-        "-c:v", "libx264", "-preset", "fast", "-crf", "23",  # 视频编码设置 / Video codec settings
-        "-c:a", "aac", "-b:a", "128k",  # 音频编码设置 / Audio codec settings
+        *silence,
+        "-vf", STANDARD_VIDEO_FILTER,
+        *audio_filter,
+        *STANDARD_VIDEO_ARGS,
+        *STANDARD_AUDIO_ARGS,
         "-movflags", "+faststart",  # 优化网络播放 / Optimize for web playback
         output_path
     ]
-    result = subprocess.run(command, capture_output=True, text=True)
+    result = run_process(command)
     return result.returncode == 0
 
-def merge_all_downloaded_videos():
-    """Merge all downloaded videos into one
-    将所有下载的视频合并为一个"""
-    if not is_ffmpeg_installed():
-        print("❌ FFmpeg not found. Please install FFmpeg first.")
-        print("❌ 未找到FFmpeg。请先安装FFmpeg。")
-        return None, 0
+def standardize_clips(jobs, workers=STANDARDIZE_WORKERS, measurements=None, on_done=None, executor=None, tenant=None):
+    """并行标准化多个片段，按成本模型预测的用时从长到短调度
+    Standardize several clips in parallel, scheduled longest-first by the cost model
 
-    os.makedirs(MERGED_DIR, exist_ok=True)
-    os.makedirs(LOG_DIR, exist_ok=True)
-    prepare_temp_directory()
+    Args:
+        jobs: (源路径, 输出路径) 列表 / List of (source path, output path)
+        workers: 并行任务数 / Number of parallel jobs
+        measurements: 可选，源路径到响度测量值的映射 / Optional mapping of source path to loudness measurement
+        on_done: 可选，每个片段完成后调用on_done(源路径, 是否成功)，用于记录断点
+                 Optional, on_done(source path, success) is called after each clip, used for checkpointing
+        executor: 可选，多个流水线共享的encode_scheduler.FairShareExecutor / Optional encode_scheduler.FairShareExecutor shared by several pipelines
+        tenant: 使用共享executor时的流水线名 / Pipeline name when using the shared executor
 
-    # 加载已合并的视频记录
-    merged_videos = set()
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            merged_videos = set(line.strip() for line in f)
+    Returns:
+        失败的源路径列表，全部成功时为空 / List of failed source paths, empty when all succeeded
+    """
+    from encode_scheduler import plan_jobs, estimate_makespan, run_jobs
+    measurements = measurements or {}
+    outputs = dict(jobs)
+    if executor is not None:
+        workers = executor.workers
+    planned = plan_jobs(list(outputs), workers)
+    logger.info(f"预计标准化用时: {format_duration(estimate_makespan(planned, workers))}（{workers} 个并行任务）")
 
-    # 获取视频文件
-    video_files = []
-    
-    # 获取下载目录中的视频文件
-    if os.path.exists(DOWNLOADS_DIR):
-        for file in os.listdir(DOWNLOADS_DIR):
-            if file.endswith('.mp4') and file not in merged_videos:
-                video_files.append(file)
-    
-    # 如果没有直接找到视频文件，则检查日志文件中的shortcode
-    if not video_files and os.path.exists(DOWNLOAD_LOG):
-        shortcodes = set()
-        with open(DOWNLOAD_LOG, "r", encoding="utf-8") as f:
-            shortcodes = set(line.strip() for line in f if line.strip())
-        
-        # 查找下载目录中与shortcode相关的视频
-        for file in os.listdir(DOWNLOADS_DIR):
-            if file.endswith('.mp4') and file not in merged_videos:
-                for shortcode in shortcodes:
-                    if shortcode in file:
-                        video_files.append(file)
-                        break
-
-    all_videos = sorted(video_files)
-    merge_count = len(all_videos)
-    
-    if merge_count == 0:
-        print("📭 No new videos to merge.")
-        print("📭 没有新视频需要合并。")
-        return None, 0
+    def standardize_job(job):
+        path = job["path"]
+        with metrics.span("merge.standardize", clip=os.path.basename(path), predicted=round(job["predicted"], 2)) as span:
+            ok = standardize_video(path, outputs[path], measurements.get(path))
+            span.status = "ok" if ok else "error"
+            span.set(bytes=os.path.getsize(outputs[path]) if ok and os.path.exists(outputs[path]) else 0)
+        if on_done:
+            on_done(path, ok)
+        return ok
 
-    # 标准化视频
-    temp_video_paths = []
-    for video in tqdm(all_videos, desc="正在标准化视频"):
-        original_path = os.path.join(DOWNLOADS_DIR, video)
-        temp_path = os.path.join(TEMP_DIR, f"temp_{video}")
-        success = standardize_video(original_path, temp_path)
-        if success:
-            temp_video_paths.append(temp_path)
-        else:
-            print(f"❌ Failed to standardize video: {video}")
-            print(f"❌ 标准化视频失败: {video}")
-            return None, 0
+    results = run_jobs(planned, standardize_job, workers, executor=executor, tenant=tenant)
+    return [path for path, _ in jobs if not results.get(path)]
 
-    inputs = []
-    filter_parts = []
+def standard_params_hash():
+    """标准化参数的哈希，参数变化时已缓存的标准化文件需要重新生成
+    Hash of the standardization parameters; cached standardized files must be rebuilt when it changes"""
+    payload = json.dumps([STANDARD_VIDEO_FILTER, STANDARD_VIDEO_ARGS, STANDARD_AUDIO_ARGS])
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
 
-    for idx, temp_path in enumerate(temp_video_paths):
-        inputs += ["-i", temp_path]
-        filter_parts.append(f"[{idx}:v:0][{idx}:a:0]")
+def probe_video(video_path):
+    """使用ffprobe读取视频的主要流参数，失败时返回None
+    Read the main stream parameters of a video with ffprobe, returns None on failure"""
+    command = [
+        FFPROBE_PATH if os.path.exists(FFPROBE_PATH) else "ffprobe",
+        "-v", "quiet",
+        "-print_format", "json",
+        "-show_streams",
+        "-show_format",
+        video_path
+    ]
+    try:
+        result = run_process(command, timeout=PROBE_TIMEOUT)
+        if result.returncode != 0 or not result.stdout:
+            return None
+        data = json.loads(result.stdout)
+    except (OSError, ValueError):
+        return None
 
-    filter_complex = "".join(filter_parts) + f"concat=n={merge_count}:v=1:a=1[outv][outa]"
+    info = {
+        "duration": float(data.get("format", {}).get("duration", 0) or 0),
+        "has_video": False,
+        "has_audio": False,
+    }
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "video" and not info["has_video"]:
+            num, _, den = stream.get("avg_frame_rate", "0/1").partition("/")
+            info.update({
+                "has_video": True,
+                "video_codec": stream.get("codec_name"),
+                "profile": stream.get("profile"),
+                "level": stream.get("level"),
+                "width": stream.get("width"),
+                "height": stream.get("height"),
+                "fps": round(float(num) / float(den), 3) if den and float(den) else 0.0,
+                "pix_fmt": stream.get("pix_fmt"),
+                "time_base": stream.get("time_base"),
+            })
+        elif stream.get("codec_type") == "audio" and not info["has_audio"]:
+            info.update({
+                "has_audio": True,
+                "audio_codec": stream.get("codec_name"),
+                "sample_rate": int(stream.get("sample_rate", 0) or 0),
+                "channels": stream.get("channels"),
+            })
+    return info
 
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    final_output_path = os.path.join(MERGED_DIR, f"{timestamp}.mp4")
+def is_standard_spec(info):
+    """判断probe_video的结果是否已经符合标准化规格
+    Check whether a probe_video result already matches the standardization spec"""
+    if not info or not info.get("has_video") or not info.get("has_audio"):
+        return False
+    return all(info.get(key) == value for key, value in STANDARD_SPEC.items())
+
+def reencode_concat(video_paths, output_path, temp_dir=TEMP_DIR, segmented=SEGMENTED_ENCODE, verify_quality=False):
+    """重新编码拼接标准化后的片段；segmented时先分段并行编码（见segment_encode），失败时退回单次编码
+    Re-encode and join standardized clips; with segmented, segment-parallel encoding (see segment_encode) is
+    tried first, falling back to a single pass on failure
+
+    Args:
+        temp_dir: 分段和列表文件的目录，用合并任务自己的work_dir，同时运行的合并互不影响
+                  Directory for segments and list files; use the merge job's own work_dir so concurrent merges don't collide
+        verify_quality: 分段编码后用SSIM和标准化片段比较 / Compare the segmented result to the standardized clips by SSIM
+    """
+    if segmented and len(video_paths) > 1:
+        from segment_encode import segmented_concat
+        if segmented_concat(video_paths, output_path, temp_dir, verify=verify_quality):
+            return True
+        logger.warning("分段并行编码未完成，改用单次编码 / Segmented encode failed, falling back to a single pass")
+
+    inputs = []
+    filter_parts = []
+    for idx, video_path in enumerate(video_paths):
+        inputs += ["-i", video_path]
+        filter_parts.append(f"[{idx}:v:0][{idx}:a:0]")
+    filter_complex = "".join(filter_parts) + f"concat=n={len(video_paths)}:v=1:a=1[outv][outa]"
 
     command = [
         FFMPEG_PATH, "-y",
@@ -131,25 +224,18 @@ def merge_all_downloaded_videos():
         "-c:v", "libx264", "-preset", "fast", "-crf", "23",
         "-c:a", "aac", "-b:a", "128k",
         "-movflags", "+faststart",
-        final_output_path
+        output_path
     ]
+    result = run_process(command)
+    if result.returncode != 0:
+        logger.error(f"合并失败: {result.stderr}")
+    return result.returncode == 0
 
-    print(f"正在合并视频: {final_output_path}")
-    result = subprocess.run(command, capture_output=True, text=True)
-
-    if result.returncode == 0:
-        print(f"视频已保存: {final_output_path}")
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            for video in all_videos:
-                f.write(video + "\n")
-        print(f"成功合并: {merge_count} 个视频")
-    else:
-        print(f"合并失败: {result.stderr}")
-        return None, 0
-
-    return os.path.abspath(final_output_path), merge_count
-
-def merge_specific_videos(source_dir=None, output_name=None, max_per_batch=15, last_n=None, force_all=False):
+def merge_specific_videos(source_dir=None, output_name=None, max_per_batch=15, last_n=None, force_all=False,
+                          strategy="concat", crossfade=0.0, bumpers=False, normalize_audio=False,
+                          workers=STANDARDIZE_WORKERS, merged_dir=MERGED_DIR, temp_dir=TEMP_DIR, merge_log=LOG_FILE,
+                          executor=None, tenant=None, restore_archived=False, renditions=None,
+                          segmented=None, verify_quality=False):
     """合并指定目录中的所有视频
     Merge all videos in the specified directory
     
@@ -159,35 +245,65 @@ def merge_specific_videos(source_dir=None, output_name=None, max_per_batch=15, l
         max_per_batch: 每批最多处理的视频数量 / Maximum videos per batch
         last_n: 只处理最后N个视频（按修改时间排序）/ Only process last N videos (sorted by modification time)
         force_all: 强制处理所有视频，即使已经合并过 / Force process all videos, even if already merged
+        strategy: 合并方式，"concat"为完整标准化后复制拼接，"reencode"为标准化后重新编码拼接，"smart"为只重新编码拼接处的GOP
+                  Merge strategy, "concat" standardizes everything then stream-copies, "reencode" standardizes then
+                  re-encodes the join, "smart" re-encodes only GOPs at joins
+        crossfade: smart模式下拼接处的交叉淡化时长（秒）/ Crossfade length at joins in smart mode (seconds)
+        bumpers: 是否插入素材库中的片头、片尾和转场（复制流拼接）/ Splice in library intro, outro and transitions by stream copy
+        normalize_audio: 是否按EBU R128做响度归一化（分析结果有缓存）/ Normalize loudness to EBU R128 (analysis is cached)
+        workers: 并行标准化任务数 / Number of parallel standardization jobs
+        merged_dir: 输出目录 / Output directory
+        temp_dir: 中间文件目录 / Directory for intermediates
+        merge_log: 已合并记录文件 / Merged-clip record file
+        executor: 可选，多个流水线共享的FairShareExecutor / Optional FairShareExecutor shared by several pipelines
+        tenant: 流水线名，用于公平调度 / Pipeline name, used for fair scheduling
+        restore_archived: retention归档（本地或S3）的源片段也参与选择，只恢复最终选中的片段，用于重新合并旧素材
+                          Source clips archived by retention (local or S3) take part in the selection and only the
+                          selected ones are restored, for re-merging old footage
+        renditions: 可选，额外的输出规格（"preview"、"landscape"或字典，见renditions），从主文件一次解码生成
+                    Optional extra output renditions ("preview", "landscape" or dicts, see renditions), made from one decode of the master
+        segmented: reencode时是否分段并行编码，None时按MERGE_SEGMENTED；失败时退回单次编码
+                   For reencode, use segment-parallel encoding; None follows MERGE_SEGMENTED; falls back to a single pass on failure
+        verify_quality: 分段编码后用SSIM和标准化片段比较 / Compare the segmented result to the standardized clips by SSIM
     
     Returns:
         (output_path, count): 输出文件路径和合并的视频数量 / Output file path and count of merged videos
     """
     if not is_ffmpeg_installed():
-        print("❌ 未找到FFmpeg")
+        logger.error("❌ 未找到FFmpeg")
         return None, 0
+    if renditions:
+        from renditions import resolve
+        resolve(renditions)  # 先检查规格，避免合并完才发现写错 / Validate up front rather than after the merge
 
     # 使用默认值或指定值
     source_dir = source_dir or DOWNLOADS_DIR
     
     # 检查源目录
     if not os.path.exists(source_dir):
-        print(f"❌ 源目录不存在: {source_dir}")
+        logger.error(f"❌ 源目录不存在: {source_dir}")
         return None, 0
-        
-    if not os.listdir(source_dir):
-        print(f"❌ 源目录为空: {source_dir}")
+
+    archived = {}
+    if restore_archived:
+        # 归档的片段也参与选择，选中后才恢复 / Archived clips take part in the selection and are restored only once selected
+        from retention import archived_sources
+        archived = archived_sources(source_dir)
+
+    if not os.listdir(source_dir) and not archived:
+        logger.error(f"❌ 源目录为空: {source_dir}")
         return None, 0
     
-    os.makedirs(MERGED_DIR, exist_ok=True)
-    os.makedirs(LOG_DIR, exist_ok=True)
-    prepare_temp_directory()
+    os.makedirs(merged_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(merge_log) or ".", exist_ok=True)
+    # 不清空临时目录：中断的合并任务的中间文件要留到继续时使用 / Don't wipe temp: an interrupted job's intermediates are needed to resume
+    os.makedirs(temp_dir, exist_ok=True)
     
     # 可以在这里添加日志跟踪逻辑
     # 如果force_all为True，则不检查已合并记录
     merged_videos = set()
-    if not force_all and os.path.exists(LOG_FILE):
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
+    if not force_all and os.path.exists(merge_log):
+        with open(merge_log, "r", encoding="utf-8") as f:
             merged_videos = set(line.strip() for line in f)
     
     # 获取所有视频文件
@@ -207,57 +323,192 @@ def merge_specific_videos(source_dir=None, output_name=None, max_per_batch=15, l
                         rel_path = os.path.relpath(os.path.join(root, file), source_dir)
                         if force_all or rel_path not in merged_videos:
                             video_files.append(rel_path)
+    video_files += [video for video in archived if (force_all or video not in merged_videos) and video not in video_files]
     
     # 按照修改时间排序
     all_videos_with_time = []
     for video in video_files:
         full_path = os.path.join(source_dir, video)
-        mtime = os.path.getmtime(full_path)
+        mtime = archived[video] if video in archived else os.path.getmtime(full_path)
         all_videos_with_time.append((video, mtime))
     
     all_videos_with_time.sort(key=lambda x: x[1])
     all_videos = [video for video, _ in all_videos_with_time]
     
+    # 上次被中断的同参数合并任务优先继续，沿用它计划的片段和输出文件名
+    # An interrupted job with the same options is resumed first, keeping its planned clips and output name
+    from merge_jobs import find_resumable, create_job
+    job_options = {
+        "strategy": strategy,
+        "crossfade": crossfade if strategy == "smart" else 0.0,
+        "bumpers": bool(bumpers),
+        "normalize_audio": bool(normalize_audio) and strategy != "smart",
+    }
+    resumed = find_resumable(source_dir, all_videos, job_options, merged_videos)
+    if resumed:
+        # 明确指定的--last/--output优先：只有选择和任务一致时才继续 / An explicit --last/--output wins: resume only if it matches the job
+        selected = all_videos[-last_n:] if last_n and isinstance(last_n, int) and last_n > 0 else None
+        if (selected is not None and selected != resumed.clip_names) or \
+                (output_name and os.path.basename(resumed.output) != f"{output_name}.mp4"):
+            logger.info(f"本次指定的片段或输出文件和中断的任务 {resumed.id[:12]} 不同，不继续该任务")
+            resumed = None
+    if resumed:
+        all_videos = resumed.clip_names
+        logger.info(f"继续上次中断的合并任务 {resumed.id[:12]}（步骤: {resumed.step}，{len(all_videos)} 个视频）")
+        last_n = None
+
     # 处理last_n参数
     if last_n and isinstance(last_n, int) and last_n > 0:
         if last_n < len(all_videos):
-            print(f"根据参数只处理最新的{last_n}个视频（共有{len(all_videos)}个）")
+            logger.info(f"根据参数只处理最新的{last_n}个视频（共有{len(all_videos)}个）")
             all_videos = all_videos[-last_n:]  # 取最后N个（最新的）
         else:
-            print(f"要求处理最后{last_n}个视频，但只有{len(all_videos)}个视频可用，将处理所有视频")
+            logger.info(f"要求处理最后{last_n}个视频，但只有{len(all_videos)}个视频可用，将处理所有视频")
     
+    # 只恢复最终选中的归档片段 / Restore only the archived clips that were finally selected
+    missing = [os.path.join(source_dir, video) for video in all_videos if video in archived]
+    if missing:
+        from retention import restore_paths
+        restored = set(restore_paths(missing))
+        logger.info(f"已从归档恢复 {len(restored)}/{len(missing)} 个片段")
+        all_videos = [video for video in all_videos
+                      if video not in archived or os.path.join(source_dir, video) in restored]
+
+    # 只读盒子头检查结构，截断或损坏的片段直接隔离 / Header-only structure check; quarantine truncated or broken clips
+    from mp4_check import gate_files
+    passed = set(gate_files([os.path.join(source_dir, video) for video in all_videos]))
+    all_videos = [video for video in all_videos if os.path.join(source_dir, video) in passed]
+    if resumed and len(all_videos) != len(resumed.clip_names):
+        logger.warning("⚠️ 任务中有片段已被隔离，放弃旧任务重新开始")
+        resumed.discard()
+        resumed = None
+
     merge_count = len(all_videos)
     
     if merge_count == 0:
-        print(f"没有找到符合条件的视频文件")
+        logger.info(f"没有找到符合条件的视频文件")
         return None, 0
 
-    # 标准化视频
-    temp_video_paths = []
-    for video in tqdm(all_videos, desc="正在标准化视频"):
-        original_path = os.path.join(source_dir, video)
-        temp_path = os.path.join(TEMP_DIR, f"temp_{video}")
-        success = standardize_video(original_path, temp_path)
-        if success:
-            temp_video_paths.append(temp_path)
-        else:
-            print(f"❌ 标准化视频失败: {video}")
+    # 设置输出文件名
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    output_name = output_name or timestamp
+    final_output_path = resumed.output if resumed else os.path.join(merged_dir, f"{output_name}.mp4")
+    source_paths = [os.path.join(source_dir, video) for video in all_videos]
+
+    # 预先编码好的片头片尾 / Pre-encoded bumpers
+    bumper_paths = {}
+    if bumpers:
+        from bumpers import get_bumpers
+        bumper_paths = get_bumpers(container="ts" if strategy == "smart" else "mp4")
+
+    # 相同的片段选择已经合并过时直接复用 / Reuse the output if the same clip selection was merged before
+    from merge_cache import compute_manifest_hash, find_cached_output, reuse_output, prepare_output_path
+    manifest_hash = compute_manifest_hash(
+        source_paths + [bumper_paths[name] for name in sorted(bumper_paths)],
+        strategy,
+        {
+            "crossfade": job_options["crossfade"],
+            "bumpers": sorted(bumper_paths),
+            "normalize_audio": job_options["normalize_audio"],
+        },
+    )
+    if resumed and resumed.id != manifest_hash:
+        # 片头片尾素材变了，旧任务的中间结果不能再用 / The bumpers changed, so the old job's intermediates are stale
+        resumed.discard()
+    cached_output = find_cached_output(manifest_hash)
+    if cached_output:
+        final_output_path = reuse_output(cached_output, final_output_path)
+        logger.info(f"相同的片段已经合并过，直接复用: {final_output_path}")
+        append_merge_log(all_videos, merge_log)
+        if renditions:
+            from renditions import render
+            render(final_output_path, renditions)
+        if resumed and resumed.id == manifest_hash:
+            resumed.finish()
+        return os.path.abspath(final_output_path), merge_count
+
+    # 断点记录：每个片段、批次和最终步骤完成后都会落盘 / Checkpoint record, written after every clip, batch and final step
+    job = create_job(manifest_hash, source_dir, source_paths, final_output_path, job_options, temp_dir)
+    os.makedirs(job.work_dir, exist_ok=True)
+    final_output_path = job.output
+    if job.step == "finalize" and not job.output_done():
+        job.set_step("concat")
+    if job.step == "finalize":
+        logger.info(f"输出文件已经生成，只需完成收尾: {final_output_path}")
+        return finish_merge_job(job, all_videos, manifest_hash, merge_log, renditions)
+    prepare_output_path(final_output_path)
+
+    # 智能渲染：只重新编码拼接处的GOP / Smart render: only re-encode GOPs at joins
+    if strategy == "smart":
+        if normalize_audio:
+            logger.warning("⚠️ 智能渲染会直接复制音频，忽略响度归一化")
+        from smart_render import smart_merge
+        logger.info(f"正在智能渲染合并: {final_output_path}")
+        job.set_step("concat")
+        with metrics.span("merge.smart", clips=merge_count) as span:
+            merged = smart_merge(source_paths, final_output_path, job.work_dir, crossfade=crossfade, bumpers=bumper_paths)
+            span.status = "ok" if merged else "error"
+        if not merged:
+            logger.error("❌ 智能渲染合并失败")
+            job.record_failure("智能渲染合并失败")
             return None, 0
+        logger.info(f"视频已保存: {final_output_path}")
+        job.record_output()
+        return finish_merge_job(job, all_videos, manifest_hash, merge_log, renditions)
+
+    # 只标准化还没完成的片段，已完成且哈希一致的直接沿用
+    # Only standardize clips not done yet; finished clips whose hash still matches are reused
+    pending = job.pending_clips()
+    if pending:
+        if len(pending) < merge_count:
+            logger.info(f"已有 {merge_count - len(pending)} 个片段标准化完成，还需处理 {len(pending)} 个")
+        job.set_step("standardize")
+
+        # 响度分析：每个源片段只分析一次，结果有缓存 / Loudness analysis: once per source clip, cached
+        measurements = {}
+        if normalize_audio:
+            from loudness import analyze_clips
+            measurements = analyze_clips([source for source, _ in pending])
+
+        # 标准化视频
+        failed = standardize_clips(pending, workers, measurements, on_done=job.mark_clip, executor=executor, tenant=tenant)
+        if failed:
+            for path in failed:
+                logger.error(f"❌ 标准化视频失败: {os.path.relpath(path, source_dir)}")
+            job.record_failure(f"标准化失败: {len(failed)} 个片段")
+            return None, 0
+    job.set_step("concat")
+    temp_video_paths = [job.clip_output(os.path.abspath(path)) for path in source_paths]
+
+    # 插入预先编码好的片头片尾，直接复制流拼接 / Splice in pre-encoded bumpers by stream copy
+    if bumper_paths:
+        from bumpers import splice_bumpers
+        temp_video_paths = splice_bumpers(temp_video_paths, bumper_paths)
+
+    # 重新编码拼接，分段和列表文件都放在任务自己的目录 / Re-encoded join; segments and list files stay in the job's own directory
+    if strategy == "reencode":
+        segmented = SEGMENTED_ENCODE if segmented is None else segmented
+        logger.info(f"正在重新编码合并{'（分段并行）' if segmented else ''}: {final_output_path}")
+        with metrics.span("merge.reencode", clips=len(temp_video_paths), segmented=segmented) as span:
+            ok = reencode_concat(temp_video_paths, final_output_path, job.work_dir, segmented, verify_quality)
+            span.status = "ok" if ok else "error"
+        if not ok:
+            logger.error("❌ 重新编码合并失败")
+            job.record_failure("重新编码合并失败")
+            return None, 0
+        logger.info(f"视频已保存: {final_output_path}")
+        job.record_output()
+        return finish_merge_job(job, all_videos, manifest_hash, merge_log, renditions)
     
     # 使用concat demuxer方法替代filter_complex方法
     # 创建合并列表文件
-    list_file = os.path.join(TEMP_DIR, "concat_list.txt")
+    list_file = os.path.join(job.work_dir, "concat_list.txt")
     with open(list_file, "w", encoding="utf-8") as f:
         for video_path in temp_video_paths:
             # 使用绝对路径并正确转义
             abs_path = os.path.abspath(video_path).replace('\\', '\\\\')
             f.write(f"file '{abs_path}'\n")
     
-    # 设置输出文件名
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    output_name = output_name or timestamp
-    final_output_path = os.path.join(MERGED_DIR, f"{output_name}.mp4")
-    
     # 使用concat demuxer执行合并
     command = [
         FFMPEG_PATH, "-y",
@@ -268,55 +519,98 @@ def merge_specific_videos(source_dir=None, output_name=None, max_per_batch=15, l
         final_output_path
     ]
     
-    print(f"正在合并视频: {final_output_path}")
-    result = subprocess.run(command, capture_output=True, text=True)
+    logger.info(f"正在合并视频: {final_output_path}")
+    with metrics.span("merge.concat", clips=len(temp_video_paths)) as span:
+        result = run_process(command)
+        span.status = "ok" if result.returncode == 0 else "error"
+        if result.returncode == 0:
+            span.set(bytes=os.path.getsize(final_output_path))
     
     if result.returncode == 0:
-        print(f"视频已保存: {final_output_path}")
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            for video in all_videos:
-                f.write(video + "\n")
-        print(f"成功合并: {merge_count} 个视频")
+        logger.info(f"视频已保存: {final_output_path}")
     else:
-        print(f"合并失败: {result.stderr}")
-        print("尝试使用备用方法合并...")
+        logger.error(f"合并失败: {result.stderr}")
+        logger.info("尝试使用备用方法合并...")
         
         # 如果concat demuxer方法失败，则尝试使用中间文件方法
-        final_success = merge_in_smaller_batches(temp_video_paths, final_output_path, 5)
+        final_success = merge_in_smaller_batches(temp_video_paths, final_output_path, 5, job.work_dir, job)
         if not final_success:
-            print("所有合并方法都失败了")
+            logger.error("所有合并方法都失败了")
+            job.record_failure("拼接失败")
             return None, 0
     
-    return os.path.abspath(final_output_path), merge_count
+    job.record_output()
+    return finish_merge_job(job, all_videos, manifest_hash, merge_log, renditions)
 
-def merge_in_smaller_batches(video_paths, output_path, batch_size=5):
+def append_merge_log(videos, merge_log=LOG_FILE):
+    """把合并过的片段追加到merged.log，已经记录过的不重复写
+    Append merged clips to merged.log, skipping ones already recorded"""
+    logged = set()
+    if os.path.exists(merge_log):
+        with open(merge_log, "r", encoding="utf-8") as f:
+            logged = set(line.strip() for line in f)
+    with open(merge_log, "a", encoding="utf-8") as f:
+        for video in videos:
+            if video not in logged:
+                f.write(video + "\n")
+
+def finish_merge_job(job, videos, manifest_hash, merge_log=LOG_FILE, renditions=None):
+    """合并任务的最后一步：生成额外的输出规格，写merged.log和清单缓存，然后清理任务的中间文件
+    Final step of a merge job: produce extra renditions, write merged.log and the manifest cache, then clean up the job's intermediates
+
+    生成规格失败不影响主文件 / A failed rendition doesn't affect the master
+    """
+    from merge_cache import record_output
+    if renditions:
+        from renditions import render
+        render(job.output, renditions)
+    # 先写清单缓存再写merged.log：中途崩溃时任务还能在finalize步骤继续 / Cache record before merged.log, so a crash in between still resumes at finalize
+    record_output(manifest_hash, job.output)
+    append_merge_log(videos, merge_log)
+    job.finish()
+    logger.info(f"成功合并: {len(videos)} 个视频")
+    return job.output, len(videos)
+
+def merge_in_smaller_batches(video_paths, output_path, batch_size=5, temp_dir=TEMP_DIR, job=None):
     """分批合并视频，适用于大量视频
-    Merge videos in smaller batches, suitable for large number of videos"""
+    Merge videos in smaller batches, suitable for large number of videos
+
+    Args:
+        temp_dir: 批次中间文件目录 / Directory for batch intermediates
+        job: 可选的merge_jobs.MergeJob，已完成的批次会被记录，继续时跳过
+             Optional merge_jobs.MergeJob; finished batches are recorded and skipped on resume
+    """
     if len(video_paths) <= batch_size:
         # 使用concat demuxer直接合并
-        return merge_with_concat_demuxer(video_paths, output_path)
+        return merge_with_concat_demuxer(video_paths, output_path, temp_dir)
     
     # 分批处理
     batch_outputs = []
     for i in range(0, len(video_paths), batch_size):
         batch = video_paths[i:i+batch_size]
-        batch_output = os.path.join(TEMP_DIR, f"batch_{i//batch_size}.mp4")
-        print(f"合并批次 {i//batch_size + 1}/{(len(video_paths) + batch_size - 1)//batch_size}...")
+        batch_output = os.path.abspath(os.path.join(temp_dir, f"batch_{i//batch_size}.mp4"))
+        if job and job.batch_done(batch_output, batch):
+            logger.info(f"批次 {i//batch_size + 1} 已完成，跳过")
+            batch_outputs.append(batch_output)
+            continue
+        logger.info(f"合并批次 {i//batch_size + 1}/{(len(video_paths) + batch_size - 1)//batch_size}...")
         
-        if merge_with_concat_demuxer(batch, batch_output):
+        if merge_with_concat_demuxer(batch, batch_output, temp_dir):
             batch_outputs.append(batch_output)
+            if job:
+                job.record_batch(batch_output, batch)
         else:
-            print(f"批次 {i//batch_size + 1} 合并失败")
+            logger.error(f"批次 {i//batch_size + 1} 合并失败")
             return False
     
     # 合并所有批次
-    return merge_with_concat_demuxer(batch_outputs, output_path)
+    return merge_with_concat_demuxer(batch_outputs, output_path, temp_dir)
 
-def merge_with_concat_demuxer(video_paths, output_path):
+def merge_with_concat_demuxer(video_paths, output_path, temp_dir=TEMP_DIR):
     """使用concat demuxer合并视频
     Merge videos using concat demuxer"""
     # 创建合并列表文件
-    list_file = os.path.join(TEMP_DIR, f"list_{os.path.basename(output_path)}.txt")
+    list_file = os.path.join(temp_dir, f"list_{os.path.basename(output_path)}.txt")
     with open(list_file, "w", encoding="utf-8") as f:
         for video_path in video_paths:
             # 使用绝对路径并正确转义
@@ -333,7 +627,7 @@ def merge_with_concat_demuxer(video_paths, output_path):
         output_path
     ]
     
-    result = subprocess.run(command, capture_output=True, text=True)
+    result = run_process(command)
     return result.returncode == 0
 
 def format_duration(seconds):
@@ -357,19 +651,40 @@ if __name__ == "__main__":
     parser.add_argument("--batch", "-b", type=int, help="每批最大视频数 / Maximum videos per batch", default=15)
     parser.add_argument("--last", "-l", type=int, help="只合并最后N个视频 / Only merge last N videos", default=None)
     parser.add_argument("--force", "-f", action="store_true", help="强制处理所有视频，不跳过已合并的 / Force process all videos, don't skip merged ones")
+    parser.add_argument("--smart", "-s", action="store_true", help="智能渲染：只重新编码拼接处的GOP / Smart render: only re-encode GOPs at joins")
+    parser.add_argument("--reencode", action="store_true", help="标准化后重新编码拼接，而不是复制流 / Re-encode the join instead of stream copying")
+    parser.add_argument("--segmented", action=argparse.BooleanOptionalAction, default=None,
+                        help="重新编码时分段并行编码（默认按MERGE_SEGMENTED，隐含--reencode）/ Segment-parallel re-encode (defaults to MERGE_SEGMENTED, implies --reencode)")
+    parser.add_argument("--verify", action="store_true", help="分段编码后用SSIM校验 / Verify the segmented encode with SSIM")
+    parser.add_argument("--crossfade", type=float, default=0.0, help="智能渲染时拼接处的交叉淡化秒数 / Crossfade seconds at joins in smart mode")
+    parser.add_argument("--bumpers", action="store_true", help="插入片头、片尾和转场素材 / Splice in intro, outro and transition bumpers")
+    parser.add_argument("--normalize", "-n", action="store_true", help="响度归一化（EBU R128）/ Normalize loudness (EBU R128)")
+    parser.add_argument("--renditions", help="额外的输出规格，逗号分隔，如preview,landscape / Extra output renditions, comma separated, e.g. preview,landscape")
+    parser.add_argument("--workers", "-w", type=int, default=STANDARDIZE_WORKERS, help="并行标准化任务数 / Parallel standardization jobs")
+    import profiling
+    profiling.add_argument(parser)
     args = parser.parse_args()
+    strategy = "smart" if args.smart else "reencode" if args.reencode or args.segmented else "concat"
+    renditions = [name.strip() for name in args.renditions.split(",") if name.strip()] if args.renditions else None
     
     start_time = time.time()
     
-    if args.dir:
-        # 合并指定目录的视频
-        path, count = merge_specific_videos(args.dir, args.output, args.batch, args.last, args.force)
-    else:
-        # 使用默认函数合并已下载视频，并传递last_n参数
-        path, count = merge_specific_videos(DOWNLOADS_DIR, output_name=args.output, max_per_batch=args.batch, last_n=args.last, force_all=args.force)
+    with profiling.stage("merge", args.profile):
+        if args.dir:
+            # 合并指定目录的视频
+            path, count = merge_specific_videos(args.dir, args.output, args.batch, args.last, args.force,
+                                                strategy=strategy, crossfade=args.crossfade, bumpers=args.bumpers,
+                                                normalize_audio=args.normalize, workers=args.workers, renditions=renditions,
+                                                segmented=args.segmented, verify_quality=args.verify)
+        else:
+            # 使用默认函数合并已下载视频，并传递last_n参数
+            path, count = merge_specific_videos(DOWNLOADS_DIR, output_name=args.output, max_per_batch=args.batch, last_n=args.last, force_all=args.force,
+                                                strategy=strategy, crossfade=args.crossfade, bumpers=args.bumpers,
+                                                normalize_audio=args.normalize, workers=args.workers, renditions=renditions,
+                                                segmented=args.segmented, verify_quality=args.verify)
     
     if path:
-        print(f"✅ 合并完成，生成文件：{path}，合并数量：{count} 个")
+        logger.info(f"✅ 合并完成，生成文件：{path}，合并数量：{count} 个")
     else:
-        print("❌ 合并失败")
-    print(f"总用时: {format_duration(time.time() - start_time)}")
+        logger.error("❌ 合并失败")
+    logger.info(f"总用时: {format_duration(time.time() - start_time)}")
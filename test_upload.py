@@ -5,6 +5,9 @@ import glob
 import random
 import logging
 import sys
+import json
+import re
+from contextlib import contextmanager
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -15,6 +18,11 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
 from selenium.common.exceptions import TimeoutException
 
+import metrics
+from log_setup import get_logger
+
+logger = get_logger("upload")
+
 # ==== 配置 / Configuration ====# Chrome浏览器和驱动路径 / Chrome browser and driver paths
 CHROMEDRIVER_PATH = r"C:\Code\instagramDownloader\tools\chromedriver-win64\chromedriver.exe"
 MERGED_FOLDER = r"C:\Code\instagramDownloader\merged"  # 合并视频目录 / Merged videos directory
@@ -22,6 +30,14 @@ PROFILE_PATH = r"C:\Code\instagramDownloader\selenium_profile"  # 浏览器配
 TITLE_PREFIX = "海外离大谱#"  # 视频标题前缀 / Video title prefix
 SCREENSHOT_DIR = "screenshots"  # 截图保存目录 / Screenshots directory
 SERIAL_NUMBER_FILE = "serial_number.txt"  # 序列号记录文件 / Serial number record file
+SERIAL_LOCK_FILE = SERIAL_NUMBER_FILE + ".lock"  # 序列号文件锁 / Serial number file lock
+SERIAL_RESERVATIONS_FILE = "serial_reservations.json"  # 已预留和已释放的序列号 / Reserved and released serial numbers
+UPLOADED_LOG = os.path.join("test_logs", "uploaded.log")  # 已上传视频记录 / Uploaded video records
+UPLOAD_STEP_LOG = os.path.join("logs", "upload_steps.jsonl")  # 上传步骤耗时记录 / Upload step timing records
+UPLOAD_STALL_TIMEOUT = 120  # 上传进度停滞超过该秒数视为失败 / Fail if upload progress stalls this long (seconds)
+UPLOAD_MAX_TIMEOUT = 3 * 3600  # 单次上传的绝对上限（秒）/ Absolute limit for one transfer (seconds)
+UPLOAD_NO_PROGRESS_TIMEOUT = 600  # 读不到进度元素时的等待上限（秒）/ Limit when no progress element can be read (seconds)
+PROGRESS_SELECTOR = ".el-progress__text, .uploading, .progress"  # 上传进度元素 / Upload progress elements
 os.makedirs(SCREENSHOT_DIR, exist_ok=True)  # 确保截图目录存在 / Ensure screenshots directory exists
 
 # 屏蔽日志输出 / Suppress log output
@@ -33,17 +49,167 @@ logging.getLogger("webdriver").setLevel(logging.ERROR)
 os.environ["CHROME_LOG_FILE"] = os.devnull
 
 
-def load_serial_number():
+def get_channel(channel=None):
+    """上传目标频道的设置，未指定的项使用本模块的默认值（多租户见pipelines.py）
+    Settings of the target channel; unset keys fall back to this module's defaults (see pipelines.py for tenants)"""
+    return {
+        "title_prefix": TITLE_PREFIX,
+        "serial_file": SERIAL_NUMBER_FILE,
+        "uploaded_log": UPLOADED_LOG,
+        **(channel or {}),
+    }
+
+def _serial_paths(serial_file=None):
+    """序列号文件、锁文件和预留记录文件，锁和预留记录放在序列号文件旁边
+    Serial file, lock file and reservations file; the lock and reservations live next to the serial file"""
+    serial_file = serial_file or SERIAL_NUMBER_FILE
+    folder = os.path.dirname(serial_file)
+    return serial_file, serial_file + ".lock", os.path.join(folder, os.path.basename(SERIAL_RESERVATIONS_FILE))
+
+def load_serial_number(serial_file=None):
     """加载序列号，不存在则从20开始
     Load serial number, start from 20 if not exists"""
-    return int(open(SERIAL_NUMBER_FILE).read()) if os.path.exists(SERIAL_NUMBER_FILE) else 20
+    serial_file = serial_file or SERIAL_NUMBER_FILE
+    return int(open(serial_file).read()) if os.path.exists(serial_file) else 20
 
-def save_serial_number(num):
+def save_serial_number(num, serial_file=None):
     """保存序列号到文件
     Save serial number to file"""
-    with open(SERIAL_NUMBER_FILE, "w") as f:
+    with open(serial_file or SERIAL_NUMBER_FILE, "w") as f:
         f.write(str(num))
 
+def _lock_fd(fd):
+    """非阻塞地锁住已打开的锁文件，被占用时返回False
+    Lock an open lock file without blocking; False if someone else holds it"""
+    if sys.platform == "win32":
+        import msvcrt
+
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+    import fcntl
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+def _unlock_fd(fd):
+    if sys.platform == "win32":
+        import msvcrt
+
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+@contextmanager
+def serial_lock(timeout=30, serial_file=None):
+    """跨进程的序列号文件锁：对常驻的锁文件加flock/msvcrt锁，锁文件本身不删除，
+    持有锁的进程崩溃时操作系统会自动释放锁，不需要判断残留
+    Cross-process lock for the serial number: flock/msvcrt lock on a persistent lock file that is never
+    deleted; the OS drops the lock when a holder crashes, so there is no stale lock to detect"""
+    _, lock_file, _ = _serial_paths(serial_file)
+    fd = os.open(lock_file, os.O_CREAT | os.O_RDWR)
+    try:
+        deadline = time.time() + timeout
+        while not _lock_fd(fd):
+            if time.time() > deadline:
+                raise TimeoutError(f"无法获取序列号锁: {lock_file}")
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            _unlock_fd(fd)
+    finally:
+        os.close(fd)
+
+def _load_reservations(serial_file=None):
+    """读取预留记录；文件损坏时改名为.corrupt备查，从空记录开始
+    Load the reservations; a corrupt file is renamed to .corrupt for inspection and an empty record is used"""
+    _, _, reservations_file = _serial_paths(serial_file)
+    data = {}
+    if os.path.exists(reservations_file):
+        try:
+            with open(reservations_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            logger.warning(f"预留记录文件损坏，已重置: {reservations_file} ({e})")
+            os.replace(reservations_file, reservations_file + ".corrupt")
+            data = {}
+    data.setdefault("reserved", {})
+    data.setdefault("released", [])
+    return data
+
+def _save_reservations(data, serial_file=None):
+    _, _, reservations_file = _serial_paths(serial_file)
+    tmp_file = reservations_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, reservations_file)
+
+def reserve_serial_number(video=None, serial_file=None):
+    """原子地预留一个序列号，优先复用失败上传释放的序列号
+    Atomically reserve a serial number, reusing numbers released by failed uploads first
+
+    Args:
+        serial_file: 可选，频道自己的序列号文件，默认SERIAL_NUMBER_FILE / Optional per-channel serial file, defaults to SERIAL_NUMBER_FILE
+    """
+    with serial_lock(serial_file=serial_file):
+        data = _load_reservations(serial_file)
+        if data["released"]:
+            serial = min(data["released"])
+            data["released"].remove(serial)
+        else:
+            serial = load_serial_number(serial_file)
+            save_serial_number(serial + 1, serial_file)
+        data["reserved"][str(serial)] = {"video": video, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        _save_reservations(data, serial_file)
+    return serial
+
+def commit_serial_number(serial, serial_file=None):
+    """上传成功后确认序列号已被使用
+    Confirm a serial number as used after a successful upload"""
+    with serial_lock(serial_file=serial_file):
+        data = _load_reservations(serial_file)
+        data["reserved"].pop(str(serial), None)
+        _save_reservations(data, serial_file)
+
+def release_serial_number(serial, serial_file=None):
+    """上传失败时释放序列号，下次预留时会被复用
+    Release a serial number after a failed upload so it is reused by the next reservation"""
+    with serial_lock(serial_file=serial_file):
+        data = _load_reservations(serial_file)
+        data["reserved"].pop(str(serial), None)
+        if serial not in data["released"]:
+            data["released"].append(serial)
+        _save_reservations(data, serial_file)
+
+def record_uploaded(video_path, log_file=None):
+    """记录已成功上传的视频
+    Record a successfully uploaded video"""
+    log_file = log_file or UPLOADED_LOG
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    with open(log_file, "a", encoding="utf-8") as f:
+        f.write(os.path.basename(video_path) + "\n")
+
+def load_uploaded(log_file=None):
+    """读取已上传视频的文件名
+    Load the file names of uploaded videos"""
+    log_file = log_file or UPLOADED_LOG
+    if not os.path.exists(log_file):
+        return set()
+    with open(log_file, "r", encoding="utf-8") as f:
+        return set(line.strip() for line in f if line.strip())
+
 def find_latest_video(folder):
     """查找指定文件夹中最新的视频文件
     Find the latest video file in the specified folder"""
@@ -53,9 +219,13 @@ def find_latest_video(folder):
     return max(videos, key=os.path.getmtime)  # 返回修改时间最新的视频 / Return the video with the latest modification time
 
 
-def init_browser():
+def init_browser(profile_path=None):
     """初始化Chrome浏览器，配置各种选项
-    Initialize Chrome browser with various options"""
+    Initialize Chrome browser with various options
+
+    Args:
+        profile_path: 可选，浏览器配置文件目录，默认使用PROFILE_PATH / Optional browser profile directory, defaults to PROFILE_PATH
+    """
     options = Options()
     # 抑制浏览器日志输出 / Suppress browser log output
     options.add_argument("--log-level=3")  # 仅显示致命错误 / Show only fatal errors
@@ -69,7 +239,7 @@ def init_browser():
     })
     
     # 浏览器配置 / Browser configuration
-    options.add_argument(f"--user-data-dir={PROFILE_PATH}")
+    options.add_argument(f"--user-data-dir={profile_path or PROFILE_PATH}")
     options.add_argument("--profile-directory=Default")
     options.add_argument("--window-size=960,1080")  # 设置窗口大小 / Set window size
     options.add_argument("--window-position=960,0")  # 设置窗口位置 / Set window position
@@ -102,11 +272,40 @@ def init_browser():
     return driver, WebDriverWait(driver, 30)  # 返回驱动和等待对象 / Return driver and wait object
 
 
+@contextmanager
+def timed_step(step, **fields):
+    """记录一个上传步骤的耗时，结果以JSON行写入UPLOAD_STEP_LOG
+    Time one upload step and append the result as a JSON line to UPLOAD_STEP_LOG
+
+    with块中可以往返回的dict里添加额外字段 / Extra fields can be added to the yielded dict inside the block
+    """
+    record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "step": step, **fields}
+    start = time.time()
+    ok = False
+    try:
+        yield record
+        ok = True
+    finally:
+        record["duration"] = round(time.time() - start, 3)
+        record["ok"] = ok
+        os.makedirs(os.path.dirname(UPLOAD_STEP_LOG), exist_ok=True)
+        with open(UPLOAD_STEP_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        attrs = {key: value for key, value in record.items() if key not in ("time", "step", "duration", "ok")}
+        if "file_size" in attrs:
+            attrs["bytes"] = attrs.pop("file_size")
+        metrics.record_span(f"upload.{step}", record["duration"], "ok" if ok else "error", **attrs)
+        extra = f" ({record['throughput_mb_s']:.2f}MB/s)" if record.get("throughput_mb_s") else ""
+        logger.info(f"⏱ {step}: {record['duration']:.1f}秒{extra}")
+
+
 def open_upload_page(driver):
     """打开B站投稿页面
     Open Bilibili upload page"""
     driver.get("https://member.bilibili.com/platform/upload/video/")
-    time.sleep(3)  # 等待页面加载 / Wait for page to load
+    # 等待页面加载完成并出现上传区域 / Wait until the page is loaded and the upload area exists
+    WebDriverWait(driver, 30).until(lambda d: d.execute_script("return document.readyState") == "complete")
+    WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.CLASS_NAME, "bcc-upload")))
     driver.execute_script("document.body.style.zoom='90%'")  # 缩小页面以便显示全部内容 / Zoom out to show all content
 
 
@@ -125,33 +324,90 @@ def upload_video(driver, video_path):
     upload_input.send_keys(video_path)
 
 
-def wait_for_upload_complete(driver):
-    """等待视频上传完成
-    Wait for video upload to complete"""
-    wait = WebDriverWait(driver, 600)  # 最多等待10分钟 / Wait for up to 10 minutes
-    # 等待上传完成提示出现 / Wait for upload complete prompt
-    wait.until(EC.presence_of_element_located((By.XPATH, '//div[contains(text(), "上传完成")]')))
-    # 等待进度条消失 / Wait for progress bar to disappear
-    wait.until_not(EC.presence_of_element_located((By.CSS_SELECTOR, ".el-progress__text, .uploading, .progress")))
-    time.sleep(3)  # 额外等待以确保UI更新 / Additional wait to ensure UI updates
+def read_upload_progress(driver):
+    """从页面的进度元素读取上传百分比，读取不到时返回None
+    Read the upload percentage from the page's progress element, None if unavailable"""
+    for element in driver.find_elements(By.CSS_SELECTOR, PROGRESS_SELECTOR):
+        try:
+            match = re.search(r"(\d+(?:\.\d+)?)\s*%", element.text)
+        except Exception:
+            continue
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def wait_for_upload_complete(driver, file_size=None):
+    """等待视频上传完成：只要进度还在前进就继续等，停滞超过UPLOAD_STALL_TIMEOUT才失败；
+    一直读不到进度（页面改版后PROGRESS_SELECTOR不匹配）时不判断停滞，最多等UPLOAD_NO_PROGRESS_TIMEOUT
+    Wait for the upload to complete: keep waiting while progress advances, fail only after it stalls
+    for UPLOAD_STALL_TIMEOUT; if progress is never readable (PROGRESS_SELECTOR stops matching after a
+    page change) there is no stall check and the wait is capped at UPLOAD_NO_PROGRESS_TIMEOUT
+
+    Returns:
+        dict: 传输统计（用时、吞吐量）/ Transfer statistics (elapsed, throughput)
+    """
+    start = time.time()
+    state = {"progress": None, "changed": start, "first": None, "last": None}
 
+    def upload_finished(d):
+        # 出现上传完成提示且进度条消失 / Complete prompt shown and progress bar gone
+        if d.find_elements(By.XPATH, '//div[contains(text(), "上传完成")]') and \
+                not d.find_elements(By.CSS_SELECTOR, PROGRESS_SELECTOR):
+            return True
+        now = time.time()
+        progress = read_upload_progress(d)
+        if progress is not None and (state["progress"] is None or progress > state["progress"]):
+            state["progress"] = progress
+            state["changed"] = now
+            state["first"] = state["first"] or (now, progress)
+            state["last"] = (now, progress)
+        elif state["progress"] is None:
+            if now - start > UPLOAD_NO_PROGRESS_TIMEOUT:
+                raise TimeoutException(f"{UPLOAD_NO_PROGRESS_TIMEOUT} 秒内未读到上传进度，也未完成")
+        elif now - state["changed"] > UPLOAD_STALL_TIMEOUT:
+            raise TimeoutException(f"上传进度停滞超过 {UPLOAD_STALL_TIMEOUT} 秒（{state['progress']}%）")
+        return False
 
-def fill_title(driver):
+    WebDriverWait(driver, UPLOAD_MAX_TIMEOUT, poll_frequency=1).until(upload_finished)
+
+    elapsed = time.time() - start
+    stats = {"elapsed": round(elapsed, 3)}
+    if file_size:
+        stats["file_size"] = file_size
+        # 用进度元素的两次采样计算吞吐量，采样不足时按总用时估算
+        # Throughput from two progress samples, falling back to total elapsed time
+        first, last = state["first"], state["last"]
+        if first and last and last[0] > first[0] and last[1] > first[1]:
+            transferred = file_size * (last[1] - first[1]) / 100
+            stats["throughput_mb_s"] = round(transferred / (last[0] - first[0]) / (1024 * 1024), 3)
+        elif elapsed > 0:
+            stats["throughput_mb_s"] = round(file_size / elapsed / (1024 * 1024), 3)
+    return stats
+
+
+def fill_title(driver, serial=None, channel=None):
     """填写视频标题
-    Fill video title"""
-    # 等待标题输入框出现 / Wait for title input to appear
+    Fill video title
+
+    Args:
+        serial: 预先预留的序列号，为None时立即分配一个 / Pre-reserved serial number, allocated now if None
+        channel: 可选，目标频道设置（见get_channel）/ Optional target channel settings (see get_channel)
+    """
+    channel = get_channel(channel)
+    # 等待标题输入框可以输入 / Wait for title input to become interactable
     WebDriverWait(driver, 60).until(
-        EC.presence_of_element_located((By.XPATH, '//input[@placeholder="请输入稿件标题"]'))
+        EC.element_to_be_clickable((By.XPATH, '//input[@placeholder="请输入稿件标题"]'))
     )
     # 获取序列号并生成标题 / Get serial number and generate title
-    serial = load_serial_number()
-    title = f"{TITLE_PREFIX}{serial}"
+    if serial is None:
+        serial = reserve_serial_number(serial_file=channel["serial_file"])
+        commit_serial_number(serial, channel["serial_file"])
+    title = f"{channel['title_prefix']}{serial}"
     # 清空并填写标题 / Clear and fill title
     input_box = driver.find_element(By.XPATH, '//input[@placeholder="请输入稿件标题"]')
     input_box.clear()
     input_box.send_keys(title)
-    # 保存下一个序列号 / Save next serial number
-    save_serial_number(serial + 1)
 
 
 def click_publish(driver):
@@ -163,8 +419,12 @@ def click_publish(driver):
     )
     # 滚动到按钮位置 / Scroll to button position
     driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", button)
+    # 等待按钮滚动到视口内 / Wait until the button has scrolled into the viewport
+    WebDriverWait(driver, 10).until(lambda d: d.execute_script(
+        "const r = arguments[0].getBoundingClientRect();"
+        "return r.top >= 0 && r.bottom <= window.innerHeight;", button))
     # 使用ActionChains点击以提高可靠性 / Use ActionChains to click for better reliability
-    ActionChains(driver).move_to_element(button).pause(0.5).click().perform()
+    ActionChains(driver).move_to_element(button).click().perform()
 
 
 def wait_for_publish_success(driver):
@@ -183,23 +443,63 @@ def wait_for_publish_success(driver):
         pass
 
 
-def upload_latest_merged_video(video_path=None):
+def run_upload_flow(driver, video, channel=None):
+    """在已打开的浏览器中执行一次完整的投稿流程
+    Run one complete upload flow in an already running browser"""
+    channel = get_channel(channel)
+    serial_file = channel["serial_file"]
+    video_name = os.path.basename(video)
+    # 传输开始前预留序列号，并发上传不会拿到同一个标题 / Reserve the serial before the transfer so concurrent uploads never share a title
+    serial = reserve_serial_number(video_name, serial_file)
+    published = False
+    succeeded = False
+    try:
+        with timed_step("open_page", video=video_name):
+            open_upload_page(driver)
+        with timed_step("file_attach", video=video_name):
+            upload_video(driver, video)
+        with timed_step("transfer", video=video_name) as record:
+            record.update(wait_for_upload_complete(driver, os.path.getsize(video)))
+        with timed_step("title_fill", video=video_name, serial=serial):
+            fill_title(driver, serial, channel)
+        with timed_step("publish", video=video_name):
+            published = True  # 点击后稿件可能已经提交，序列号不能再复用 / After the click the serial may be used
+            click_publish(driver)
+        with timed_step("confirmation", video=video_name):
+            wait_for_publish_success(driver)
+        succeeded = True
+    finally:
+        # finally而不是except Exception：Ctrl+C中断时序列号也要释放 / finally, not except Exception, so Ctrl+C releases the serial too
+        if succeeded or published:
+            commit_serial_number(serial, serial_file)
+        else:
+            release_serial_number(serial, serial_file)
+    record_uploaded(video, channel["uploaded_log"])
+
+
+def upload_latest_merged_video(video_path=None, driver=None, channel=None):
     """上传最新合并的视频到B站
     Upload the latest merged video to Bilibili
     
     Args:
         video_path: 可选，指定要上传的视频路径，如果为None则自动查找最新视频
+        driver: 可选，复用已登录的浏览器（不会被关闭），为None时启动新浏览器
+                Optional already-authenticated browser to reuse (not closed); a new one is started if None
+        channel: 可选，目标频道设置（标题前缀、序列号文件、上传记录），见get_channel
+                 Optional target channel settings (title prefix, serial file, upload log), see get_channel
         
     Returns:
         (success, duration): 上传成功与否和用时
     """
-    # 临时屏蔽stderr输出 / Suppress stderr output
+    owns_driver = driver is None
+    # 临时屏蔽stderr输出（复用浏览器时可能有多个线程并发，不修改全局stderr）
+    # Suppress stderr output (not with a reused browser, other threads may be uploading concurrently)
     original_stderr = sys.stderr
-    null_output = open(os.devnull, 'w')
-    sys.stderr = null_output
+    null_output = open(os.devnull, 'w') if owns_driver else None
+    if null_output:
+        sys.stderr = null_output
     
     start = time.time()
-    driver = None
     success = False
     
     try:
@@ -212,40 +512,37 @@ def upload_latest_merged_video(video_path=None):
             if not os.path.exists(video):
                 raise FileNotFoundError(f"指定的视频文件不存在: {video}")
         
-        print(f"正在上传视频到哔哩哔哩: {os.path.basename(video)}")
+        logger.info(f"正在上传视频到哔哩哔哩: {os.path.basename(video)}")
         
         # 初始化浏览器 / Initialize browser
-        driver, _ = init_browser()
+        if owns_driver:
+            driver, _ = init_browser()
         # 执行上传流程 / Execute upload process
-        open_upload_page(driver)
-        upload_video(driver, video)
-        wait_for_upload_complete(driver)
-        fill_title(driver)
-        click_publish(driver)
-        wait_for_publish_success(driver)
+        run_upload_flow(driver, video, channel)
         
         success = True
     except FileNotFoundError as e:
-        print(f"文件错误: {str(e)}")
+        logger.error(f"文件错误: {str(e)}")
     except Exception as e:
-        print(f"上传失败: {str(e)}")
+        logger.error(f"上传失败: {str(e)}")
         if driver:
             # 截图记录失败状态 / Screenshot to record failure state
             driver.save_screenshot(os.path.join(SCREENSHOT_DIR, f"上传失败.png"))
     finally:
-        # 关闭浏览器 / Close browser
-        if driver:
+        # 关闭浏览器（复用的浏览器由调用方管理）/ Close browser (a reused browser is managed by the caller)
+        if driver and owns_driver:
             driver.quit()
         
         # 恢复stderr / Restore stderr
-        sys.stderr = original_stderr
-        null_output.close()
+        if null_output:
+            sys.stderr = original_stderr
+            null_output.close()
         
         # 显示结果 / Show result
         duration = time.time() - start
         if success:
-            print(f"上传成功！用时{int(duration)}秒")  # Upload successful! Time used: X seconds
+            logger.info(f"上传成功！用时{int(duration)}秒")  # Upload successful! Time used: X seconds
         else:
-            print("上传失败，请检查错误信息")  # Upload failed, please check error message
+            logger.error("上传失败，请检查错误信息")  # Upload failed, please check error message
         
         return success, duration
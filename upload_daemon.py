@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+B站上传守护进程：保持已登录的浏览器常驻，从队列中取上传任务
+Bilibili upload daemon: keeps authenticated browsers warm and serves upload jobs from a queue
+
+浏览器启动和页面加载只在开始时付出一次；上传N次后或浏览器内存过大时自动重启浏览器，防止Chrome内存泄漏。
+任务以JSON文件的形式放在upload_queue/pending中，其他进程用submit_upload提交。
+Browser start-up and page load are paid once; the browser is recycled after N uploads or when its
+memory grows too large, to contain Chrome leaks. Jobs are JSON files in upload_queue/pending,
+submitted by other processes with submit_upload.
+
+有积压时可以并发上传（每个上传线程一个浏览器实例），标题序列号由test_upload原子分配。
+With a backlog, several uploads can run in parallel (one browser instance per upload thread);
+title serial numbers are allocated atomically by test_upload.
+"""
+
+import os
+import sys
+import json
+import glob
+import shutil
+import signal
+import threading
+from datetime import datetime
+
+from test_upload import (
+    init_browser, open_upload_page, upload_latest_merged_video, load_uploaded, PROFILE_PATH, MERGED_FOLDER,
+)
+from log_setup import get_logger
+
+logger = get_logger("upload")
+
+QUEUE_DIR = "upload_queue"  # 上传队列目录 / Upload queue directory
+PENDING_DIR = os.path.join(QUEUE_DIR, "pending")  # 待上传 / Waiting
+PROCESSING_DIR = os.path.join(QUEUE_DIR, "processing")  # 正在上传 / In progress
+DONE_DIR = os.path.join(QUEUE_DIR, "done")  # 上传成功 / Succeeded
+FAILED_DIR = os.path.join(QUEUE_DIR, "failed")  # 上传失败 / Failed
+
+MAX_UPLOADS_PER_BROWSER = int(os.environ.get("UPLOAD_MAX_PER_BROWSER", 10))  # 每个浏览器最多上传次数 / Uploads before recycling
+MAX_BROWSER_MEMORY_MB = int(os.environ.get("UPLOAD_MAX_BROWSER_MB", 1500))  # 浏览器内存上限 / Browser memory limit
+POLL_INTERVAL = 10  # 队列为空时的检查间隔（秒）/ Queue poll interval when idle (seconds)
+
+
+def _process_tree_memory_mb(pid):
+    """统计进程及其子进程的内存（需要psutil）
+    Total memory of a process and its children (requires psutil)"""
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        root = psutil.Process(pid)
+        processes = [root] + root.children(recursive=True)
+    except psutil.Error:
+        return None
+    total = 0
+    for process in processes:
+        try:
+            total += process.memory_info().rss
+        except psutil.Error:
+            pass
+    return total / (1024 * 1024)
+
+
+class WarmBrowser:
+    """常驻的已登录浏览器，按上传次数和内存占用自动重启
+    A warm authenticated browser, recycled by upload count and memory usage"""
+
+    def __init__(self, max_uploads=MAX_UPLOADS_PER_BROWSER, max_memory_mb=MAX_BROWSER_MEMORY_MB, profile_path=None,
+                 channel=None):
+        self.max_uploads = max_uploads
+        self.max_memory_mb = max_memory_mb
+        self.profile_path = profile_path or PROFILE_PATH
+        self.channel = channel  # 这个浏览器登录的频道（标题前缀、序列号）/ Channel this browser is logged into (title prefix, serial)
+        self.driver = None
+        self.uploads = 0
+
+    def get(self):
+        """返回可用的浏览器，不存在或已失效时重新启动
+        Return a usable browser, (re)starting it if missing or dead"""
+        if self.driver is not None:
+            try:
+                _ = self.driver.current_url  # 检查会话是否还活着 / Check the session is still alive
+            except Exception:
+                logger.info("浏览器会话已失效，重新启动")
+                self.recycle()
+        if self.driver is None:
+            logger.info("正在启动浏览器...")
+            self.driver, _ = init_browser(self.profile_path)
+            self.uploads = 0
+            open_upload_page(self.driver)  # 预热投稿页面 / Warm up the upload page
+        return self.driver
+
+    def memory_mb(self):
+        """浏览器占用的内存（MB），无法测量时返回None
+        Browser memory in MB, None if it cannot be measured"""
+        if self.driver is None:
+            return None
+        try:
+            browser_pid = self.driver.service.process.pid
+        except AttributeError:
+            return None
+        memory = _process_tree_memory_mb(browser_pid)
+        if memory is not None:
+            return memory
+        # 没有psutil时退而使用页面的JS堆大小 / Without psutil, fall back to the page's JS heap size
+        try:
+            metrics = self.driver.execute_cdp_cmd("Performance.getMetrics", {})["metrics"]
+            heap = next(m["value"] for m in metrics if m["name"] == "JSHeapTotalSize")
+            return heap / (1024 * 1024)
+        except Exception:
+            return None
+
+    def after_upload(self, success):
+        """一次上传结束后决定是否重启浏览器
+        Decide whether to recycle the browser after an upload"""
+        self.uploads += 1
+        if not success:
+            # 失败后页面状态未知，直接重启 / Page state is unknown after a failure, recycle
+            self.recycle()
+            return
+        memory = self.memory_mb()
+        if self.uploads >= self.max_uploads:
+            logger.info(f"浏览器已上传 {self.uploads} 次，重启以释放内存")
+            self.recycle()
+        elif memory is not None and memory > self.max_memory_mb:
+            logger.info(f"浏览器内存 {memory:.0f}MB 超过上限 {self.max_memory_mb}MB，重启")
+            self.recycle()
+
+    def recycle(self):
+        """关闭浏览器，下次使用时重新启动
+        Close the browser; it is restarted on next use"""
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+        self.driver = None
+        self.uploads = 0
+
+    def upload(self, video_path):
+        """用常驻浏览器上传一个视频
+        Upload one video with the warm browser"""
+        success, duration = upload_latest_merged_video(video_path=video_path, driver=self.get(), channel=self.channel)
+        self.after_upload(success)
+        return success, duration
+
+
+def ensure_queue_dirs():
+    """确保队列目录存在
+    Ensure queue directories exist"""
+    for folder in (PENDING_DIR, PROCESSING_DIR, DONE_DIR, FAILED_DIR):
+        os.makedirs(folder, exist_ok=True)
+
+
+def submit_upload(video_path):
+    """提交一个上传任务到队列
+    Submit an upload job to the queue
+
+    Returns:
+        任务文件路径 / Job file path
+    """
+    ensure_queue_dirs()
+    video_path = os.path.abspath(video_path)
+    job_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.json"
+    tmp_file = os.path.join(QUEUE_DIR, job_name + ".tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump({"video_path": video_path, "submitted": datetime.now().isoformat(timespec="seconds")}, f, ensure_ascii=False)
+    job_file = os.path.join(PENDING_DIR, job_name)
+    os.replace(tmp_file, job_file)
+    logger.info(f"已提交上传任务: {os.path.basename(video_path)}")
+    return job_file
+
+
+def claim_next_job():
+    """取出最早提交的任务并移动到processing目录
+    Take the oldest job and move it to the processing directory"""
+    for job_file in sorted(glob.glob(os.path.join(PENDING_DIR, "*.json"))):
+        claimed = os.path.join(PROCESSING_DIR, os.path.basename(job_file))
+        try:
+            os.replace(job_file, claimed)
+        except OSError:
+            continue  # 被其他进程抢先取走 / Taken by another process
+        return claimed
+    return None
+
+
+def finish_job(job_file, success, duration):
+    """记录任务结果并移动到done或failed目录
+    Record the job result and move it to done or failed"""
+    with open(job_file, "r", encoding="utf-8") as f:
+        job = json.load(f)
+    job.update({"success": success, "duration": round(duration, 1), "finished": datetime.now().isoformat(timespec="seconds")})
+    with open(job_file, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    shutil.move(job_file, os.path.join(DONE_DIR if success else FAILED_DIR, os.path.basename(job_file)))
+
+
+def recover_interrupted_jobs():
+    """把上次中断时正在处理的任务放回队列
+    Put jobs interrupted last time back into the queue"""
+    for job_file in glob.glob(os.path.join(PROCESSING_DIR, "*.json")):
+        os.replace(job_file, os.path.join(PENDING_DIR, os.path.basename(job_file)))
+
+
+def worker_profile(index, base_profile=None):
+    """第index个并发上传使用的浏览器配置目录
+    Browser profile directory for the index-th concurrent uploader
+
+    Chrome不允许两个实例共用一个配置目录，其余实例使用从主配置复制出来的目录（包含登录状态）。
+    Chrome won't share a profile directory between instances, so the others use a copy of the main
+    profile (which carries the login state).
+
+    Args:
+        base_profile: 主配置目录，即频道自己的profile_path，默认PROFILE_PATH
+                      The main profile, i.e. the channel's own profile_path; defaults to PROFILE_PATH
+    """
+    base_profile = base_profile or PROFILE_PATH
+    if index == 0:
+        return base_profile
+    profile = f"{base_profile}_worker{index}"
+    if not os.path.exists(profile):
+        logger.info(f"正在复制浏览器配置: {profile}")
+        shutil.copytree(base_profile, profile, ignore=shutil.ignore_patterns("Singleton*", "lockfile", "*.lock"))
+    return profile
+
+
+def _serve_worker(stop_event, browser, once, keep_warm=False):
+    """单个上传线程：不断取任务并用自己的浏览器上传
+    One upload thread: keeps claiming jobs and uploads them with its own browser"""
+    try:
+        while not stop_event.is_set():
+            job_file = claim_next_job()
+            if not job_file:
+                if once:
+                    break
+                stop_event.wait(POLL_INTERVAL)
+                continue
+
+            with open(job_file, "r", encoding="utf-8") as f:
+                video_path = json.load(f)["video_path"]
+            if not os.path.exists(video_path):
+                logger.error(f"❌ 视频文件不存在，跳过: {video_path}")
+                finish_job(job_file, False, 0.0)
+                continue
+
+            try:
+                success, duration = browser.upload(video_path)
+            except Exception as e:
+                logger.error(f"上传任务出错: {e}")
+                browser.recycle()
+                success, duration = False, 0.0
+            finish_job(job_file, success, duration)
+    finally:
+        if not keep_warm:
+            browser.recycle()
+
+
+def serve(stop_event=None, browser=None, once=False, concurrency=1, keep_warm=False):
+    """持续处理队列中的上传任务，直到收到停止信号
+    Serve upload jobs from the queue until stopped
+
+    Args:
+        stop_event: 可选的threading.Event，设置后退出 / Optional threading.Event, exits when set
+        browser: 可选的WarmBrowser，用于第一个上传线程 / Optional WarmBrowser for the first upload thread
+        once: 队列清空后立即退出 / Exit as soon as the queue is empty
+        concurrency: 并发上传数，每个上传线程有独立的浏览器 / Concurrent uploads, each thread has its own browser
+        keep_warm: 退出时不关闭传入的browser，供调用方下次复用 / Leave the passed browser open on exit for reuse by the caller
+    """
+    ensure_queue_dirs()
+    recover_interrupted_jobs()
+    stop_event = stop_event or threading.Event()
+    browsers = [browser or WarmBrowser()]
+    # 其余上传线程登录同一个频道：沿用第一个浏览器的频道，配置从它的配置目录复制
+    # The other upload threads log into the same channel: keep the first browser's channel and copy its profile
+    primary = browsers[0]
+    for index in range(1, max(1, concurrency)):
+        profile = worker_profile(index, (primary.channel or {}).get("profile_path") or primary.profile_path)
+        browsers.append(WarmBrowser(primary.max_uploads, primary.max_memory_mb, profile, primary.channel))
+
+    if len(browsers) == 1:
+        _serve_worker(stop_event, browsers[0], once, keep_warm)
+        return
+
+    workers = [
+        threading.Thread(target=_serve_worker, args=(stop_event, item, once, keep_warm and index == 0), name=f"uploader-{index}")
+        for index, item in enumerate(browsers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def queued_videos():
+    """已经在队列中（等待或处理中）的视频绝对路径
+    Absolute paths of videos already in the queue (pending or processing)"""
+    ensure_queue_dirs()
+    queued = set()
+    for job_file in glob.glob(os.path.join(PENDING_DIR, "*.json")) + glob.glob(os.path.join(PROCESSING_DIR, "*.json")):
+        with open(job_file, "r", encoding="utf-8") as f:
+            queued.add(os.path.abspath(json.load(f)["video_path"]))
+    return queued
+
+
+def submit_videos(videos):
+    """提交指定的视频，跳过已上传和已在队列中的
+    Submit the given videos, skipping ones already uploaded or queued
+
+    Returns:
+        提交的任务数 / Number of submitted jobs
+    """
+    uploaded = load_uploaded()
+    queued = queued_videos()
+    count = 0
+    for video in videos:
+        if os.path.basename(video) in uploaded or os.path.abspath(video) in queued or not os.path.exists(video):
+            continue
+        submit_upload(video)
+        count += 1
+    return count
+
+
+def submit_backlog(folder=MERGED_FOLDER):
+    """把文件夹中尚未上传、也不在队列中的合并视频全部提交（手动补传用，常驻进程只提交自己生成的视频）
+    Submit every merged video in a folder that is neither uploaded nor already queued (for manual
+    catch-up; the pipeline daemon only submits videos it produced itself)
+
+    Returns:
+        提交的任务数 / Number of submitted jobs
+    """
+    return submit_videos(sorted(glob.glob(os.path.join(folder, "*.mp4")), key=os.path.getmtime))
+
+
+def install_signal_handlers(stop_event):
+    """收到SIGINT/SIGTERM时设置停止标志，让当前任务完成后退出
+    Set the stop flag on SIGINT/SIGTERM so the daemon exits after the current job"""
+    def handle(signum, frame):
+        logger.info("\n收到停止信号，当前任务完成后退出")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handle)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, handle)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="B站上传守护进程 / Bilibili upload daemon")
+    parser.add_argument("--submit", "-s", nargs="+", help="提交视频到上传队列 / Submit videos to the upload queue")
+    parser.add_argument("--backlog", nargs="?", const=MERGED_FOLDER, help="提交文件夹中所有未上传的视频 / Submit all not-yet-uploaded videos in a folder")
+    parser.add_argument("--concurrency", "-c", type=int, default=1, help="并发上传数 / Concurrent uploads")
+    parser.add_argument("--once", action="store_true", help="处理完队列后退出 / Exit once the queue is empty")
+    parser.add_argument("--max-uploads", type=int, default=MAX_UPLOADS_PER_BROWSER, help="每个浏览器最多上传次数 / Uploads per browser")
+    parser.add_argument("--max-memory", type=int, default=MAX_BROWSER_MEMORY_MB, help="浏览器内存上限（MB）/ Browser memory limit (MB)")
+    args = parser.parse_args()
+
+    if args.submit:
+        for path in args.submit:
+            submit_upload(path)
+        sys.exit(0)
+    if args.backlog:
+        logger.info(f"已提交 {submit_backlog(args.backlog)} 个积压的视频")
+
+    stop = threading.Event()
+    install_signal_handlers(stop)
+    logger.info(f"上传守护进程已启动，队列目录: {os.path.abspath(QUEUE_DIR)}")
+    serve(stop, WarmBrowser(args.max_uploads, args.max_memory), once=args.once, concurrency=args.concurrency)
+    logger.info("上传守护进程已退出")